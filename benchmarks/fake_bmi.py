@@ -0,0 +1,221 @@
+# stand-in BMI models for benchmarking the Python side of the coupling (update functions, post-processing) without
+# the LISFLOOD library. The fake LISFLOOD engine mimics the behaviour that the coupling code relies on: an adaptive
+# update() that advances the model by one sub-step, update_until(t) for the native mode of update_lfp, get_var
+# returning views on the model state ('H', 'SGCz', 'DEM', 'Qx', 'Qy', 'SGCQin'), and the _t, _dt, _endTime and
+# get_current_time semantics of the GLOFRIM model wrappers
+import os
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+
+import utils
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+EXAMPLE_DEMS = {
+    'synthetic_2D': os.path.join(ROOT_DIR, 'example_models', 'LFP_synthetic_2D', 'LFP_DEM.asc'),
+    'synthetic_2D_ortho': os.path.join(ROOT_DIR, 'example_models', 'LFP_synthetic_2D_ortho', 'LFP_DEM.asc'),
+}
+
+
+def read_dem(fn, scale=1):
+    """
+    Reads a synthetic DEM and refines it to benchmark larger grids
+    :param fn: string - path to DEM (ascii grid)
+    :param scale: int - refinement factor in both directions (the number of cells grows with scale ** 2)
+    :return: tuple - 2D numpy array with elevation, Affine transform
+    """
+    with rasterio.open(fn) as src:
+        dem = src.read(1).astype(np.float64)
+        transform = src.transform
+    if scale > 1:
+        dem = np.kron(dem, np.ones((scale, scale)))
+        transform = transform * Affine.scale(1. / scale)
+    return dem, transform
+
+
+class FakeLisfloodBmi(object):
+    """
+    Pure NumPy stand-in for the LISFLOOD-FP BMI library. Water is routed with a simple diffusive scheme, starting
+    from a sub-grid channel in the middle of the domain, with an adaptive time step limited by a CFL condition,
+    so that the number of sub-steps per coupled step depends on the water depth as in LISFLOOD.
+    """
+    def __init__(self, dem, cellsize, initial_tstep=600., channel_depth=2., seed=0):
+        """
+        :param dem: 2D numpy array - terrain elevation
+        :param cellsize: float - cell size in m
+        :param initial_tstep: float - maximum sub-step in seconds
+        :param channel_depth: float - depth of the sub-grid channel below the terrain
+        :param seed: int - seed of the random initial water depth
+        """
+        rng = np.random.default_rng(seed)
+        self.cellsize = cellsize
+        self.initial_tstep = initial_tstep
+        self.t = 0.
+        self.vars = {'DEM': dem.copy()}
+        # channel along the middle eleventh of the columns (the middle column of the synthetic DEMs)
+        channel = np.zeros(dem.shape, dtype=bool)
+        channel[:, dem.shape[1] * 5 // 11:max(dem.shape[1] * 6 // 11, dem.shape[1] * 5 // 11 + 1)] = True
+        self.vars['SGCz'] = np.where(channel, dem - channel_depth, dem)
+        # channel partly over its banks, so that there is flood water to infiltrate
+        self.vars['H'] = np.where(channel, rng.uniform(1.5, 2.5, dem.shape), 0.)
+        self.vars['SGCQin'] = np.zeros(dem.shape)
+        # staggered flows as in LISFLOOD, one row and column more than the grid
+        self.vars['Qx'] = np.zeros((dem.shape[0] + 1, dem.shape[1] + 1))
+        self.vars['Qy'] = np.zeros((dem.shape[0] + 1, dem.shape[1] + 1))
+        self.tot_in = 0.
+        self.tot_out = 0.
+
+    def get_var(self, name):
+        return self.vars[name]
+
+    def get_current_time(self):
+        return self.t
+
+    def _time_step(self):
+        hmax = max(self.vars['H'].max(), 1e-3)
+        return min(self.initial_tstep, 0.7 * self.cellsize / np.sqrt(9.81 * hmax))
+
+    def update(self):
+        self._step(self._time_step())
+
+    def update_until(self, t):
+        # adaptive sub-steps, the last one shortened to end at t
+        while t - self.t > 1e-6:
+            self._step(min(self._time_step(), t - self.t))
+
+    def _step(self, dt):
+        h = self.vars['H']
+        z = self.vars['SGCz']
+        wse = z + h
+        k = 0.05 * self.cellsize
+        # fluxes over cell faces, driven by water surface differences, with the flow depth over the face as in
+        # LISFLOOD (highest water surface minus highest bed), so that water can spread onto dry cells
+        hflow_x = np.maximum(np.maximum(wse[:, :-1], wse[:, 1:]) - np.maximum(z[:, :-1], z[:, 1:]), 0)
+        hflow_y = np.maximum(np.maximum(wse[:-1, :], wse[1:, :]) - np.maximum(z[:-1, :], z[1:, :]), 0)
+        qx = -k * np.diff(wse, axis=1) * hflow_x / self.cellsize
+        qy = -k * np.diff(wse, axis=0) * hflow_y / self.cellsize
+        self.vars['Qx'][:-1, 1:-1] = qx
+        self.vars['Qy'][1:-1, :-1] = qy
+        dh = np.zeros(h.shape)
+        dh[:, :-1] -= qx
+        dh[:, 1:] += qx
+        dh[:-1, :] -= qy
+        dh[1:, :] += qy
+        dh *= dt / self.cellsize
+        dh += self.vars['SGCQin'] * dt / self.cellsize ** 2
+        self.tot_in += self.vars['SGCQin'].sum() * dt
+        h += dh
+        np.maximum(h, 0, out=h)
+        self.t += dt
+
+
+class FakeGrid(object):
+    """
+    Grid definition with the attributes of a GLOFRIM grid used by the coupling code
+    """
+    def __init__(self, transform, shape, mask=None, crs='EPSG:4326'):
+        self.transform = transform
+        self.crs = crs
+        self.height, self.width = shape
+        self.mask = np.ones(shape, dtype=bool) if mask is None else mask
+
+    def index(self, x, y):
+        cols, rows = ~self.transform * (np.asarray(x), np.asarray(y))
+        return np.ravel_multi_index((np.floor(rows).astype(int), np.floor(cols).astype(int)),
+                                    (self.height, self.width))
+
+
+class FakeLFP(object):
+    """
+    Stand-in for the GLOFRIM LISFLOOD model wrapper, updated with utils.update_lfp
+    """
+    update = utils.update_lfp
+
+    def __init__(self, dem, transform, cellsize=None, start_time=datetime(2000, 1, 1), days=3650, **kwargs):
+        """
+        :param dem: 2D numpy array - terrain elevation
+        :param transform: Affine - transform of the grid
+        :param cellsize: float - cell size in m (default: from transform)
+        :param start_time: datetime - start time of the model
+        :param days: int - length of the model run in days
+        """
+        if cellsize is None:
+            # cell size in m, latlong grids (such as synthetic_2D) are converted at the equator
+            cellsize = abs(transform.a) if abs(transform.a) > 1 else abs(transform.a) * 111320.
+        self._bmi = FakeLisfloodBmi(dem, cellsize, **kwargs)
+        self.grid = FakeGrid(transform, dem.shape)
+        self._startTime = start_time
+        self._endTime = start_time + timedelta(days=days)
+        self._dt = timedelta(seconds=self._bmi.initial_tstep)
+        self._t = start_time
+        self.logger = logging.getLogger('FakeLFP')
+
+    def get_current_time(self):
+        return self._startTime + timedelta(seconds=self._bmi.get_current_time())
+
+    def get_value(self, name):
+        return self._bmi.get_var(name)
+
+    def _get_tot_volume_in(self):
+        return self._bmi.tot_in
+
+    def _get_tot_volume_out(self):
+        return self._bmi.tot_out
+
+
+class FakeWflow(object):
+    """
+    Stand-in for the GLOFRIM wflow model wrapper, producing river runoff at the coupled points at every update
+    """
+    def __init__(self, n_points, start_time=datetime(2000, 1, 1), seed=0):
+        self._rng = np.random.default_rng(seed)
+        self._t = start_time
+        self.runoff = np.zeros(n_points)
+
+    def update(self, dt):
+        self._t += timedelta(seconds=dt)
+        self.runoff = self._rng.gamma(2., 5., self.runoff.shape)
+
+    def get_value_at_indices(self, name, idxs):
+        return self.runoff
+
+
+class FakeGlofrim(object):
+    """
+    Stand-in for the GLOFRIM coupled model, updated with utils.update_glofrim. wflow river runoff at a number of
+    inflow points is passed to the LISFLOOD sub-grid channel inflow, as in the one-way coupled experiments.
+    """
+    update = utils.update_glofrim
+
+    def __init__(self, lfp, n_inflow=5):
+        """
+        :param lfp: FakeLFP - LISFLOOD stand-in
+        :param n_inflow: int - number of inflow points
+        """
+        h = lfp._bmi.get_var('H')
+        self.idxs = np.flatnonzero(h > 0)[::max(1, np.count_nonzero(h > 0) // n_inflow)][:n_inflow]
+        self.bmimodels = {'WFL': FakeWflow(len(self.idxs), lfp._startTime), 'LFP': lfp}
+        self.initialized = True
+        self._t = lfp._startTime
+        self._dt = timedelta(days=1)
+        self._endTime = lfp._endTime
+        self.exchanges = [('update', 'WFL'),
+                          ('exchange', {'name': 'WFL.RiverRunoff>LFP.SGCQin'}),
+                          ('update', 'LFP')]
+        self._wb_header = ['time', 'WFL_tot_in', 'WFL_tot_out', 'WFL.RiverRunoff>LFP.SGCQin', 'LFP_tot_in',
+                           'LFP_tot_out']
+        self.logger = logging.getLogger('FakeGlofrim')
+        self.wb_logger = logging.getLogger('FakeGlofrim.wb')
+
+    def get_end_time(self):
+        return self._endTime
+
+    def get_current_time(self):
+        return self.bmimodels['LFP'].get_current_time()
+
+    def exchange(self, name, **kwargs):
+        q = self.bmimodels['WFL'].get_value_at_indices('RiverRunoff', self.idxs)
+        self.bmimodels['LFP']._bmi.get_var('SGCQin').flat[self.idxs] = q
+        return q.sum() * self._dt.total_seconds()
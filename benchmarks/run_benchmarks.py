@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# benchmarks of the Python side of the coupling on the synthetic example models, with stand-in BMI models
+# (see fake_bmi.py), so that they run without the LISFLOOD library. Timings are compared with stored baselines, so
+# that regressions show up as numbers.
+#
+#   python run_benchmarks.py                  # run all benchmarks and compare with baselines.json
+#   python run_benchmarks.py --quick          # smallest grid and shortest run only
+#   python run_benchmarks.py --filter discharge
+#   python run_benchmarks.py --save           # store the timings as new baselines
+#
+# Baselines depend on the machine, so store new baselines before comparing changes on another machine.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+import numpy as np
+import xarray as xr
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARK_DIR, '..'))
+import utils
+import fake_bmi
+
+BASELINES = os.path.join(BENCHMARK_DIR, 'baselines.json')
+SCALES = [1, 2]
+DAYS = [1, 5]
+TIMESTEPS = [30, 365]
+POINTS = [100, 10000]
+
+
+def make_lfp(dem_name, scale, **kwargs):
+    """
+    Sets up a LISFLOOD stand-in on a (refined) synthetic DEM. The cell size used for the time step is that of the
+    original DEM, so that the number of sub-steps per day does not depend on the refinement
+    """
+    dem, transform = fake_bmi.read_dem(fake_bmi.EXAMPLE_DEMS[dem_name], scale=scale)
+    cellsize = abs(transform.a) * scale
+    cellsize = cellsize if cellsize > 1 else cellsize * 111320.
+    return fake_bmi.FakeLFP(dem, transform, cellsize=cellsize, **kwargs)
+
+
+def make_cross_sections(x, y, n=5):
+    """
+    Makes cross sections perpendicular to the channel (spanning the domain in x-direction) at n rows
+    """
+    feats = []
+    for i, yi in enumerate(np.linspace(y[0], y[-1], n + 2)[1:-1]):
+        feats.append({'geometry': {'type': 'LineString', 'coordinates': [(x[0], yi), (x[-1], yi)]},
+                      'properties': {'name': 'cs{:d}'.format(i)}})
+    return feats
+
+
+def bench_update_lfp(dem_name, scale, days):
+    lfp = make_lfp(dem_name, scale)
+
+    def run():
+        for _ in range(days):
+            lfp.update(dt=86400., infiltcap=30. / 86400, storagecap=1e6)
+    return run
+
+
+def bench_update_lfp_native(dem_name, scale, days):
+    lfp = make_lfp(dem_name, scale)
+
+    def run():
+        for _ in range(days):
+            lfp.update(dt=86400., infiltcap=30. / 86400, storagecap=1e6, native=True)
+    return run
+
+
+def bench_update_glofrim(dem_name, scale, days):
+    cbmi = fake_bmi.FakeGlofrim(make_lfp(dem_name, scale))
+
+    def run():
+        for _ in range(days):
+            cbmi.update()
+    return run
+
+
+def flow_fields(dem_name, scale, timesteps):
+    lfp = make_lfp(dem_name, scale)
+    x, y = utils.grid_coords(lfp.grid.transform, (lfp.grid.height, lfp.grid.width))
+    rng = np.random.default_rng(0)
+    time = [datetime(2000, 1, 1) + timedelta(days=i) for i in range(timesteps)]
+    shape = (timesteps, lfp.grid.height, lfp.grid.width)
+    return x, y, time, rng.normal(0, 1, shape), rng.normal(0, 1, shape)
+
+
+def bench_discharge(dem_name, scale, timesteps):
+    x, y, time, qx, qy = flow_fields(dem_name, scale, timesteps)
+    da_x = xr.DataArray(qx, dims=('time', 'y', 'x'), coords={'time': time, 'y': y, 'x': x}, attrs={'units': 'm3/s'})
+    da_y = xr.DataArray(qy, dims=('time', 'y', 'x'), coords={'time': time, 'y': y, 'x': x}, attrs={'units': 'm3/s'})
+    feats = make_cross_sections(x, y)
+
+    def run():
+        utils.discharge(da_x, da_y, feats)
+    return run
+
+
+def bench_merge_outputs(dem_name, scale, timesteps):
+    x, y, time, h, q = flow_fields(dem_name, scale, timesteps)
+    datas = [list(h), list(q)]
+    names = ['H', 'Q']
+    attributes = [{'units': 'm'}, {'units': 'm3/s'}]
+
+    def run():
+        utils.merge_outputs(datas, time, x, y, names, attributes)
+    return run
+
+
+def bench_get_indexes(dem_name, scale, points):
+    import geopandas as gpd
+    lfp = make_lfp(dem_name, scale)
+    cbmi = SimpleNamespace(bmimodels={'LFP': lfp})
+    x, y = utils.grid_coords(lfp.grid.transform, (lfp.grid.height, lfp.grid.width))
+    rng = np.random.default_rng(0)
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(rng.uniform(min(x), max(x), points),
+                                                       rng.uniform(min(y), max(y), points)))
+
+    def run():
+        utils.get_indexes(cbmi, gdf, model_name='LFP')
+    return run
+
+
+# benchmark name: (setup function, name of size parameter, sizes)
+BENCHMARKS = {
+    'update_lfp': (bench_update_lfp, 'days', DAYS),
+    'update_lfp_native': (bench_update_lfp_native, 'days', DAYS),
+    'update_glofrim': (bench_update_glofrim, 'days', DAYS),
+    'discharge': (bench_discharge, 'timesteps', TIMESTEPS),
+    'merge_outputs': (bench_merge_outputs, 'timesteps', TIMESTEPS),
+    'get_indexes': (bench_get_indexes, 'points', POINTS),
+}
+
+
+def cases(quick=False, pattern=None):
+    """
+    :param quick: boolean - only the smallest grid and size
+    :param pattern: string - only cases whose name contains pattern
+    :return: list - (case name, benchmark name, dem name, scale, size) for all cases
+    """
+    result = []
+    for name, (setup, size_name, sizes) in BENCHMARKS.items():
+        scales, sizes = (SCALES[:1], sizes[:1]) if quick else (SCALES, sizes)
+        for dem_name, scale, size in itertools.product(fake_bmi.EXAMPLE_DEMS, scales, sizes):
+            case = '{:s}[{:s},scale={:d},{:s}={:d}]'.format(name, dem_name, scale, size_name, size)
+            if pattern is None or pattern in case:
+                result.append((case, name, dem_name, scale, size))
+    return result
+
+
+def run_case(name, dem_name, scale, size, repeat=3):
+    """
+    Times one benchmark case. Set-up is not timed, and every repeat starts from a fresh set-up.
+    :return: float - best wall time over the repeats in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        run = BENCHMARKS[name][0](dem_name, scale, size)
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the coupling code with stand-in BMI models')
+    parser.add_argument('--quick', action='store_true', help='smallest grid and size only')
+    parser.add_argument('--filter', default=None, help='only run cases containing this string')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repeats per case (best is reported)')
+    parser.add_argument('--save', action='store_true', help='store timings as baselines')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slow-down at which a case is reported as a regression')
+    parser.add_argument('--noise', type=float, default=0.002,
+                        help='absolute slow-down in seconds below which a case is never reported as a regression')
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if os.path.isfile(BASELINES):
+        with open(BASELINES, 'r') as f:
+            baselines = json.load(f)['timings']
+    results = {}
+    regressions = []
+    print('{:60s} {:>10s} {:>10s} {:>7s}'.format('case', 'seconds', 'baseline', 'ratio'))
+    for case, name, dem_name, scale, size in cases(args.quick, args.filter):
+        results[case] = run_case(name, dem_name, scale, size, repeat=args.repeat)
+        baseline = baselines.get(case)
+        if baseline is None:
+            print('{:60s} {:10.4f} {:>10s} {:>7s}'.format(case, results[case], '-', '-'))
+            continue
+        ratio = results[case] / baseline
+        # differences of a few milliseconds are timer noise, not regressions
+        slower = ratio > 1 + args.tolerance and results[case] - baseline > args.noise
+        flag = '  REGRESSION' if slower else ''
+        print('{:60s} {:10.4f} {:10.4f} {:7.2f}{:s}'.format(case, results[case], baseline, ratio, flag))
+        if flag:
+            regressions.append(case)
+    if args.save:
+        baselines.update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump({'machine': {'platform': platform.platform(),
+                                   'processor': platform.processor(),
+                                   'python': platform.python_version(),
+                                   'numpy': np.__version__
+                                   },
+                       'timings': baselines
+                       }, f, indent=1, sort_keys=True)
+        print('Baselines stored in {:s}'.format(BASELINES))
+    if len(regressions) > 0:
+        print('{:d} regression(s) beyond {:.0%}'.format(len(regressions), args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# runs a coupled experiment declared in an experiment file, see specs/ for the experiments (the *_oneyear.py scripts
+# run these) and utils.runner for the options, e.g.
+#
+#   python run_experiment.py specs/lisflood_1d2d_twoway.ini
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: python run_experiment.py <experiment file>')
+    utils.run_experiment(sys.argv[1])
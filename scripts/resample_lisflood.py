@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# builds LISFLOOD model variants at other resolutions from the model in ../lisflood (replaces warp_lisflood.sh),
+# resampled layers are cached in ../lisflood/resampled, so that rebuilding a variant only exports them, e.g.
+#
+#   python resample_lisflood.py 250 500 1000 --bounds 675000 8162500 848500 8454500
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resamples the LISFLOOD inputs to other resolutions')
+    parser.add_argument('resolution', type=float, nargs='+', help='cell size(s) of the variants in m')
+    parser.add_argument('--bounds', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                        help='extent of the variants (default: extent of the DEM)')
+    parser.add_argument('--model', default=os.path.join(ROOT, 'lisflood'), help='folder of the LISFLOOD model')
+    parser.add_argument('--output', default=os.path.join(ROOT, 'lisflood_{resolution:g}m'),
+                        help='folder of each variant, formatted with the resolution')
+    parser.add_argument('--cache', default=None, help='folder with cached layers (default: <model>/resampled)')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    args = parser.parse_args()
+    written = utils.resample_lisflood(args.model, args.output, args.resolution, bounds=args.bounds,
+                                      cache_dir=args.cache, workers=args.workers)
+    for fn, resampled in sorted(written.items()):
+        print('{:s} {:s}'.format('resampled' if resampled else 'cached   ', fn))
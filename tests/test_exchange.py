@@ -0,0 +1,142 @@
+# checks that fusing exchanges (utils.fuse_grid_exchanges) does not change what arrives in the target model, with a
+# stand-in for GLOFRIM that exchanges in the way GLOFRIM does: the product of the source variables (get_value of the
+# source model) times from_unit, regridded to the target grid, times to_unit, added to or set in the target variable
+#
+#   python -m pytest tests
+import os
+import sys
+import copy
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
+
+class SourceModel(object):
+    def __init__(self, values):
+        self.values = values
+
+    def get_value(self, var):
+        return self.values[var].copy()
+
+
+class TargetModel(object):
+    def __init__(self, shape):
+        self.values = {'H': np.ones(shape), 'SGCQin': np.zeros(shape)}
+
+    def get_value(self, var):
+        return self.values[var]
+
+
+class BlockSum(object):
+    """
+    Stand-in for a GLOFRIM grid-to-grid coupling: sums blocks of cells of the source grid (a linear regridding), one
+    object per exchange as GLOFRIM creates them
+    """
+    def __init__(self, grid, factor=2):
+        self.grid = grid
+        self.factor = factor
+
+    def regrid(self, values):
+        ny, nx = values.shape
+        return values.reshape(ny // self.factor, self.factor, nx // self.factor, self.factor).sum(axis=(1, 3))
+
+
+GRID = object()
+
+
+class CoupledModel(object):
+    """
+    Stand-in for GLOFRIM with a source grid of 6 x 8 cells that is regridded to a target grid of 3 x 4 cells by the
+    coupling of each exchange
+    """
+    def __init__(self, exchanges, seed=0):
+        rng = np.random.default_rng(seed)
+        names = ['InwaterMM', 'ssf_toriver', 'InwaterL', 'RiverRunoff', 'Area']
+        self.bmimodels = {'WFL': SourceModel({name: rng.random((6, 8)) for name in names}),
+                          'LFP': TargetModel((3, 4))}
+        self.exchanges = exchanges
+        self._wb_header = ['time'] + [item[1]['name'] for item in exchanges if item[0] == 'exchange']
+
+    def exchange(self, name, from_mod, from_vars, to_mod, to_vars, coupling, from_unit=1., to_unit=1., add=False,
+                 **kwargs):
+        values = self.bmimodels[from_mod].get_value(from_vars[0])
+        for var in from_vars[1:]:
+            values = values * self.bmimodels[from_mod].get_value(var)
+        values = values * from_unit
+        regridded = coupling.regrid(values) * to_unit
+        target = self.bmimodels[to_mod].get_value(to_vars[0])
+        if add:
+            target += regridded
+        else:
+            target[...] = regridded
+        return values.sum()
+
+    def update(self):
+        return {item[1]['name']: self.exchange(**item[1]) for item in self.exchanges if item[0] == 'exchange'}
+
+
+def exchange(name, from_vars, to_var='H', from_unit=1., to_unit=1., add=True):
+    return ('exchange', {'name': name, 'from_mod': 'WFL', 'from_vars': from_vars, 'from_unit': from_unit,
+                         'to_mod': 'LFP', 'to_vars': [to_var], 'to_unit': to_unit, 'add': add,
+                         'coupling': BlockSum(GRID)})
+
+
+# units as in glofrim_barotse_2way1D2D.ini: LFP.H*1000 for InwaterMM, *0.72337963 for ssf_toriver and InwaterL
+EXCHANGES = [
+    ('update', 'WFL'),
+    exchange('WFL.RiverRunoff>LFP.SGCQin', ['RiverRunoff'], to_var='SGCQin', from_unit=86400., add=False),
+    exchange('WFL.InwaterMM>LFP.H', ['InwaterMM', 'Area'], from_unit=0.001, to_unit=1000.),
+    exchange('WFL.ssf_toriver>LFP.H', ['ssf_toriver'], from_unit=3.5, to_unit=0.72337963),
+    exchange('WFL.InwaterL>LFP.H', ['InwaterL'], from_unit=-2., to_unit=0.72337963),
+    ('update', 'LFP'),
+]
+
+
+def test_fused_exchanges_deliver_same_target_values():
+    unfused = CoupledModel(copy.deepcopy(EXCHANGES))
+    fused = CoupledModel(copy.deepcopy(EXCHANGES))
+    names = utils.fuse_grid_exchanges(fused)
+    assert names == ['WFL.InwaterMM>LFP.H + WFL.ssf_toriver>LFP.H + WFL.InwaterL>LFP.H']
+    assert len([item for item in fused.exchanges if item[0] == 'exchange']) == 2
+    for step in range(3):
+        volumes_unfused = unfused.update()
+        volumes_fused = fused.update()
+        for var in ['H', 'SGCQin']:
+            np.testing.assert_allclose(fused.bmimodels['LFP'].values[var], unfused.bmimodels['LFP'].values[var],
+                                       rtol=1e-12)
+        # the fused exchange gives the sum of the volumes of the exchanges it replaces, in the units of the first
+        to_units = [item[1]['to_unit'] for item in EXCHANGES[2:5]]
+        volume = sum(volumes_unfused[name] * to_unit / to_units[0]
+                     for name, to_unit in zip(names[0].split(' + '), to_units))
+        assert volumes_fused[names[0]] == pytest.approx(volume)
+    assert fused._wb_header == ['time', 'WFL.RiverRunoff>LFP.SGCQin', names[0]]
+
+
+def test_exchanges_that_overwrite_are_not_fused():
+    exchanges = copy.deepcopy(EXCHANGES)
+    exchanges[4][1]['add'] = False
+    fused = CoupledModel(exchanges)
+    unfused = CoupledModel(copy.deepcopy(exchanges))
+    assert utils.fuse_grid_exchanges(fused) == ['WFL.InwaterMM>LFP.H + WFL.ssf_toriver>LFP.H']
+    fused.update()
+    unfused.update()
+    np.testing.assert_array_equal(fused.bmimodels['LFP'].values['H'], unfused.bmimodels['LFP'].values['H'])
+
+
+def test_exchanges_with_other_couplings_are_not_fused():
+    exchanges = copy.deepcopy(EXCHANGES)
+    # another block size on the same grid, and the same block size on another grid
+    exchanges[3][1]['coupling'] = BlockSum(exchanges[2][1]['coupling'].grid, factor=3)
+    exchanges[4][1]['coupling'] = BlockSum(object())
+    assert utils.fuse_grid_exchanges(CoupledModel(exchanges)) == []
+
+
+def test_unknown_exchange_layout_is_refused():
+    exchanges = copy.deepcopy(EXCHANGES)
+    del exchanges[2][1]['from_mod']
+    model = CoupledModel(exchanges)
+    with pytest.raises(ValueError):
+        utils.fuse_grid_exchanges(model)
+    assert model.exchanges == exchanges
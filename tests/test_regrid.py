@@ -0,0 +1,67 @@
+# checks that utils.Regridder conserves volume and preserves constant fields on grids whose cells are not aligned
+#
+#   python -m pytest tests
+import os
+import sys
+import numpy as np
+import rasterio.warp
+from rasterio.transform import Affine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+from utils.regrid import _shoelace
+
+CRS = 'EPSG:32734'
+# 500 m source grid inside a 900 m target grid, with edges that do not line up
+SRC_TRANSFORM = Affine(500., 0., 700123., 0., -500., 8300077.)
+SRC_SHAPE = (60, 80)
+DST_TRANSFORM = Affine(900., 0., 699000., 0., -900., 8301000.)
+DST_SHAPE = (36, 48)
+
+
+def regridder(**kwargs):
+    return utils.Regridder(SRC_TRANSFORM, CRS, SRC_SHAPE, DST_TRANSFORM, CRS, DST_SHAPE, **kwargs)
+
+
+def test_volume_is_conserved():
+    data = np.random.default_rng(0).random(SRC_SHAPE)
+    regridded = regridder()(data)
+    np.testing.assert_allclose((regridded * 900. ** 2).sum(), (data * 500. ** 2).sum(), rtol=1e-10)
+
+
+def test_constant_field_is_preserved():
+    regridded = regridder()(np.ones(SRC_SHAPE))
+    # target cells fully covered by the source grid
+    x0, y0 = SRC_TRANSFORM * (0, 0)
+    x1, y1 = SRC_TRANSFORM * (SRC_SHAPE[1], SRC_SHAPE[0])
+    c0, r0 = [int(np.ceil(v)) for v in ~DST_TRANSFORM * (x0, y0)]
+    c1, r1 = [int(np.floor(v)) for v in ~DST_TRANSFORM * (x1, y1)]
+    np.testing.assert_allclose(regridded[r0:r1, c0:c1], 1., rtol=1e-12)
+    # partly covered cells at the edge get the covered fraction, cells outside nothing
+    assert regridded.max() <= 1. + 1e-12
+    assert regridded[:r0 - 1].sum() == 0. and regridded[:, :c0 - 1].sum() == 0.
+
+
+def test_nodata_does_not_contribute():
+    data = np.ones(SRC_SHAPE)
+    data[10:20, 10:20] = np.nan
+    regridded = regridder()(data, nodata=np.nan)
+    assert np.isfinite(regridded).all()
+    np.testing.assert_allclose((regridded * 900. ** 2).sum(), (np.nansum(data) * 500. ** 2), rtol=1e-10)
+
+
+def test_volume_is_conserved_between_crs():
+    # target grid in geographic coordinates, overlaps are approximated by oversampling
+    (left, right), (top, bottom) = rasterio.warp.transform(CRS, 'EPSG:4326', [699000., 745000.], [8301000., 8266000.])
+    dst_transform = Affine(0.01, 0., left, 0., -0.01, top)
+    dst_shape = (int(np.ceil((top - bottom) / 0.01)), int(np.ceil((right - left) / 0.01)))
+    data = np.random.default_rng(1).random(SRC_SHAPE)
+    regridded = utils.Regridder(SRC_TRANSFORM, CRS, SRC_SHAPE, dst_transform, 'EPSG:4326', dst_shape,
+                                oversample=8)(data)
+    # areas of the target cells in the source crs
+    cols, rows = np.meshgrid(np.arange(dst_shape[1] + 1), np.arange(dst_shape[0] + 1))
+    xs, ys = rasterio.warp.transform('EPSG:4326', CRS, *(dst_transform * (cols.flatten(), rows.flatten())))
+    xs, ys = np.reshape(xs, rows.shape), np.reshape(ys, rows.shape)
+    area = _shoelace([xs[:-1, :-1], xs[:-1, 1:], xs[1:, 1:], xs[1:, :-1]],
+                     [ys[:-1, :-1], ys[:-1, 1:], ys[1:, 1:], ys[1:, :-1]])
+    np.testing.assert_allclose((regridded * area).sum(), (data * 500. ** 2).sum(), rtol=1e-10)
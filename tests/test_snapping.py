@@ -0,0 +1,38 @@
+# checks that utils.RiverSnapper snaps the SFINCS source points of the Barotse model to wflow river cells with the
+# upstream areas of the points (the uparea column of src_update.geojson)
+#
+#   python -m pytest tests
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STATICMAPS = os.path.join(ROOT, 'wflow', 'staticmaps')
+SOURCES = os.path.join(ROOT, 'sfincs', 'barotse', 'gis', 'src_update.geojson')
+
+
+@pytest.fixture(scope='module')
+def snapped():
+    gpd = pytest.importorskip('geopandas')
+    snapper = utils.RiverSnapper(os.path.join(STATICMAPS, 'wflow_river.map'),
+                                 os.path.join(STATICMAPS, 'wflow_uparea.map'))
+    gdf = gpd.read_file(SOURCES)
+    idxs = snapper.snap_gdf(gdf)
+    uparea = snapper.uparea[np.searchsorted(snapper.index, idxs)]
+    return gdf['uparea'].values, uparea
+
+
+def test_snapped_cells_match_reference_upstream_areas(snapped):
+    reference, uparea = snapped
+    np.testing.assert_allclose(uparea, reference, rtol=0.06)
+
+
+def test_point_at_confluence_is_snapped_above_it(snapped):
+    # point 2 (33851 km2) lies on the cell below the confluence with the tributary of point 1 (5825 km2), which
+    # would count the tributary twice
+    reference, uparea = snapped
+    assert uparea[2] < reference[2] + reference[1] / 2.
@@ -1,2 +1,19 @@
 from .update_funcs import *
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .encoding import *
+from .output import *
+from .zarrstore import *
+from .regrid import *
+from .ensemble import *
+from .staticmaps import *
+from .resample import *
+from .checkpoint import *
+from .spinup import *
+from .waterbalance import *
+from .timing import *
+from .inertial import *
+from .snapping import *
+from .exchange import *
+from .floodstats import *
+from .overviews import *
+from .runner import *
@@ -0,0 +1,171 @@
+# checkpoints of coupled GLOFRIM runs, so that long (multi-year) runs can be resumed after a crash or a
+# pre-empted job instead of starting again from the start time
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime
+import numpy as np
+from .staticmaps import checksum
+
+# state variables stored per model (retrieved with get_var), wflow states are written in its own format instead
+STATE_VARIABLES = {
+    'LFP': ['H', 'Qx', 'Qy'],
+    'Sfincs': ['zs'],
+}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def run_key(config_fn, extra=None):
+    """
+    Identifies a coupled run by its configuration, so that checkpoints are only resumed by the run that wrote them:
+    a hash of the contents of the GLOFRIM ini file and of the model configuration files it references (e.g. the
+    wflow ini, LISFLOOD par and SFINCS inp files), and of any other settings of the run
+    :param config_fn: string - path to GLOFRIM ini file
+    :param extra: dict - other settings of the run (e.g. coupling options and outputs), included in the key
+    :return: string - hexadecimal key
+    """
+    # imported here, spinup imports this module
+    from .spinup import model_configs
+    content = {'config': checksum(config_fn),
+               'models': {mod: checksum(fn) for mod, fn in sorted(model_configs(config_fn).items())},
+               'extra': extra,
+               }
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def save_checkpoint(cbmi, checkpoint_dir, writers={}, variables=STATE_VARIABLES, keep=2, key=None):
+    """
+    Writes a checkpoint of the coupled model at its current time to a new folder checkpoint_<time> in
+    checkpoint_dir. The checkpoint contains:
+        - the wflow states, as PCRaster maps named as in wflow/instate (save_state of the wflow bmi)
+        - the state variables of the other models (e.g. LISFLOOD H, Qx, Qy and SFINCS zs) in states.npz
+        - the GLOFRIM clock, the clocks of all models, the positions of the output writers and the key of the run
+          in checkpoint.json
+    The folder is first written under a temporary name and renamed when complete, so that a crash during writing
+    never leaves a broken checkpoint behind. Only the last keep checkpoints are retained.
+    :param cbmi: Glofrim - initialized coupled model
+    :param checkpoint_dir: string - folder with checkpoints of this run
+    :param writers: dict - output writers (OutputWriter, DischargeRecorder, WaterBalanceRecorder) by name, their
+        positions are stored
+    :param variables: dict - per model the state variables to store
+    :param keep: int - number of checkpoints to retain (None to retain all)
+    :param key: string - key of the run (see run_key), checked when the checkpoint is resumed
+    :return: string - path to the checkpoint
+    """
+    t = cbmi.get_current_time()
+    path = os.path.join(checkpoint_dir, 'checkpoint_{:s}'.format(t.strftime('%Y%m%d%H%M%S')))
+    path_tmp = path + '.tmp'
+    for p in [path, path_tmp]:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+    os.makedirs(path_tmp)
+    if 'WFL' in cbmi.bmimodels:
+        os.makedirs(os.path.join(path_tmp, 'wflow'))
+        cbmi.bmimodels['WFL']._bmi.save_state(os.path.join(path_tmp, 'wflow'))
+    states = {}
+    for mod, names in variables.items():
+        if mod in cbmi.bmimodels:
+            for name in names:
+                states['{:s}.{:s}'.format(mod, name)] = np.array(cbmi.bmimodels[mod]._bmi.get_var(name))
+    np.savez(os.path.join(path_tmp, 'states.npz'), **states)
+    # make sure all outputs up to the checkpoint are on disk
+    for writer in writers.values():
+        if hasattr(writer, 'flush'):
+            writer.flush()
+        else:
+            writer.nc.sync()
+    meta = {'time': t.strftime(TIME_FORMAT),
+            'clocks': {mod: bmi._t.strftime(TIME_FORMAT) for mod, bmi in cbmi.bmimodels.items()},
+            'writers': {name: writer.n for name, writer in writers.items()},
+            'key': key,
+            }
+    with open(os.path.join(path_tmp, 'checkpoint.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(path_tmp, path)
+    if keep is not None:
+        for old in list_checkpoints(checkpoint_dir)[:-keep]:
+            shutil.rmtree(old)
+    return path
+
+
+def list_checkpoints(checkpoint_dir):
+    """
+    :param checkpoint_dir: string - folder with checkpoints of a run
+    :return: list - paths to complete checkpoints, from old to new
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    names = sorted(name for name in os.listdir(checkpoint_dir)
+                   if name.startswith('checkpoint_') and not name.endswith('.tmp'))
+    return [os.path.join(checkpoint_dir, name) for name in names
+            if os.path.isfile(os.path.join(checkpoint_dir, name, 'checkpoint.json'))]
+
+
+def latest_checkpoint(checkpoint_dir, key=None):
+    """
+    :param checkpoint_dir: string - folder with checkpoints of a run
+    :param key: string - if set, key of the run (see run_key) that the checkpoint must have been written by
+    :return: string - path to the latest complete checkpoint, None if there is none
+    """
+    checkpoints = list_checkpoints(checkpoint_dir)
+    if len(checkpoints) == 0:
+        return None
+    if key is not None and read_checkpoint(checkpoints[-1]).get('key') != key:
+        raise ValueError('Checkpoints in {:s} were written by a run with another configuration, inputs or settings. '
+                         'Remove the folder to start again, or restore the configuration to resume'.format(
+                             checkpoint_dir))
+    return checkpoints[-1]
+
+
+def remove_checkpoints(checkpoint_dir):
+    """
+    Removes the checkpoints of a run, once it has completed, so that a rerun starts from the start time
+    :param checkpoint_dir: string - folder with checkpoints of a run
+    """
+    if os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+
+
+def read_checkpoint(path):
+    """
+    Reads the clock and writer positions of a checkpoint, without touching any model. Use the time to set the
+    start time of the coupled model before it is initialized.
+    :param path: string - path to checkpoint
+    :return: dict - with time (datetime), clocks (dict of datetime per model) and writers (dict of positions)
+    """
+    with open(os.path.join(path, 'checkpoint.json'), 'r') as f:
+        meta = json.load(f)
+    meta['time'] = datetime.strptime(meta['time'], TIME_FORMAT)
+    meta['clocks'] = {mod: datetime.strptime(t, TIME_FORMAT) for mod, t in meta['clocks'].items()}
+    return meta
+
+
+def load_checkpoint(cbmi, path):
+    """
+    Restores the states of an initialized coupled model from a checkpoint. The start time of the coupled model
+    must have been set to the time of the checkpoint (see read_checkpoint) before initialize_model, so that
+    forcing and boundary conditions continue from the right moment.
+    :param cbmi: Glofrim - initialized coupled model
+    :param path: string - path to checkpoint
+    :return: dict - with time (datetime), clocks (dict of datetime per model) and writers (dict of positions)
+    """
+    meta = read_checkpoint(path)
+    if cbmi.get_current_time() != meta['time']:
+        raise ValueError('Model time {} differs from checkpoint time {}, set the start time to the checkpoint time '
+                         'before initializing the model'.format(cbmi.get_current_time(), meta['time']))
+    if 'WFL' in cbmi.bmimodels:
+        cbmi.bmimodels['WFL']._bmi.load_state(os.path.abspath(os.path.join(path, 'wflow')))
+    with np.load(os.path.join(path, 'states.npz')) as states:
+        for key in states.files:
+            mod, name = key.split('.', 1)
+            bmi = cbmi.bmimodels[mod]._bmi
+            if mod == 'LFP':
+                # LISFLOOD returns views on its own memory, so the state is restored by writing into them
+                bmi.get_var(name)[...] = states[key]
+            else:
+                bmi.set_var(name, states[key])
+    cbmi._t = meta['time']
+    for mod, t in meta['clocks'].items():
+        cbmi.bmimodels[mod]._t = t
+    return meta
@@ -0,0 +1,184 @@
+# storage encodings of output fields. Fields are computed in float64, but water depths are only meaningful to the
+# millimetre and fluxes to a few significant digits, so they are stored quantised and compressed
+import numpy as np
+
+
+class Encoding(object):
+    """
+    Storage encoding of one output variable, used by OutputWriter (netCDF4) and output_encodings (xarray):
+        dtype 'f4' - float32, optionally with the mantissa rounded to a number of significant digits, so that the
+            trailing bits are zero and compress well (relative error at most 2**-(keepbits + 1))
+        dtype 'i2' - int16 packed with scale_factor and add_offset (CF convention), absolute error at most
+            scale_factor / 2, values outside the valid range are clipped to it and NaN is stored as fill value
+    Data are always stored with the shuffle filter and zlib compression.
+
+    Usage:
+        enc = Encoding('i2', scale_factor=0.001, add_offset=32.767)  # 0 - 65.534 m, max error 0.5 mm
+        v = nc.createVariable(name, dimensions=dims, **enc.netcdf())
+        v[:] = enc.encode(data)
+    """
+    def __init__(self, dtype='f4', scale_factor=None, add_offset=0., significant_digits=None, complevel=None,
+                 shuffle=True):
+        """
+        :param dtype: string - storage type, 'f4', 'f8' or 'i2'
+        :param scale_factor: float - packing resolution of integer types
+        :param add_offset: float - packing offset of integer types (value of the stored 0)
+        :param significant_digits: int - decimal significant digits kept of float types (default: all)
+        :param complevel: int - zlib compression level (1-9), default that of the writer
+        :param shuffle: boolean - if True, bytes are shuffled before compression
+        """
+        self.dtype = np.dtype(dtype)
+        self.packed = self.dtype.kind == 'i'
+        if self.packed and scale_factor is None:
+            raise ValueError('Integer encodings need a scale_factor')
+        self.scale_factor = scale_factor
+        self.add_offset = add_offset
+        self.significant_digits = significant_digits
+        self.complevel = complevel
+        self.shuffle = shuffle
+        if self.packed:
+            info = np.iinfo(self.dtype)
+            # the lowest integer is reserved for missing values
+            self.fill_value = int(info.min)
+            self.valid_range = (add_offset + (info.min + 1) * scale_factor, add_offset + info.max * scale_factor)
+        else:
+            self.fill_value = None
+            self.valid_range = None
+        if significant_digits is not None and not self.packed:
+            # mantissa bits needed for the decimal digits, of the 23 (float32) or 52 (float64) available
+            self.keepbits = min(int(np.ceil(significant_digits * np.log2(10))), np.finfo(self.dtype).nmant)
+        else:
+            self.keepbits = None
+
+    @property
+    def max_error(self):
+        """
+        :return: tuple - maximum absolute error (None if relative) and maximum relative error (None if absolute)
+            of stored values within the valid range
+        """
+        if self.packed:
+            return 0.5 * self.scale_factor, None
+        return None, 2. ** -((self.keepbits or np.finfo(self.dtype).nmant) + 1)
+
+    def __repr__(self):
+        abs_err, rel_err = self.max_error
+        error = '{:g}'.format(abs_err) if abs_err is not None else '{:g} (relative)'.format(rel_err)
+        return 'Encoding({:s}, max error {:s})'.format(self.dtype.str, error)
+
+    def _round_mantissa(self, data):
+        # round to nearest on the kept bits, then zero the others
+        uint = np.dtype('u{:d}'.format(self.dtype.itemsize))
+        bits = data.view(uint)
+        drop = np.finfo(self.dtype).nmant - self.keepbits
+        half = uint.type(1 << (drop - 1)) if drop > 0 else uint.type(0)
+        mask = uint.type(~((1 << drop) - 1) & np.iinfo(uint).max)
+        finite = np.isfinite(data)
+        bits[finite] = (bits[finite] + half) & mask
+        return data
+
+    def encode(self, data):
+        """
+        Prepares data to be stored: clipped to the valid range (packed types) or with rounded mantissa (float
+        types). Packing itself is done by netCDF4 or xarray from the scale_factor and add_offset attributes.
+        :param data: numpy array - values in float
+        :return: numpy array - values to write, masked where missing for packed types
+        """
+        if self.packed:
+            data = np.clip(np.asarray(data, dtype=np.float64), *self.valid_range)
+            # missing values are replaced under the mask, so that packing does not cast NaN to integers
+            missing = np.isnan(data)
+            return np.ma.masked_array(np.where(missing, self.add_offset, data), mask=missing)
+        data = np.array(data, dtype=self.dtype)
+        if self.keepbits is not None:
+            data = self._round_mantissa(data)
+        return data
+
+    def pack(self, data):
+        """
+        Converts data to the stored values, for stores that do not pack themselves (e.g. zarr)
+        :param data: numpy array - values in float
+        :return: numpy array - values in the storage type, fill value (packed types) or NaN where missing
+        """
+        data = self.encode(data)
+        if not self.packed:
+            return data
+        packed = np.round((data.filled(np.nan) - self.add_offset) / self.scale_factor)
+        return np.where(np.isnan(packed), self.fill_value, packed).astype(self.dtype)
+
+    def netcdf(self, complevel=4):
+        """
+        :param complevel: int - zlib compression level if the encoding has none
+        :return: dict - arguments of netCDF4 createVariable
+        """
+        kwargs = {'datatype': self.dtype.str.lstrip('<>='), 'zlib': True, 'shuffle': self.shuffle,
+                  'complevel': self.complevel or complevel}
+        if self.fill_value is not None:
+            kwargs['fill_value'] = self.fill_value
+        return kwargs
+
+    def attributes(self):
+        """
+        :return: dict - packing attributes to set on the netCDF4 variable
+        """
+        if not self.packed:
+            return {}
+        return {'scale_factor': self.scale_factor, 'add_offset': self.add_offset}
+
+    def xarray(self, complevel=4):
+        """
+        :param complevel: int - zlib compression level if the encoding has none
+        :return: dict - encoding of the variable in xarray to_netcdf
+        """
+        encoding = {'dtype': self.dtype.name, 'zlib': True, 'shuffle': self.shuffle,
+                    'complevel': self.complevel or complevel}
+        if self.keepbits is not None:
+            # the mantissa is rounded to the kept bits by the netCDF library when the data are written
+            encoding.update({'significant_digits': self.keepbits, 'quantize_mode': 'BitRound'})
+        if self.packed:
+            encoding.update({'scale_factor': self.scale_factor, 'add_offset': self.add_offset,
+                             '_FillValue': self.fill_value})
+        return encoding
+
+
+# depths in millimetres between 0 and 65.534 m, levels and elevations in float32, flows with 4 significant digits
+DEPTH_ENCODING = Encoding('i2', scale_factor=0.001, add_offset=32.767)
+FLOW_ENCODING = Encoding('f4', significant_digits=4)
+DEFAULT_ENCODING = Encoding('f4')
+
+# encoding per variable, looked up by name, then by short_name and then by units of its attributes
+ENCODINGS = {
+    'water_depth': DEPTH_ENCODING,
+    'river_flow': FLOW_ENCODING,
+    'river_discharge': FLOW_ENCODING,
+    'm**3 s**-1': FLOW_ENCODING,
+    'm**2 s**-1': FLOW_ENCODING,
+    'm s**-1': FLOW_ENCODING,
+}
+
+
+def get_encoding(name, attrs={}, encodings=None):
+    """
+    Selects the storage encoding of an output variable
+    :param name: string - name of variable
+    :param attrs: dict - attributes of variable (short_name and units are used)
+    :param encodings: dict - encodings overriding ENCODINGS, with the same keys. Use Encoding('f8') to store a
+        variable unchanged
+    :return: Encoding - encoding of the variable (DEFAULT_ENCODING if no key matches)
+    """
+    policy = dict(ENCODINGS, **(encodings or {}))
+    for key in [name, attrs.get('short_name'), attrs.get('units')]:
+        if key is not None and key in policy:
+            return policy[key]
+    return DEFAULT_ENCODING
+
+
+def output_encodings(ds, encodings=None):
+    """
+    Storage encodings of all variables of a dataset (e.g. from merge_outputs), to be passed to to_netcdf, so that
+    only the written file is quantised and compressed:
+        ds.to_netcdf(fn, encoding=output_encodings(ds))
+    :param ds: Dataset - output fields
+    :param encodings: dict - encodings overriding ENCODINGS, by variable name, short_name or units
+    :return: dict - xarray encoding per variable
+    """
+    return {name: get_encoding(name, da.attrs, encodings).xarray() for name, da in ds.data_vars.items()}
@@ -0,0 +1,211 @@
+# parallel runner for wflow_sbm ensembles (e.g. Monte Carlo parameter sweeps), replacing batch files that run
+# one member after another
+import os
+import sys
+import json
+import time
+import hashlib
+import itertools
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from . import staticmaps
+
+# wflow_sbm -P statements applied for each parameter multiplier, as used in the Monte Carlo notebook
+PARAMETER_STATEMENTS = {
+    'KsatVer': ['KsatVer = KsatVer * {:g}'],
+    'RootingDepth': ['self.RootingDepth = self.RootingDepth * {:g}'],
+    'SoilThickness': ['self.SoilThickness = self.SoilThickness * {:g}',
+                      'self.SoilWaterCapacity = self.SoilWaterCapacity * {:g}'],
+}
+# file in each run folder with the hash and parameter values of the member that ran in it
+MEMBER_FILE = 'ensemble_member.json'
+
+
+def parameter_grid(**kwargs):
+    """
+    Makes a parameter table with all combinations of parameter values
+    :param kwargs: lists of values per parameter, e.g. KsatVer=range(1, 5), RootingDepth=np.arange(1, 5)
+    :return: DataFrame - one row per ensemble member, one column per parameter
+    """
+    names = list(kwargs.keys())
+    return pd.DataFrame(list(itertools.product(*kwargs.values())), columns=names)
+
+
+class EnsembleRunner(object):
+    """
+    Runs an ensemble of wflow_sbm members in parallel. Each member is a separate wflow_sbm process, and as many
+    members as there are cores run at the same time. Each member writes to its own run folder in the case folder.
+    The status of all members is kept in a json file in the case folder, keyed by a hash of the parameter values of
+    each member, so that an interrupted ensemble can be resumed, skipping members that already finished, also after
+    the parameter table was edited or reordered. Run folders follow the parameter values as well: a member keeps
+    the folder it ran in, a new member gets the folder of its row number if that is not used by another member and
+    the next free number otherwise, and the hash is stored in each folder (ensemble_member.json), so that a folder
+    is never overwritten by other parameter values. At the end a summary table is written.
+
+    Usage:
+        parameters = parameter_grid(KsatVer=range(1, 5), RootingDepth=range(1, 5), SoilThickness=range(1, 5))
+        runner = EnsembleRunner('../wflow', parameters, extra_statements=['self.M = self.M * 1000'],
+                                store=staticmaps.build_store('../wflow').fn_store)
+        summary = runner.run()
+    """
+    def __init__(self, case_dir, parameters, statements=PARAMETER_STATEMENTS, extra_statements=[], ini_file=None,
+                 run_template='all_outputs_{:03d}', processes=None, python=sys.executable, store=None):
+        """
+        :param case_dir: string - wflow case folder (-C)
+        :param parameters: DataFrame - parameter table, one row per member and one column per parameter multiplier
+        :param statements: dict - per parameter name a list of -P statement templates, formatted with the value
+        :param extra_statements: list - -P statements applied to all members
+        :param ini_file: string - wflow ini file (-c), by default the one of the case is used
+        :param run_template: string - template for the run folder (-R) of each member, formatted with a run number
+        :param processes: int - number of members to run at the same time (default: number of cores)
+        :param python: string - python executable used to run wflow_sbm
+        :param store: string - path to a static maps store (see staticmaps.build_store), shared by all members
+        """
+        self.case_dir = os.path.abspath(case_dir)
+        self.parameters = pd.DataFrame(parameters).reset_index(drop=True)
+        self.statements = statements
+        self.extra_statements = list(extra_statements)
+        self.ini_file = ini_file
+        self.run_template = run_template
+        self.processes = os.cpu_count() if processes is None else processes
+        self.python = python
+        self.store = store
+        self.status_file = os.path.join(self.case_dir, 'ensemble_status.json')
+        self.summary_file = os.path.join(self.case_dir, 'ensemble_summary.csv')
+        self._lock = threading.Lock()
+        self._run_ids = {}
+        if os.path.isfile(self.status_file):
+            with open(self.status_file, 'r') as f:
+                self.status = json.load(f)
+        else:
+            self.status = {}
+
+    def command(self, n):
+        """
+        :param n: int - member number (0-based row of the parameter table)
+        :return: list - command line arguments to run the member
+        """
+        if self.store is None:
+            cmd = [self.python, '-m', 'wflow.wflow_sbm', '-f']
+        else:
+            # read static maps from the memory-mapped store instead of parsing them in every member
+            cmd = [self.python, os.path.abspath(staticmaps.__file__), 'run', os.path.abspath(self.store), '-f']
+        for name, value in self.parameters.iloc[n].items():
+            for statement in self.statements[name]:
+                cmd += ['-P', statement.format(value)]
+        for statement in self.extra_statements:
+            cmd += ['-P', statement]
+        cmd += ['-C', self.case_dir, '-R', self.run_id(n)]
+        if self.ini_file is not None:
+            cmd += ['-c', self.ini_file]
+        return cmd
+
+    def member_parameters(self, n):
+        """
+        :param n: int - member number (0-based row of the parameter table)
+        :return: dict - parameter values of the member
+        """
+        return {name: value.item() if hasattr(value, 'item') else value
+                for name, value in self.parameters.iloc[n].items()}
+
+    def key(self, n):
+        """
+        :param n: int - member number (0-based row of the parameter table)
+        :return: string - hash of the parameter values of the member and the statements applied to all members
+        """
+        content = {'parameters': self.member_parameters(n), 'extra_statements': self.extra_statements}
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _folder_key(self, run_id):
+        # key of the member that ran in a run folder, None if no member did
+        fn = os.path.join(self.case_dir, run_id, MEMBER_FILE)
+        if not os.path.isfile(fn):
+            return None
+        with open(fn, 'r') as f:
+            return json.load(f).get('key')
+
+    def run_id(self, n):
+        """
+        :param n: int - member number (0-based row of the parameter table)
+        :return: string - run folder (-R) of the member, the folder it ran in before, or else the folder of its row
+            number or the next free one
+        """
+        key = self.key(n)
+        if key in self.status:
+            return self.status[key]['run_id']
+        if n not in self._run_ids:
+            used = set(entry['run_id'] for k, entry in self.status.items() if k != key)
+            used |= set(run_id for m, run_id in self._run_ids.items() if m != n)
+            candidates = itertools.chain([n + 1], itertools.count(len(self.parameters) + 1))
+            for number in candidates:
+                run_id = self.run_template.format(number)
+                if run_id not in used and self._folder_key(run_id) in [None, key]:
+                    break
+            self._run_ids[n] = run_id
+        return self._run_ids[n]
+
+    def _run_member(self, n):
+        run_id = self.run_id(n)
+        run_dir = os.path.join(self.case_dir, run_id)
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir)
+        if self._folder_key(run_id) not in [None, self.key(n)]:
+            raise ValueError('Run folder {:s} holds a member with other parameter values'.format(run_dir))
+        with open(os.path.join(run_dir, MEMBER_FILE), 'w') as f:
+            json.dump({'key': self.key(n), 'parameters': self.member_parameters(n)}, f, indent=2)
+        self._update_status(n, {'run_id': run_id, 'parameters': self.member_parameters(n), 'status': 'running'})
+        t0 = time.time()
+        with open(os.path.join(run_dir, 'ensemble_member.log'), 'w') as log:
+            returncode = subprocess.call(self.command(n), stdout=log, stderr=subprocess.STDOUT, cwd=self.case_dir)
+        return {'run_id': run_id,
+                'parameters': self.member_parameters(n),
+                'status': 'done' if returncode == 0 else 'failed',
+                'returncode': returncode,
+                'seconds': time.time() - t0
+                }
+
+    def _update_status(self, n, result):
+        with self._lock:
+            self.status[self.key(n)] = result
+            # write to a temporary file first, so that an interrupt never leaves a broken status file
+            with open(self.status_file + '.tmp', 'w') as f:
+                json.dump(self.status, f, indent=2)
+            os.replace(self.status_file + '.tmp', self.status_file)
+
+    def pending(self):
+        """
+        :return: list - member numbers that did not finish successfully yet
+        """
+        return [n for n in range(len(self.parameters)) if self.status.get(self.key(n), {}).get('status') != 'done']
+
+    def run(self):
+        """
+        Runs all pending members in parallel and writes the summary table
+        :return: DataFrame - summary with parameters, status and run time per member
+        """
+        members = self.pending()
+        # run folders are assigned before members run in parallel
+        for n in members:
+            self.run_id(n)
+        # members are separate processes, so threads suffice to keep the pool of processes busy
+        with ThreadPoolExecutor(max_workers=self.processes) as pool:
+            futures = {pool.submit(self._run_member, n): n for n in members}
+            for future in as_completed(futures):
+                n = futures[future]
+                self._update_status(n, future.result())
+                print('Member {:d} of {:d} {:s}'.format(n + 1, len(self.parameters),
+                                                        self.status[self.key(n)]['status']))
+        return self.summary()
+
+    def summary(self):
+        """
+        Collects the status of all members in a table and writes it to ensemble_summary.csv in the case folder
+        :return: DataFrame - summary with parameters, status and run time per member
+        """
+        status = pd.DataFrame([self.status.get(self.key(n), {'run_id': self.run_id(n), 'status': 'pending'})
+                               for n in range(len(self.parameters))]).drop(columns='parameters', errors='ignore')
+        summary = pd.concat([self.parameters, status], axis=1)
+        summary.to_csv(self.summary_file, index_label='member')
+        return summary
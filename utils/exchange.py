@@ -0,0 +1,231 @@
+# compiled exchange plans between coupled models, set up once so that an exchange at every coupled time step only
+# moves the exchanged values, without looking up indices or copying whole model variables
+import numpy as np
+
+
+class PointExchange(object):
+    """
+    Point-to-point exchange from one model variable to another, e.g. wflow RiverRunoff at source points to the
+    SFINCS qsrc discharges. Index arrays, the unit multiplier and all buffers are set up once, so that push costs
+    O(points) with no allocations on the Python side. Values are written into the target variable in one of three
+    ways, chosen once from what the target library offers:
+        view - get_var returns a view on the model memory (e.g. LISFLOOD), values are put in place
+        index - the library has an indexed setter set_var_index (bmi.wrapper), only the exchanged values are passed
+        copy - get_var returns a copy, the whole variable is retrieved, changed and set (as update_runoff_bounds did)
+
+    Usage:
+        runoff_exchange = PointExchange(cbmi, idxs_wfl)     # WFL.RiverRunoff -> Sfincs.qsrc at all times
+        while running:
+            cbmi.update()
+            runoff_exchange.push()
+    """
+    def __init__(self, cbmi, src_idxs, model_out='WFL', var_out='RiverRunoff', model_in='Sfincs', var_in='qsrc',
+                 dst_idxs=None, multiplier=1., broadcast=True, mode=None):
+        """
+        :param cbmi: Glofrim - initialized coupled model
+        :param src_idxs: 1D array - flat indices of the points in the source model grid
+        :param model_out: string - short name of the source model
+        :param var_out: string - source variable, retrieved with get_value_at_indices
+        :param model_in: string - short name of the target model
+        :param var_in: string - target variable
+        :param dst_idxs: 1D array - indices of the points in the target variable (default: 0, 1, ..., n - 1)
+        :param multiplier: float or 1D array - unit conversion from source to target per point
+        :param broadcast: boolean - if True, dst_idxs index the last axis of the target variable and values are
+            repeated over all leading axes (e.g. all times of qsrc), otherwise dst_idxs are flat indices
+        :param mode: string - 'view', 'index' or 'copy' (default: the cheapest one the target library offers)
+        """
+        self.src = cbmi.bmimodels[model_out]
+        self.dst = cbmi.bmimodels[model_in]._bmi
+        self.var_out = var_out
+        self.var_in = var_in
+        self.src_idxs = np.asarray(src_idxs, dtype=np.int64)
+        n = len(self.src_idxs)
+        dst_idxs = np.arange(n) if dst_idxs is None else np.asarray(dst_idxs, dtype=np.int64)
+        if len(dst_idxs) != n:
+            raise ValueError('Number of source points ({:d}) and target points ({:d}) differ'.format(n,
+                                                                                                 len(dst_idxs)))
+        target = np.asarray(self.dst.get_var(var_in))
+        self.shape = target.shape
+        if broadcast:
+            # the same values at all leading positions (e.g. times) of the target variable
+            n_rep = int(np.prod(self.shape[:-1]))
+            self.flat_idxs = (np.arange(n_rep)[:, None] * self.shape[-1] + dst_idxs[None, :]).reshape(-1)
+        else:
+            n_rep = 1
+            self.flat_idxs = dst_idxs
+        self.multiplier = np.broadcast_to(np.asarray(multiplier, dtype=np.float64), (n,)).copy()
+        self.values = np.zeros(n)
+        self._buffer = np.zeros((n_rep, n), dtype=target.dtype)
+        self._flat = self._buffer.reshape(-1)
+        self.mode = mode or self._detect_mode(target)
+
+    def _detect_mode(self, target):
+        if target.flags.writeable and np.shares_memory(target, self.dst.get_var(self.var_in)):
+            return 'view'
+        if hasattr(self.dst, 'set_var_index'):
+            return 'index'
+        return 'copy'
+
+    def push(self):
+        """
+        Moves the current values of the source points to the target points
+        :return: 1D numpy array - exchanged values at the source points after unit conversion (reused buffer)
+        """
+        np.multiply(self.src.get_value_at_indices(self.var_out, self.src_idxs), self.multiplier, out=self.values)
+        self._buffer[...] = self.values
+        if self.mode == 'view':
+            np.put(self.dst.get_var(self.var_in), self.flat_idxs, self._flat)
+        elif self.mode == 'index':
+            self.dst.set_var_index(self.var_in, self.flat_idxs, self._flat)
+        else:
+            target = np.array(self.dst.get_var(self.var_in))
+            np.put(target, self.flat_idxs, self._flat)
+            self.dst.set_var(self.var_in, target)
+        return self.values
+
+
+# keys of a GLOFRIM exchange that may differ between exchanges that are fused into one, unit multipliers are folded
+# into the scale of each source as regridding is linear
+FUSED_KEYS = ['from_vars', 'from_unit', 'to_unit', 'name', 'add']
+# keys that every GLOFRIM exchange must have to be fused
+EXCHANGE_KEYS = ['name', 'from_mod', 'from_vars', 'to_mod', 'to_vars']
+
+
+class SummedSource(object):
+    """
+    Virtual source variable: the sum of several scaled source variables (products of from_vars times a scale) of
+    one model, computed in a reused buffer
+    """
+    def __init__(self, get_value, parts):
+        """
+        :param get_value: function - get_value of the source model
+        :param parts: list - (from_vars, scale) of the summed exchanges, the scale is from_unit times the ratio of
+            to_unit to that of the fused exchange
+        """
+        self.get_value = get_value
+        self.parts = parts
+        self._sum = None
+
+    def __call__(self, *args, **kwargs):
+        for i, (from_vars, scale) in enumerate(self.parts):
+            value = self.get_value(from_vars[0], *args, **kwargs)
+            for var in from_vars[1:]:
+                value = value * self.get_value(var, *args, **kwargs)
+            if self._sum is None or self._sum.shape != np.shape(value):
+                self._sum = np.zeros(np.shape(value))
+            if i == 0:
+                np.multiply(value, scale, out=self._sum)
+            else:
+                self._sum += value * scale
+        return self._sum
+
+
+def _equal(a, b):
+    try:
+        if isinstance(a, (np.ndarray, list, tuple)) or isinstance(b, (np.ndarray, list, tuple)):
+            return bool(np.array_equal(a, b))
+        return bool(a is b or a == b)
+    except (ValueError, TypeError):
+        return False
+
+
+def _same_coupling(a, b):
+    """
+    Checks if two coupling (or regridder) objects map values in the same way. GLOFRIM may create one per exchange, so
+    objects of the same type are compared by their attributes: index arrays and weights by value, grids and models by
+    identity (a model has one grid object)
+    """
+    if _equal(a, b):
+        return True
+    if type(a) is not type(b) or not hasattr(a, '__dict__') or set(vars(a)) != set(vars(b)):
+        return False
+    return all(_equal(value, vars(b)[key]) for key, value in vars(a).items())
+
+
+def _fusable(first, item):
+    """
+    Checks if an exchange can be fused with the first exchange of a group: it only differs in its source
+    variables (of the same model) and unit multipliers, it uses the same coupling and it adds to the target, so that
+    the sum of the scaled sources gives the same result
+    """
+    if not item.get('add', False):
+        return False
+    if not _equal(item.get('to_unit', 1.), first.get('to_unit', 1.)) and first.get('to_unit', 1.) == 0:
+        return False
+    keys = (set(first) | set(item)) - set(FUSED_KEYS)
+    return all(_same_coupling(first.get(key), item.get(key)) for key in keys)
+
+
+def _add_virtual_var(model, name, source):
+    """
+    Makes a virtual variable available through get_value of a model
+    """
+    if not hasattr(model, '_virtual_vars'):
+        model._virtual_vars = {}
+        get_value = model.get_value
+
+        def get_value_virtual(var, *args, **kwargs):
+            if var in model._virtual_vars:
+                return model._virtual_vars[var](*args, **kwargs)
+            return get_value(var, *args, **kwargs)
+        model.get_value = get_value_virtual
+        model._get_value_original = get_value
+    model._virtual_vars[name] = source
+
+
+def fuse_grid_exchanges(cbmi):
+    """
+    Fuses consecutive exchanges of a coupled model that take different variables from the same source model and add
+    them to the same target variable, e.g. WFL.InwaterMM, WFL.ssf_toriver and WFL.InwaterL into LFP.H. The scaled
+    sources (from_unit and to_unit relative to that of the first exchange) are summed on the source grid in a
+    virtual variable, so that the fused exchange is regridded and set once, and the water balance shows one
+    combined volume in the units of the first exchange. Only the first exchange of a group may overwrite the
+    target; exchanges in between model updates are never fused. Call after initialize_model and after changing the
+    add flags of the exchanges.
+    Fusing is optional (fuse_exchanges in experiment files, off by default): it relies on the layout of the GLOFRIM
+    exchanges (dicts with EXCHANGE_KEYS, source values taken with get_value of the source model), which is checked
+    before anything is changed. Check that fused and unfused runs give the same water balance for a new GLOFRIM
+    version.
+    :param cbmi: Glofrim - initialized coupled model
+    :return: list - names of the fused exchanges
+    """
+    for item in cbmi.exchanges:
+        if item[0] == 'exchange':
+            missing = [key for key in EXCHANGE_KEYS if not isinstance(item[1], dict) or key not in item[1]]
+            if len(missing) > 0:
+                raise ValueError('Exchange {} does not have the layout that fuse_grid_exchanges expects, it misses '
+                                 '{:s}'.format(item[1], ', '.join(missing)))
+    # consecutive exchanges that can be fused are grouped
+    exchanges = []
+    for item in cbmi.exchanges:
+        if item[0] == 'exchange':
+            if len(exchanges) > 0 and exchanges[-1][0] == 'exchange' and _fusable(exchanges[-1][1][0], item[1]):
+                exchanges[-1][1].append(item[1])
+            else:
+                exchanges.append(('exchange', [item[1]]))
+        else:
+            exchanges.append(item)
+    fused = []
+    cbmi.exchanges = []
+    for item in exchanges:
+        if item[0] != 'exchange':
+            cbmi.exchanges.append(item)
+            continue
+        items = item[1]
+        if len(items) == 1:
+            cbmi.exchanges.append(('exchange', items[0]))
+            continue
+        to_unit = items[0].get('to_unit', 1.)
+        parts = [(list(x['from_vars']), x.get('from_unit', 1.) * x.get('to_unit', 1.) / to_unit) for x in items]
+        var = 'fused:' + '+'.join('*'.join(from_vars) for from_vars, _ in parts)
+        model = cbmi.bmimodels[items[0]['from_mod']]
+        _add_virtual_var(model, var, SummedSource(getattr(model, '_get_value_original', model.get_value), parts))
+        exchange = dict(items[0], from_vars=[var], from_unit=1., name=' + '.join(x['name'] for x in items))
+        cbmi.exchanges.append(('exchange', exchange))
+        fused.append(exchange['name'])
+        # one water balance column for the fused exchange, in the place of the first one
+        if hasattr(cbmi, '_wb_header'):
+            names = [x['name'] for x in items]
+            cbmi._wb_header = [exchange['name'] if c == names[0] else c for c in cbmi._wb_header
+                               if c not in names[1:]]
+    return fused
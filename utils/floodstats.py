@@ -0,0 +1,219 @@
+# flood statistics accumulated while a coupled run is going, so that flood-regime maps (maximum depth, duration,
+# timing) of multi-year runs do not need the full time series of flood depth fields to be stored and reloaded
+import os
+from datetime import datetime
+import numpy as np
+from .encoding import Encoding
+from .output import OutputWriter
+from .checkpoint import TIME_FORMAT
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UNITS = 'days since 1970-01-01 00:00:00'
+
+# statistics per period with attributes, first_wet and last_wet are stored as CF times (decoded by xarray)
+STATISTICS = {
+    'max_depth': {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Maximum flood depth'},
+    'mean_depth': {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Mean flood depth'},
+    'duration': {'units': 'days', 'long_name': 'Duration of inundation above threshold'},
+    'first_wet': {'units': EPOCH_UNITS, 'long_name': 'Time of first inundation above threshold'},
+    'last_wet': {'units': EPOCH_UNITS, 'long_name': 'Time of last inundation above threshold'},
+}
+TIME_ENCODINGS = {'first_wet': Encoding('f8'), 'last_wet': Encoding('f8')}
+
+
+def _period(t, reset):
+    # start of the period that t falls in
+    if reset == 'monthly':
+        return t.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if reset == 'yearly':
+        return t.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    return None
+
+
+class FloodStatistics(object):
+    """
+    Streaming per-cell flood statistics: maximum depth, mean depth, duration above a depth threshold and the times
+    of first and last inundation above the threshold. Flood depth fields are added as they are computed, either in
+    the coupled loop (once per coupled time step) or from update_lfp at every infiltration event (sub-daily, see
+    attach). Each field counts for the time since the previous one. The statistics are kept in a few 2D arrays and
+    written to a NetCDF file (through an OutputWriter) at the end of every period (reset monthly or yearly) or of
+    the run, with the start of the period as time. The state of the running period is stored next to the file
+    when the writers are flushed for a checkpoint, so that a resumed run continues the statistics.
+
+    Usage:
+        stats = FloodStatistics(fn_stats, x, y, threshold=0.1, reset='monthly', mask=mask)
+        stats.attach(cbmi.bmimodels['LFP'])     # fed by update_lfp, or:
+        while running:
+            cbmi.update()
+            stats.add(cbmi.get_current_time(), flood_depth)
+        stats.close()
+    """
+    def __init__(self, fn, x, y, threshold=0.1, reset=None, mask=None, t_start=None, position=None):
+        """
+        :param fn: string - path to NetCDF file to write (overwritten if it exists, unless position is set)
+        :param x: 1D numpy array - x-coordinates
+        :param y: 1D numpy array - y-coordinates
+        :param threshold: float - flood depth (m) above which a cell counts as inundated
+        :param reset: string - 'monthly' or 'yearly' to write and reset the statistics per period, None for one
+            period over the whole run
+        :param mask: 2D numpy array (bool) - if set, statistics are only computed and stored for these cells
+        :param t_start: datetime - start time, the first field counts from here (default: from the first field)
+        :param position: int - if set, the existing file is reopened and the statistics of the running period are
+            restored from the state stored at the checkpoint
+        """
+        if reset not in [None, 'monthly', 'yearly']:
+            raise ValueError('reset must be None, monthly or yearly')
+        self.fn = fn
+        self.fn_state = os.path.splitext(fn)[0] + '_state.npz'
+        self.threshold = threshold
+        self.reset = reset
+        self.shape = (len(y), len(x))
+        self.index = None if mask is None else np.flatnonzero(mask)
+        self.window = None
+        self.offset = None
+        self.writer = OutputWriter(fn, x, y, list(STATISTICS), list(STATISTICS.values()), mask=mask,
+                                   position=position, encodings=TIME_ENCODINGS)
+        self.nc = self.writer.nc
+        n = self.shape[0] * self.shape[1] if self.index is None else len(self.index)
+        self.max_depth = np.zeros(n)
+        self.sum_depth = np.zeros(n)
+        self.duration = np.zeros(n)
+        self.first_wet = np.full(n, np.nan)
+        self.last_wet = np.full(n, np.nan)
+        self.seconds = 0.
+        self.t = t_start
+        self.period = None if t_start is None else _period(t_start, reset) or t_start
+        if position is not None:
+            self._load_state()
+
+    @property
+    def n(self):
+        """
+        :return: int - number of periods written, the position to resume at
+        """
+        return self.writer.n
+
+    def attach(self, model, window=None):
+        """
+        Feeds the statistics from update_lfp at every infiltration event, with the flood depth H + SGCz - DEM
+        :param model: GLOFRIM LISFLOOD model - initialized model that is updated with update_lfp
+        :param window: tuple - rows and cols (slices) of the statistics grid in the model grid (default: all)
+        """
+        self.window = window
+        z = np.asarray(model._bmi.get_var('SGCz'), dtype=np.float64)
+        dem = np.asarray(model._bmi.get_var('DEM'), dtype=np.float64)
+        if window is not None:
+            z, dem = z[window], dem[window]
+        # channel depth below terrain, water depth above it is flood depth
+        self.offset = dem - z
+        model.flood_stats = self
+
+    def add(self, t, depth):
+        """
+        Adds a flood depth field, which counts for the time since the previous field (or the start time)
+        :param t: datetime - time of the field
+        :param depth: 2D numpy array - flood depth, or water depth (H) if attached to a LISFLOOD model
+        """
+        if self.t is None:
+            self.t = t
+            self.period = _period(t, self.reset) or t
+            return
+        if t <= self.t:
+            return
+        if self.reset is not None:
+            # the field is assigned to the period of the middle of its interval
+            period = _period(self.t + (t - self.t) / 2, self.reset)
+            if period != self.period:
+                self._write()
+                self.period = period
+        dt = (t - self.t).total_seconds()
+        depth = np.asarray(depth)
+        if self.window is not None:
+            depth = depth[self.window]
+        if self.offset is not None:
+            depth = depth - self.offset
+        depth = depth.reshape(-1) if self.index is None else depth.reshape(-1)[self.index]
+        depth = np.maximum(depth, 0)
+        np.fmax(self.max_depth, depth, out=self.max_depth)
+        self.sum_depth += depth * dt
+        wet = depth > self.threshold
+        self.duration[wet] += dt
+        days = (t - EPOCH).total_seconds() / 86400.
+        self.first_wet[wet & np.isnan(self.first_wet)] = days
+        self.last_wet[wet] = days
+        self.seconds += dt
+        self.t = t
+
+    def maps(self):
+        """
+        :return: dict - 2D numpy arrays of the statistics of the running period (NaN outside the mask)
+        """
+        values = {
+            'max_depth': self.max_depth,
+            'mean_depth': self.sum_depth / self.seconds if self.seconds > 0 else np.zeros_like(self.sum_depth),
+            'duration': self.duration / 86400.,
+            'first_wet': self.first_wet,
+            'last_wet': self.last_wet,
+        }
+        maps = {}
+        for name, data in values.items():
+            if self.index is None:
+                maps[name] = data.reshape(self.shape).copy()
+            else:
+                maps[name] = np.full(self.shape[0] * self.shape[1], np.nan)
+                maps[name][self.index] = data
+                maps[name] = maps[name].reshape(self.shape)
+        return maps
+
+    def _write(self):
+        # write the statistics of the running period and start a new one
+        if self.seconds > 0:
+            self.writer.append(self.period, self.maps())
+        self.max_depth[:] = 0.
+        self.sum_depth[:] = 0.
+        self.duration[:] = 0.
+        self.first_wet[:] = np.nan
+        self.last_wet[:] = np.nan
+        self.seconds = 0.
+
+    def _load_state(self):
+        if not os.path.isfile(self.fn_state):
+            # no field was added before the checkpoint, the statistics start at t_start
+            return
+        with np.load(self.fn_state) as state:
+            for name in ['max_depth', 'sum_depth', 'duration', 'first_wet', 'last_wet']:
+                getattr(self, name)[:] = state[name]
+            self.seconds = float(state['seconds'])
+            self.t = datetime.strptime(str(state['t']), TIME_FORMAT)
+            self.period = datetime.strptime(str(state['period']), TIME_FORMAT)
+
+    def flush(self):
+        """
+        Flushes the written periods to disk and stores the state of the running period, for checkpoints
+        """
+        self.writer.nc.sync()
+        if self.t is None:
+            # no field added yet, there is no running period to store
+            return
+        np.savez(self.fn_state, max_depth=self.max_depth, sum_depth=self.sum_depth, duration=self.duration,
+                 first_wet=self.first_wet, last_wet=self.last_wet, seconds=self.seconds,
+                 t=self.t.strftime(TIME_FORMAT), period=self.period.strftime(TIME_FORMAT))
+
+    def close(self, final=True):
+        """
+        Writes the statistics of the running period and closes the file
+        :param final: boolean - if False (e.g. after a failure), the running period is not written and the state of
+            the last checkpoint is kept, so that a resumed run continues the statistics from there
+        """
+        if self.writer.nc.isopen():
+            if final:
+                self._write()
+            self.writer.close()
+            if final and os.path.isfile(self.fn_state):
+                os.remove(self.fn_state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,400 @@
+# incremental output writers for coupled GLOFRIM runs. Instead of collecting all time slices in lists and
+# merging them at the end (see merge_outputs), slices are appended to file while the model is running
+import numpy as np
+import netCDF4
+import xarray as xr
+from .encoding import get_encoding
+
+
+# dimensions (rows, columns, active cells) of fields on the cell centres and on the faces between cells of a
+# staggered grid, e.g. LISFLOOD Qx on the faces in x-direction
+GRID_DIMS = {
+    None: ('y', 'x', 'cell'),
+    'x': ('y', 'x_u', 'cell_u'),
+    'y': ('y_v', 'x', 'cell_v'),
+}
+
+
+def faces(c):
+    """
+    :param c: 1D numpy array - equidistant coordinates of cell centres
+    :return: 1D numpy array - coordinates of the faces between and on both ends of the cells (one more than c)
+    """
+    c = np.asarray(c, dtype=np.float64)
+    d = c[1] - c[0] if len(c) > 1 else 1.
+    return np.append(c - 0.5 * d, c[-1] + 0.5 * d)
+
+
+def face_mask(mask, axis):
+    """
+    :param mask: 2D numpy array (bool) - active cells
+    :param axis: string - 'x' for the faces between columns, 'y' for the faces between rows
+    :return: 2D numpy array (bool) - faces of active cells, with one column (x) or row (y) more than mask
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if axis == 'x':
+        faces_mask = np.zeros((mask.shape[0], mask.shape[1] + 1), dtype=bool)
+        faces_mask[:, :-1] |= mask
+        faces_mask[:, 1:] |= mask
+    else:
+        faces_mask = np.zeros((mask.shape[0] + 1, mask.shape[1]), dtype=bool)
+        faces_mask[:-1] |= mask
+        faces_mask[1:] |= mask
+    return faces_mask
+
+
+class OutputWriter(object):
+    """
+    Writes 2D output fields of a coupled run to a NetCDF4 (HDF5) file, one time step at a time.
+    The file is opened with an unlimited time dimension at initialisation and each call to append writes
+    the slices of the current time step to disk. Memory use therefore does not grow with the length of the run,
+    and the time steps that were already written remain readable if the run crashes. Each variable is stored with
+    the encoding selected from its name and attributes (see ENCODINGS), e.g. water depths as int16 millimetres and
+    flows as float32 with 4 significant digits, shuffled and zlib compressed.
+    If a mask is provided, only the active cells are stored, as a 1D (time, cell) vector per variable, together
+    with the mask and the flat index of the active cells. Use the active accessor to get 2D fields back, e.g.
+    ds.isel(time=10).active['H'].
+    Fields that do not change during the run (e.g. SGCz and DEM) are written once as static variables, and fluxes
+    on a staggered grid are stored on the faces (x_u or y_v axis), so that derived fields (H_f, H_c, cell centred
+    Qx and Qy) do not need to be stored but can be computed when read, with the derived accessor.
+    A run resumed from a checkpoint reopens the file with the position stored in the checkpoint, and continues
+    writing at that time step.
+
+    Usage:
+        writer = OutputWriter(fn_out, x, y, ['SGCQin', 'H', 'Qx_face'], attributes, staggered={'Qx_face': 'x'},
+                              static={'SGCz': (z, z_attrs), 'DEM': (dem, dem_attrs)})
+        while running:
+            writer.append(cbmi.get_current_time(), [q, h, qx])
+        writer.close()
+    """
+    def __init__(self, fn, x, y, names, attributes, time_units='seconds since 1970-01-01 00:00:00',
+                 calendar='standard', complevel=4, mask=None, position=None, encodings=None, static=None,
+                 staggered=None):
+        """
+        :param fn: string - path to NetCDF file to write (overwritten if it exists, unless position is set)
+        :param x: 1D numpy array - x-coordinates
+        :param y: 1D numpy array - y-coordinates
+        :param names: list - containing strings with names of variables to write
+        :param attributes: list - containing attributes dictionaries belonging to names
+        :param time_units: string - CF-compliant units used to encode the time axis
+        :param calendar: string - CF-compliant calendar used to encode the time axis
+        :param complevel: int - zlib compression level (1-9)
+        :param mask: 2D numpy array (bool) - if set, only cells where mask is True are stored
+        :param position: int - if set, the existing file is reopened and writing continues at this time step
+        :param encodings: dict - encodings overriding ENCODINGS, by variable name, short_name or units
+        :param static: dict - 2D numpy arrays and attributes dictionaries (tuples) of static fields by name, written
+            once
+        :param staggered: dict - axis ('x' or 'y') of variables on the faces between cells by name. Their slices
+            have one column (x) or row (y) more than the grid, larger slices (e.g. LISFLOOD Qx, Qy) are cropped
+        """
+        self.fn = fn
+        self.names = list(names)
+        self.encodings = [get_encoding(name, attrs, encodings) for name, attrs in zip(self.names, attributes)]
+        self.staggered = dict(staggered or {})
+        self.shapes = {None: (len(y), len(x)), 'x': (len(y), len(x) + 1), 'y': (len(y) + 1, len(x))}
+        self.time_units = time_units
+        self.calendar = calendar
+        if position is not None:
+            self.n = position
+            self.nc = netCDF4.Dataset(fn, 'a')
+            self.indices = {axis: np.asarray(self.nc[dims[2]][:]) for axis, dims in GRID_DIMS.items()
+                            if dims[2] in self.nc.variables}
+            self.index = self.indices.get(None)
+            return
+        self.n = 0
+        self.nc = netCDF4.Dataset(fn, 'w', format='NETCDF4')
+        self.nc.createDimension('time', None)
+        self.nc.createDimension('y', len(y))
+        self.nc.createDimension('x', len(x))
+        v = self.nc.createVariable('time', 'f8', ('time',))
+        v.units = time_units
+        v.calendar = calendar
+        v = self.nc.createVariable('y', 'f8', ('y',))
+        v[:] = np.array(y)
+        v = self.nc.createVariable('x', 'f8', ('x',))
+        v[:] = np.array(x)
+        axes = set(self.staggered.get(name) for name in self.names) - {None}
+        for axis, name, coords in [('x', 'x_u', x), ('y', 'y_v', y)]:
+            if axis in axes:
+                self.nc.createDimension(name, len(coords) + 1)
+                v = self.nc.createVariable(name, 'f8', (name,))
+                v.long_name = '{:s}-coordinate of cell faces'.format(axis)
+                v[:] = faces(coords)
+        self.indices = {}
+        if mask is not None:
+            v = self.nc.createVariable('mask', 'i1', ('y', 'x'), zlib=True)
+            v[:] = np.array(mask, dtype=np.int8)
+            for axis in [None] + sorted(axes):
+                cell = GRID_DIMS[axis][2]
+                self.indices[axis] = np.flatnonzero(mask if axis is None else face_mask(mask, axis))
+                self.nc.createDimension(cell, len(self.indices[axis]))
+                v = self.nc.createVariable(cell, 'i8', (cell,), zlib=True)
+                v.long_name = 'flat index of active {:s} in ({:s}, {:s}) grid'.format(
+                    'cell' if axis is None else 'face', *GRID_DIMS[axis][:2])
+                v[:] = self.indices[axis]
+        self.index = self.indices.get(None)
+        for name, (data, attrs) in (static or {}).items():
+            encoding = get_encoding(name, attrs, encodings)
+            v = self.nc.createVariable(name, dimensions=self._dims(None), **encoding.netcdf(complevel))
+            v.setncatts(dict(attrs, **encoding.attributes()))
+            v[:] = encoding.encode(self._select(None, data))
+        for name, attrs, encoding in zip(self.names, attributes, self.encodings):
+            axis = self.staggered.get(name)
+            dims = ('time',) + self._dims(axis)
+            v = self.nc.createVariable(name,
+                                       dimensions=dims,
+                                       chunksizes=(1,) + tuple(max(len(self.nc.dimensions[d]), 1) for d in dims[1:]),
+                                       **encoding.netcdf(complevel)
+                                       )
+            v.setncatts(dict(attrs, **encoding.attributes()))
+        self.nc.sync()
+
+    def _dims(self, axis):
+        rows, cols, cell = GRID_DIMS[axis]
+        return (rows, cols) if self.index is None else (cell,)
+
+    def _select(self, axis, data):
+        # crops a slice to the (staggered) grid and selects the active cells
+        rows, cols = self.shapes[axis]
+        data = np.asarray(data)[:rows, :cols]
+        if self.index is not None:
+            data = data.reshape(-1)[self.indices[axis]]
+        return data
+
+    def append(self, time, datas):
+        """
+        Appends one time step to the file and flushes it to disk
+        :param time: datetime - time of the slices as retrieved from bmi model
+        :param datas: list - 2D numpy slices in the same order as names, or dict with names as keys
+        """
+        if isinstance(datas, dict):
+            datas = [datas[name] for name in self.names]
+        self.nc['time'][self.n] = netCDF4.date2num(time, self.time_units, calendar=self.calendar)
+        for name, data, encoding in zip(self.names, datas, self.encodings):
+            self.nc[name][self.n] = encoding.encode(self._select(self.staggered.get(name), data))
+        self.n += 1
+        self.nc.sync()
+
+    def close(self):
+        """
+        Closes the file
+        """
+        if self.nc.isopen():
+            self.nc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@xr.register_dataset_accessor('active')
+class ActiveCellAccessor(object):
+    """
+    Accessor to get 2D (y, x) fields from datasets stored with only active cells (see OutputWriter). Fields are
+    only scattered back to the grid when requested, so select the time steps of interest first, e.g.
+        ds = xr.open_dataset(fn_out)
+        h = ds.isel(time=slice(0, 10)).active['H']
+    Datasets with full 2D fields are returned unchanged, so that analysis code works for both storage modes.
+    """
+    def __init__(self, ds):
+        self._ds = ds
+
+    @property
+    def compact(self):
+        """
+        :return: boolean - True if the dataset only contains active cells
+        """
+        return 'cell' in self._ds.dims
+
+    def __getitem__(self, name):
+        """
+        :param name: string - name of variable
+        :return: DataArray - variable with (y, x) dimensions instead of cell (or the face dimensions instead of
+            cell_u and cell_v), NaN outside the active cells
+        """
+        da = self._ds[name]
+        grids = [dims for dims in GRID_DIMS.values() if dims[2] in da.dims]
+        if not self.compact or len(grids) == 0:
+            return da
+        rows, cols, cell = grids[0]
+        shape = (len(self._ds[rows]), len(self._ds[cols]))
+        other_dims = [d for d in da.dims if d != cell]
+        da = da.transpose(*other_dims, cell)
+        # times (e.g. of first inundation) are filled with NaT, other variables with NaN
+        if da.dtype.kind == 'M':
+            data = np.full(da.shape[:-1] + (shape[0] * shape[1],), np.datetime64('NaT'), dtype=da.dtype)
+        else:
+            data = np.full(da.shape[:-1] + (shape[0] * shape[1],), np.nan)
+        data[..., self._ds[cell].values] = da.values
+        return xr.DataArray(data.reshape(da.shape[:-1] + shape),
+                            name=name,
+                            dims=tuple(other_dims) + (rows, cols),
+                            coords=dict({d: da[d] for d in other_dims if d in da.coords},
+                                        **{rows: self._ds[rows], cols: self._ds[cols]}
+                                        ),
+                            attrs=da.attrs
+                            )
+
+
+def _flood_depth(get, ds):
+    # flood depth above terrain, from LISFLOOD depth and channel bed or from SFINCS water level and bed level
+    if 'SGCz' in ds.variables:
+        return np.maximum(get('H') + get('SGCz') - get('DEM'), 0)
+    return np.maximum(get('H') - get('zb'), 0)
+
+
+def _channel_depth(get, ds):
+    # channel depth below terrain, only in channels
+    return np.minimum(get('DEM') - get('SGCz'), get('H'))
+
+
+def _active(da, ds):
+    # NaN outside the active cells, faces of active cells are stored for both cells they separate
+    if 'mask' in ds.variables:
+        return da.where(ds['mask'] != 0)
+    return da
+
+
+def _centred_qx(get, ds):
+    # average of the faces on both sides of each cell
+    qx = get('Qx_face')
+    left = qx.isel(x_u=slice(0, -1)).rename(x_u='x').assign_coords(x=ds['x'])
+    right = qx.isel(x_u=slice(1, None)).rename(x_u='x').assign_coords(x=ds['x'])
+    return _active(0.5 * left + 0.5 * right, ds)
+
+
+def _centred_qy(get, ds):
+    # reverse flow so that positive is northward, and negative is southward
+    qy = get('Qy_face')
+    top = qy.isel(y_v=slice(0, -1)).rename(y_v='y').assign_coords(y=ds['y'])
+    bottom = qy.isel(y_v=slice(1, None)).rename(y_v='y').assign_coords(y=ds['y'])
+    return _active(-0.5 * top - 0.5 * bottom, ds)
+
+
+# variables derived from stored variables when read: function of (get, ds) and attributes
+DERIVED_VARIABLES = {
+    'H_f': (_flood_depth, {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Water Depth floodplain'}),
+    'H_c': (_channel_depth, {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Water Depth channel'}),
+    'Qx': (_centred_qx, {'units': 'm**3 s**-1', 'long_name': 'Flow in x-direction (eastward)'}),
+    'Qy': (_centred_qy, {'units': 'm**3 s**-1', 'long_name': 'Flow in y-direction (northward)'}),
+}
+
+
+@xr.register_dataset_accessor('derived')
+class DerivedVariableAccessor(object):
+    """
+    Accessor to variables that are computed from the stored variables when requested, instead of being stored
+    (see DERIVED_VARIABLES):
+        H_f - flood depth above terrain, max(H + SGCz - DEM, 0) (LISFLOOD) or max(H - zb, 0) (SFINCS)
+        H_c - channel depth below terrain, min(DEM - SGCz, H) (LISFLOOD)
+        Qx - cell centred flow in x-direction, mean of the flows on the faces left and right (Qx_face)
+        Qy - cell centred flow in y-direction, positive northward, from the faces above and below (Qy_face)
+    Only the selected part of a dataset is read and computed, so select the time steps of interest first, e.g.
+        ds = xr.open_dataset(fn_out)
+        h_f = ds.isel(time=slice(0, 10)).derived['H_f']
+    Fields are returned in 2D (see ActiveCellAccessor). Variables that are stored are returned as they are, so that
+    analysis code works for files with and without the derived variables stored.
+    """
+    def __init__(self, ds):
+        self._ds = ds
+
+    def __getitem__(self, name):
+        """
+        :param name: string - name of (stored or derived) variable
+        :return: DataArray - 2D (y, x) variable
+        """
+        if name in self._ds.variables:
+            return self._ds.active[name]
+        if name not in DERIVED_VARIABLES:
+            raise KeyError('{:s} is not stored and cannot be derived, use one of {}'.format(
+                name, list(DERIVED_VARIABLES)))
+        func, attrs = DERIVED_VARIABLES[name]
+        da = func(lambda var: self._ds.active[var], self._ds)
+        return da.transpose('time', ..., missing_dims='ignore').rename(name).assign_attrs(attrs)
+
+
+# attributes of recorded discharge
+DISCHARGE_ATTRS = {'units': 'm**3 s**-1', 'short_name': 'river_discharge'}
+
+
+class DischargeRecorder(object):
+    """
+    Records discharge over cross sections during a coupled run, so that full x- and y-directional flow fields
+    do not need to be stored. Discharge is computed at every step with a CrossSectionOperator (same perpendicular
+    and sign logic as discharge) and appended to a NetCDF file with (time, station) dimensions.
+
+    Usage:
+        operator = CrossSectionOperator(x, y, fiona.open('../gis/cross_sections.gpkg'))
+        recorder = DischargeRecorder(fn_discharge, operator)
+        while running:
+            recorder.record(cbmi.get_current_time(), qx, qy)
+        recorder.close()
+    """
+    def __init__(self, fn, operator, name='Q', attrs=None,
+                 time_units='seconds since 1970-01-01 00:00:00', calendar='standard', position=None):
+        """
+        :param fn: string - path to NetCDF file to write (overwritten if it exists, unless position is set)
+        :param operator: CrossSectionOperator - compiled cross sections on the grid of the flow fields
+        :param name: string - name of the discharge variable
+        :param attrs: dict - attributes of the discharge variable (default: DISCHARGE_ATTRS)
+        :param time_units: string - CF-compliant units used to encode the time axis
+        :param calendar: string - CF-compliant calendar used to encode the time axis
+        :param position: int - if set, the existing file is reopened and recording continues at this time step
+        """
+        if len(operator.stations) == 0:
+            raise ValueError('No cross sections on the grid of the flow fields, there is no discharge to record')
+        attrs = dict(DISCHARGE_ATTRS if attrs is None else attrs)
+        self.fn = fn
+        self.operator = operator
+        self.name = name
+        self.time_units = time_units
+        self.calendar = calendar
+        self.encoding = get_encoding(name, attrs)
+        if position is not None:
+            self.n = position
+            self.nc = netCDF4.Dataset(fn, 'a')
+            return
+        self.n = 0
+        self.nc = netCDF4.Dataset(fn, 'w', format='NETCDF4')
+        self.nc.createDimension('time', None)
+        self.nc.createDimension('station', len(operator.stations))
+        v = self.nc.createVariable('time', 'f8', ('time',))
+        v.units = time_units
+        v.calendar = calendar
+        v = self.nc.createVariable('station', str, ('station',))
+        for i, station in enumerate(operator.stations):
+            v[i] = str(station)
+        v = self.nc.createVariable(name,
+                                   dimensions=('time', 'station'),
+                                   chunksizes=(1024, len(operator.stations)),
+                                   **self.encoding.netcdf()
+                                   )
+        v.setncatts(dict(attrs, **self.encoding.attributes()))
+        self.nc.sync()
+
+    def record(self, time, qx, qy):
+        """
+        Computes discharge over all cross sections for one time step and appends it to the file
+        :param time: datetime - time of the flow fields as retrieved from bmi model
+        :param qx: 2D numpy array - x-directional flow (cell centred, positive eastward)
+        :param qy: 2D numpy array - y-directional flow (cell centred, positive northward)
+        """
+        self.nc['time'][self.n] = netCDF4.date2num(time, self.time_units, calendar=self.calendar)
+        self.nc[self.name][self.n] = self.encoding.encode(self.operator(qx, qy))
+        self.n += 1
+        self.nc.sync()
+
+    def close(self):
+        """
+        Closes the file
+        """
+        if self.nc.isopen():
+            self.nc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,175 @@
+# multi-resolution overviews of stored output fields, built once after a run, so that zoomed-out maps, animations
+# and scrubbing over long runs read and render a few coarse levels instead of aggregating the full grids per frame
+import os
+import numpy as np
+import netCDF4
+import xarray as xr
+from .encoding import get_encoding
+from .output import GRID_DIMS
+
+# overview levels as number of cells per block in each direction
+FACTORS = (2, 4, 8)
+# variables that describe the storage and are not aggregated
+STORAGE_VARIABLES = ['mask'] + [dims[2] for dims in GRID_DIMS.values()]
+
+
+def block_mean(data, factor):
+    """
+    Averages the last two axes of an array over blocks of factor x factor cells, ignoring missing values. The
+    array is padded with missing values to a whole number of blocks.
+    :param data: numpy array - with (rows, columns) as last axes, missing values as NaN
+    :param factor: int - number of cells per block in each direction
+    :return: numpy array - block averages, NaN where a block has no values
+    """
+    data = np.asarray(data, dtype=np.float64)
+    rows, cols = data.shape[-2:]
+    ny, nx = -(-rows // factor), -(-cols // factor)
+    padded = np.full(data.shape[:-2] + (ny * factor, nx * factor), np.nan)
+    padded[..., :rows, :cols] = data
+    blocks = padded.reshape(data.shape[:-2] + (ny, factor, nx, factor))
+    valid = np.isfinite(blocks)
+    count = valid.sum(axis=(-3, -1))
+    total = np.where(valid, blocks, 0.).sum(axis=(-3, -1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def _block_coords(c, factor):
+    # centres of the blocks of equidistant coordinates, also for the padded last block
+    c = np.asarray(c, dtype=np.float64)
+    d = c[1] - c[0] if len(c) > 1 else 0.
+    n = -(-len(c) // factor)
+    return c[0] + (np.arange(n) * factor + 0.5 * (factor - 1)) * d
+
+
+def overview_path(fn):
+    """
+    :param fn: string - path to results file (NetCDF) or store (zarr)
+    :return: string - path to the overviews of the results
+    """
+    return os.path.splitext(fn.rstrip('/'))[0] + '_overviews.nc'
+
+
+def _open(fn):
+    return xr.open_zarr(fn) if fn.rstrip('/').endswith('.zarr') else xr.open_dataset(fn)
+
+
+def _spatial_variables(ds):
+    # variables on the cell grid (as last dimensions, or stored as active cells), not those on the cell faces
+    names = []
+    for name, da in ds.data_vars.items():
+        if name in STORAGE_VARIABLES:
+            continue
+        if da.dims[-1:] == ('cell',) or da.dims[-2:] in [('y', 'x'), ('lat', 'lon')]:
+            names.append(name)
+    return names
+
+
+def build_overviews(fn, factors=FACTORS, variables=None, time_block=64):
+    """
+    Builds overview levels of the spatial variables of a results file, averaged over blocks of 2 x 2, 4 x 4 and
+    8 x 8 cells (ignoring missing values), and writes them next to the results (see overview_path), one NetCDF
+    group per level (x2, x4, x8). Fields are read in blocks of time steps, so that memory use does not grow with
+    the length of the run. Results stored as active cells are scattered to the grid first, and variables that are
+    derived when read (e.g. H_f, see DerivedVariableAccessor) can be listed as well.
+    :param fn: string - path to results file (NetCDF) or store (zarr)
+    :param factors: list - block sizes of the overview levels
+    :param variables: list - names of variables (default: all stored variables on the cell grid)
+    :param time_block: int - number of time steps read at once
+    :return: string - path to the overviews
+    """
+    ds = _open(fn)
+    variables = variables or _spatial_variables(ds)
+    fn_ov = overview_path(fn)
+    nc = netCDF4.Dataset(fn_ov, 'w', format='NETCDF4')
+    nc.factors = np.array(factors, dtype=np.int32)
+    nc.source = os.path.basename(fn.rstrip('/'))
+    try:
+        groups = {}
+        for name in variables:
+            # dimensions and attributes from the first time step, fields are read per block of time steps below
+            template = ds.isel(time=slice(0, 1)).derived[name] if 'time' in ds.dims else ds.derived[name]
+            rows, cols = template.dims[-2:]
+            encoding = get_encoding(name, template.attrs)
+            for factor in factors:
+                if factor not in groups:
+                    groups[factor] = nc.createGroup('x{:d}'.format(factor))
+                group = groups[factor]
+                for dim in template.dims:
+                    if dim in group.dimensions:
+                        continue
+                    if dim == 'time':
+                        group.createDimension('time', None)
+                        v = group.createVariable('time', 'f8', ('time',))
+                        v.units = 'seconds since 1970-01-01 00:00:00'
+                        v.calendar = 'standard'
+                        v[:] = ds['time'].values.astype('datetime64[s]').astype(np.float64)
+                        continue
+                    coords = ds[dim].values
+                    if dim in [rows, cols]:
+                        coords = _block_coords(coords, factor)
+                    group.createDimension(dim, len(coords))
+                    v = group.createVariable(dim, 'f8', (dim,))
+                    v.setncatts(ds[dim].attrs)
+                    v[:] = coords
+                v = group.createVariable(name, dimensions=template.dims, **encoding.netcdf())
+                v.setncatts(dict(template.attrs, **encoding.attributes()))
+            # all levels are aggregated from each block of time steps
+            if 'time' in template.dims:
+                blocks = [slice(i, min(i + time_block, ds.sizes['time'])) for i in range(0, ds.sizes['time'],
+                                                                                          time_block)]
+            else:
+                blocks = [None]
+            for block in blocks:
+                da = ds.derived[name] if block is None else ds.isel(time=block).derived[name]
+                data = da.transpose(*template.dims).values
+                index = tuple(block if d == 'time' else slice(None) for d in template.dims)
+                for factor in factors:
+                    groups[factor][name][index] = encoding.encode(block_mean(data, factor))
+    finally:
+        nc.close()
+        ds.close()
+    return fn_ov
+
+
+def open_overview(fn, width, height=None, bbox=None):
+    """
+    Opens the coarsest level of the results that still has at least width x height cells in the view, e.g. for a
+    plot of 550 pixels wide:
+        ds = open_overview(fn_out, 550, bbox=(690000, 8200000, 760000, 8330000))
+        ds['H_f'].hvplot.quadmesh('x', 'y', rasterize=True, widget_type='scrubber')
+    The full resolution results are opened if no overview level is coarse enough (or none were built). Note that
+    those may be stored as active cells and with derived variables (use the active and derived accessors).
+    :param fn: string - path to results file (NetCDF) or store (zarr)
+    :param width: int - width of the view in pixels
+    :param height: int - height of the view in pixels (default: not used to select the level)
+    :param bbox: tuple - (xmin, ymin, xmax, ymax) of the view in the coordinates of the results (default: all)
+    :return: Dataset - results at the selected level, cropped to bbox
+    """
+    fn_ov = overview_path(fn)
+    factors = []
+    if os.path.isfile(fn_ov):
+        with netCDF4.Dataset(fn_ov) as nc:
+            factors = sorted(np.atleast_1d(nc.factors).tolist())
+    ds = _open(fn)
+    # number of full resolution cells in the view, along the last two dimensions of the grid
+    rows, cols = [d for d in ds.dims if d in ['y', 'lat']][:1], [d for d in ds.dims if d in ['x', 'lon']][:1]
+    if len(rows) == 0 or len(cols) == 0:
+        return ds
+    rows, cols = rows[0], cols[0]
+    selection = {}
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        selection = {cols: np.flatnonzero((ds[cols].values >= xmin) & (ds[cols].values <= xmax)),
+                     rows: np.flatnonzero((ds[rows].values >= ymin) & (ds[rows].values <= ymax))}
+    n_cols = len(selection[cols]) if bbox is not None else ds.sizes[cols]
+    n_rows = len(selection[rows]) if bbox is not None else ds.sizes[rows]
+    fits = [f for f in factors if n_cols / f >= width and (height is None or n_rows / f >= height)]
+    if len(fits) > 0:
+        ds.close()
+        ds = xr.open_dataset(fn_ov, group='x{:d}'.format(max(fits)))
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            selection = {cols: np.flatnonzero((ds[cols].values >= xmin) & (ds[cols].values <= xmax)),
+                         rows: np.flatnonzero((ds[rows].values >= ymin) & (ds[rows].values <= ymax))}
+    return ds.isel(selection) if bbox is not None else ds
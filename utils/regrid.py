@@ -0,0 +1,169 @@
+# regridding of fields between two fixed model grids (e.g. LISFLOOD -> wflow) with a precomputed sparse operator
+import os
+import hashlib
+import numpy as np
+import rasterio.crs
+import rasterio.warp
+import scipy.sparse
+
+
+def _shoelace(xs, ys):
+    """
+    Computes the area of quadrilaterals from their corner coordinates (ordered around the polygon)
+    :param xs: list - four 2D numpy arrays with x-coordinates of the corners
+    :param ys: list - four 2D numpy arrays with y-coordinates of the corners
+    :return: 2D numpy array with areas
+    """
+    area = np.zeros(xs[0].shape)
+    for i in range(4):
+        j = (i + 1) % 4
+        area += xs[i] * ys[j] - xs[j] * ys[i]
+    return np.abs(area) * 0.5
+
+
+def _overlaps(src_edges, dst_edges):
+    """
+    Computes the overlaps between the cells of two 1D axes
+    :param src_edges: 1D numpy array - edges of the source cells (ascending or descending)
+    :param dst_edges: 1D numpy array - edges of the target cells (ascending or descending)
+    :return: sparse matrix - (target x source) lengths of the overlaps
+    """
+    src_edges = np.asarray(src_edges, dtype=np.float64)
+    n_src = len(src_edges) - 1
+    descending = src_edges[-1] < src_edges[0]
+    edges = src_edges[::-1] if descending else src_edges
+    rows, cols, lengths = [], [], []
+    for i in range(len(dst_edges) - 1):
+        lo, hi = sorted(dst_edges[i:i + 2])
+        k = np.arange(max(np.searchsorted(edges, lo, side='right') - 1, 0),
+                      min(np.searchsorted(edges, hi, side='left'), n_src))
+        length = np.minimum(edges[k + 1], hi) - np.maximum(edges[k], lo)
+        k, length = k[length > 0], length[length > 0]
+        rows.append(np.full(len(k), i))
+        cols.append(n_src - 1 - k if descending else k)
+        lengths.append(length)
+    return scipy.sparse.coo_matrix((np.concatenate(lengths), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(len(dst_edges) - 1, n_src))
+
+
+def _same_crs(crs1, crs2):
+    if crs1 is None or crs2 is None:
+        return crs1 is None and crs2 is None
+    return rasterio.crs.CRS.from_user_input(crs1) == rasterio.crs.CRS.from_user_input(crs2)
+
+
+class Regridder(object):
+    """
+    Area weighted regridder between two fixed grids. The overlap between source and target cells is computed
+    once and stored as a sparse (target x source) matrix of overlap areas divided by the target cell areas.
+    Regridding a field is then a single sparse matrix-vector product. Overlaps are exact for north-up grids in the
+    same crs, and otherwise approximated by oversampling every source cell, each sample carrying its share of the
+    source cell area. Each part of a source cell ends up in exactly one target cell, so volumes are conserved and
+    a constant field stays constant in target cells that are fully covered by the source grid (target cells at
+    the edge of the source domain get the volume of the covered part). Source cells with nodata do not contribute
+    any volume, so the result does not contain missing values.
+
+    Usage:
+        regridder = Regridder.from_grids(lfp_grid, wfl_grid, cache_dir='../results/cache')
+        infilt_wfl = regridder(cbmi.bmimodels['LFP'].infilt, nodata=np.nan)
+    """
+    def __init__(self, src_transform, src_crs, src_shape, dst_transform, dst_crs, dst_shape, oversample=4,
+                 cache_dir=None):
+        """
+        :param src_transform: Affine - transform of the source grid
+        :param src_crs: CRS or string - coordinate reference system of the source grid
+        :param src_shape: tuple - (rows, cols) of the source grid
+        :param dst_transform: Affine - transform of the target grid
+        :param dst_crs: CRS or string - coordinate reference system of the target grid
+        :param dst_shape: tuple - (rows, cols) of the target grid
+        :param oversample: int - number of sample points per source cell in each direction used to approximate
+            overlaps between grids in different crs or rotated grids
+        :param cache_dir: string - if set, weights are stored in (and read from) this folder, keyed by the grid definitions
+        """
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+        key = 'conservative|{}|{}|{}|{}|{}|{}|{}'.format(tuple(src_transform)[:6], src_crs, self.src_shape,
+                                            tuple(dst_transform)[:6], dst_crs, self.dst_shape, oversample)
+        self.key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        fn_cache = None if cache_dir is None else os.path.join(cache_dir, 'regrid_{:s}.npz'.format(self.key))
+        if fn_cache is not None and os.path.isfile(fn_cache):
+            self.weights = scipy.sparse.load_npz(fn_cache).tocsr()
+        else:
+            self.weights = self._compute_weights(src_transform, src_crs, dst_transform, dst_crs, oversample)
+            if fn_cache is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                scipy.sparse.save_npz(fn_cache, self.weights)
+
+    @classmethod
+    def from_grids(cls, src_grid, dst_grid, **kwargs):
+        """
+        Sets up a regridder from two GLOFRIM grid definitions (with transform, crs, height and width)
+        :param src_grid: grid definition of the source model, e.g. cbmi.bmimodels['LFP'].grid
+        :param dst_grid: grid definition of the target model, e.g. cbmi.bmimodels['WFL'].grid
+        :return: Regridder
+        """
+        return cls(src_grid.transform, src_grid.crs, (src_grid.height, src_grid.width),
+                   dst_grid.transform, dst_grid.crs, (dst_grid.height, dst_grid.width), **kwargs)
+
+    def _compute_weights(self, src_transform, src_crs, dst_transform, dst_crs, oversample):
+        src_rows, src_cols = self.src_shape
+        dst_rows, dst_cols = self.dst_shape
+        north_up = all(t.b == 0 and t.d == 0 for t in [src_transform, dst_transform])
+        if north_up and _same_crs(src_crs, dst_crs):
+            # exact overlaps, the overlap of two cells is the product of the overlaps of their rows and columns
+            x_src = src_transform.c + src_transform.a * np.arange(src_cols + 1)
+            y_src = src_transform.f + src_transform.e * np.arange(src_rows + 1)
+            x_dst = dst_transform.c + dst_transform.a * np.arange(dst_cols + 1)
+            y_dst = dst_transform.f + dst_transform.e * np.arange(dst_rows + 1)
+            dst_area = abs(dst_transform.a * dst_transform.e)
+            weights = scipy.sparse.kron(_overlaps(y_src, y_dst), _overlaps(x_src, x_dst)) / dst_area
+            return scipy.sparse.csr_matrix(weights)
+        # area of source cells in source crs units, and of target cells expressed in the same units
+        src_area = abs(src_transform.a * src_transform.e - src_transform.b * src_transform.d)
+        cols, rows = np.meshgrid(np.arange(dst_cols + 1), np.arange(dst_rows + 1))
+        xs, ys = dst_transform * (cols.flatten(), rows.flatten())
+        xs, ys = rasterio.warp.transform(dst_crs, src_crs, xs, ys)
+        xs = np.array(xs).reshape(rows.shape)
+        ys = np.array(ys).reshape(rows.shape)
+        dst_area = _shoelace([xs[:-1, :-1], xs[:-1, 1:], xs[1:, 1:], xs[1:, :-1]],
+                             [ys[:-1, :-1], ys[:-1, 1:], ys[1:, 1:], ys[1:, :-1]]).flatten()
+        # sample points within each source cell, processed per block of rows to limit memory
+        offsets = (np.arange(oversample) + 0.5) / oversample
+        off_col, off_row = [o.flatten() for o in np.meshgrid(offsets, offsets)]
+        inv_dst = ~dst_transform
+        row_idx, col_idx = [], []
+        block = max(1, 1000000 // max(1, src_cols * oversample ** 2))
+        for row_start in range(0, src_rows, block):
+            r, c = np.meshgrid(np.arange(row_start, min(row_start + block, src_rows)), np.arange(src_cols),
+                               indexing='ij')
+            src_idx = np.ravel_multi_index((r.flatten(), c.flatten()), self.src_shape)
+            sample_c = (c.flatten()[:, None] + off_col[None, :]).flatten()
+            sample_r = (r.flatten()[:, None] + off_row[None, :]).flatten()
+            xs, ys = src_transform * (sample_c, sample_r)
+            xs, ys = rasterio.warp.transform(src_crs, dst_crs, xs, ys)
+            dst_c, dst_r = inv_dst * (np.array(xs), np.array(ys))
+            dst_c, dst_r = np.floor(dst_c).astype(int), np.floor(dst_r).astype(int)
+            inside = (dst_c >= 0) & (dst_c < dst_cols) & (dst_r >= 0) & (dst_r < dst_rows)
+            row_idx.append(np.ravel_multi_index((dst_r[inside], dst_c[inside]), self.dst_shape))
+            col_idx.append(np.repeat(src_idx, oversample ** 2)[inside])
+        row_idx = np.concatenate(row_idx)
+        col_idx = np.concatenate(col_idx)
+        # each sample carries its share of the source cell area, duplicates are summed by the sparse matrix
+        values = src_area / oversample ** 2 / dst_area[row_idx]
+        return scipy.sparse.coo_matrix((values, (row_idx, col_idx)),
+                                       shape=(dst_rows * dst_cols, src_rows * src_cols)).tocsr()
+
+    def __call__(self, data, nodata=np.nan):
+        """
+        Regrids a field from the source grid to the target grid
+        :param data: 2D numpy array - field on the source grid, in a unit per area (e.g. mm)
+        :param nodata: float - missing value in data, these cells do not contribute to the target field
+        :return: 2D numpy array - field on the target grid
+        """
+        values = np.asarray(data, dtype=np.float64).flatten()
+        if np.isnan(nodata):
+            values[np.isnan(values)] = 0.
+        else:
+            values[values == nodata] = 0.
+        return (self.weights @ values).reshape(self.dst_shape)
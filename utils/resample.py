@@ -0,0 +1,217 @@
+# resampling of LISFLOOD input rasters to model variants at other resolutions (as the former warp_lisflood.sh did with
+# gdalwarp, map2col and col2map), with the layers resampled in parallel worker processes and every resampled layer
+# cached by the checksum of its input and the target grid, so that rebuilding a variant only exports cached rasters
+import os
+import glob
+import json
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+import rasterio.shutil
+import rasterio.warp
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from .staticmaps import checksum
+from .inertial import read_par
+
+# raster layers of the parameter file by keyword, with their resampling method. Width is averaged over the channel
+# cells only (nodata elsewhere), as col2map did. The masked DEM (DEMfile) defines the model domain
+LAYERS = {
+    'DEMfile': 'average',
+    'SGCbank': 'average',
+    'SGCwidth': 'average',
+    'SGCbed': 'average',
+    'startfile': 'average',
+    'manningfile': 'average',
+}
+# rasters of the model folder that are not referenced in parameter files
+EXTRA_LAYERS = {'bfplain.asc': 'average'}
+# other files of the model folder that are copied unchanged
+COPY_PATTERNS = ['*.par', '*.bdy', '*.bci', '*.evap', '*.gauge']
+# output format by file extension, sources are looked up with these extensions if the referenced file is missing
+DRIVERS = {'.asc': 'AAIGrid', '.tif': 'GTiff', '.map': 'PCRaster'}
+NODATA = -9999.
+
+
+def target_grid(resolution, bounds):
+    """
+    :param resolution: float - cell size of the target grid
+    :param bounds: tuple - (xmin, ymin, xmax, ymax) of the target grid, extended to whole cells to the east and
+        south if needed
+    :return: tuple - Affine transform and (rows, cols) of the target grid
+    """
+    xmin, ymin, xmax, ymax = bounds
+    cols = int(np.ceil((xmax - xmin) / resolution - 1e-6))
+    rows = int(np.ceil((ymax - ymin) / resolution - 1e-6))
+    return from_origin(xmin, ymax, resolution, resolution), (rows, cols)
+
+
+def _find_source(model_dir, name):
+    # the referenced raster, or one with the same name and another raster extension (e.g. a GeoTIFF of an .asc)
+    base = os.path.splitext(name)[0]
+    for fn in [name] + [base + ext for ext in DRIVERS]:
+        if os.path.isfile(os.path.join(model_dir, fn)):
+            return os.path.join(model_dir, fn)
+    raise IOError('Raster {:s} (or {:s}) not found in {:s}'.format(name, '/'.join(DRIVERS), model_dir))
+
+
+def _resample(fn_src, fn_cache, transform, shape, crs, resampling):
+    # runs in a worker process: resamples one layer to the target grid and writes it as binary GeoTIFF
+    with rasterio.open(fn_src) as src:
+        nodata = NODATA if src.nodata is None else src.nodata
+        dst_crs = crs or src.crs
+        # grids without crs (ASCII grids) are in the crs of the target grid, or both in an arbitrary projected crs
+        src_crs = src.crs or crs or 'EPSG:3857'
+        data = np.full(shape, nodata, dtype=np.float32)
+        rasterio.warp.reproject(rasterio.band(src, 1), data, src_transform=src.transform, src_crs=src_crs,
+                                src_nodata=nodata, dst_transform=transform, dst_crs=dst_crs or src_crs,
+                                dst_nodata=nodata, resampling=Resampling[resampling])
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'height': shape[0], 'width': shape[1],
+               'transform': transform, 'crs': dst_crs, 'nodata': nodata, 'compress': 'deflate', 'tiled': True}
+    # written under a temporary name, so that an interrupted worker does not leave an invalid cache entry
+    with rasterio.open(fn_cache + '.tmp', 'w', **profile) as dst:
+        dst.write(data, 1)
+    os.replace(fn_cache + '.tmp', fn_cache)
+    return fn_cache
+
+
+def _export(fn_cache, fn_out):
+    # runs in a worker process: writes a cached layer in the format of the output extension
+    driver = DRIVERS.get(os.path.splitext(fn_out)[1].lower(), 'GTiff')
+    if driver == 'GTiff':
+        shutil.copyfile(fn_cache, fn_out)
+    else:
+        # without .aux.xml side files
+        with rasterio.Env(GDAL_PAM_ENABLED='NO'):
+            rasterio.shutil.copy(fn_cache, fn_out, driver=driver)
+    return fn_out
+
+
+class ResampleCache(object):
+    """
+    Folder with resampled layers (binary GeoTIFFs), keyed by a hash of the checksum of the input raster, the target
+    grid and the resampling method. Checksums of input files are remembered by size and modification time, so that
+    unchanged (large) inputs are not read again for every variant.
+    """
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: string - folder with resampled layers
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._checksums_fn = os.path.join(self.cache_dir, 'checksums.json')
+        self._checksums = {}
+        if os.path.isfile(self._checksums_fn):
+            with open(self._checksums_fn, 'r') as f:
+                self._checksums = json.load(f)
+
+    def _checksum(self, fn):
+        fn = os.path.abspath(fn)
+        stat = os.stat(fn)
+        entry = self._checksums.get(fn)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': checksum(fn)}
+            self._checksums[fn] = entry
+        return entry['sha1']
+
+    def path(self, fn_src, transform, shape, crs, resampling):
+        """
+        :param fn_src: string - path to input raster
+        :param transform: Affine - transform of the target grid
+        :param shape: tuple - (rows, cols) of the target grid
+        :param crs: CRS or string - crs of the target grid (None for that of the input)
+        :param resampling: string - resampling method (name of rasterio Resampling)
+        :return: string - path to the cached layer (which may not exist yet)
+        """
+        content = {'input': self._checksum(fn_src), 'transform': list(transform)[:6], 'shape': list(shape),
+                   'crs': None if crs is None else str(crs), 'resampling': resampling}
+        key = hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'layer_{:s}.tif'.format(key))
+
+    def save(self):
+        """
+        Stores the remembered checksums of input files
+        """
+        with open(self._checksums_fn + '.tmp', 'w') as f:
+            json.dump(self._checksums, f, indent=1)
+        os.replace(self._checksums_fn + '.tmp', self._checksums_fn)
+
+
+def resample_lisflood(model_dir, out_dir, resolution, bounds=None, crs=None, cache_dir=None, workers=4,
+                      layers=LAYERS, extra=EXTRA_LAYERS, copy_patterns=COPY_PATTERNS):
+    """
+    Builds LISFLOOD model variants at other resolutions from a model folder: the raster layers referenced in its
+    parameter files (see LAYERS) and the extra rasters are resampled to the target grid in parallel worker
+    processes and written under their own names, in the format of their extension, and the other model files
+    (parameter, boundary and evaporation files) are copied. Resampled layers are cached as binary GeoTIFFs, so that
+    a rerun (or another variant on the same grid) only exports them.
+
+    Usage:
+        resample_lisflood('../lisflood', '../lisflood_{resolution:g}m', [250, 500, 1000],
+                          bounds=(675000, 8162500, 848500, 8454500), cache_dir='../lisflood/resampled')
+    :param model_dir: string - folder with the LISFLOOD model at its original resolution
+    :param out_dir: string - folder of the variant, formatted with the resolution, e.g. 'lisflood_{resolution:g}m'
+    :param resolution: float or list - cell size(s) of the target grid(s) in units of the model crs
+    :param bounds: tuple - (xmin, ymin, xmax, ymax) of the target grids (default: bounds of the DEM)
+    :param crs: CRS or string - crs of the target grids (default: that of the inputs)
+    :param cache_dir: string - folder with cached layers (default: <model_dir>/resampled)
+    :param workers: int - number of worker processes
+    :param layers: dict - resampling method per raster keyword of the parameter files
+    :param extra: dict - resampling method per file name of other rasters in the model folder
+    :param copy_patterns: list - glob patterns of files that are copied unchanged
+    :return: dict - per written layer True if it was resampled, False if it was taken from the cache
+    """
+    model_dir = os.path.abspath(model_dir)
+    resolutions = np.atleast_1d(resolution).tolist()
+    cache = ResampleCache(os.path.join(model_dir, 'resampled') if cache_dir is None else cache_dir)
+    # rasters of all parameter files, each resampled once
+    sources = {}
+    dem = None
+    for fn_par in sorted(glob.glob(os.path.join(model_dir, '*.par'))):
+        for key, value in read_par(fn_par).items():
+            if key in layers:
+                sources[value] = layers[key]
+                dem = value if key == 'DEMfile' and dem is None else dem
+    for name, method in extra.items():
+        if os.path.isfile(os.path.join(model_dir, name)):
+            sources[name] = method
+    if bounds is None:
+        if dem is None:
+            raise ValueError('No DEMfile in the parameter files of {:s}, bounds are needed'.format(model_dir))
+        with rasterio.open(_find_source(model_dir, dem)) as src:
+            bounds = tuple(src.bounds)
+
+    jobs = []
+    for res in resolutions:
+        transform, shape = target_grid(res, bounds)
+        folder = out_dir.format(resolution=res)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for pattern in copy_patterns:
+            for fn in glob.glob(os.path.join(model_dir, pattern)):
+                shutil.copy(fn, folder)
+        for name, method in sorted(sources.items()):
+            fn_src = _find_source(model_dir, name)
+            jobs.append((fn_src, cache.path(fn_src, transform, shape, crs, method), transform, shape, method,
+                         os.path.join(folder, name)))
+    cache.save()
+
+    # layers are resampled (if not cached) and exported in parallel, a layer shared by variants is resampled once
+    written = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        resampled = {}
+        for fn_src, fn_cache, transform, shape, method, fn_out in jobs:
+            if not os.path.isfile(fn_cache) and fn_cache not in resampled:
+                resampled[fn_cache] = pool.submit(_resample, fn_src, fn_cache, transform, shape, crs, method)
+        exports = []
+        for fn_src, fn_cache, transform, shape, method, fn_out in jobs:
+            if fn_cache in resampled:
+                resampled[fn_cache].result()
+            exports.append(pool.submit(_export, fn_cache, fn_out))
+            written[fn_out] = fn_cache in resampled
+        for export in exports:
+            export.result()
+    return written
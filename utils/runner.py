@@ -0,0 +1,494 @@
+# config-driven runner of coupled GLOFRIM experiments. An experiment file (ini) declares the GLOFRIM configuration,
+# the run period and the coupling options, and an output spec with the variables to store, the save interval, a
+# region of interest (bounding box and/or mask) and a time window, so that output collection and file size scale
+# with what is analysed instead of with grid size x number of time steps
+import os
+import sys
+import configparser
+from datetime import datetime
+import numpy as np
+import rasterio
+from .utils import grid_coords, CrossSectionOperator
+from .output import OutputWriter, DischargeRecorder
+from .zarrstore import ZarrWriter
+from .checkpoint import (run_key, latest_checkpoint, read_checkpoint, load_checkpoint, save_checkpoint,
+                         remove_checkpoints)
+from .spinup import SpinupCache
+from .waterbalance import WaterBalanceRecorder
+from .timing import StepTimer
+from .regrid import Regridder
+from .exchange import PointExchange, fuse_grid_exchanges
+from .snapping import RiverSnapper
+from .floodstats import FloodStatistics
+from .overviews import build_overviews
+from .update_funcs import update_glofrim, update_lfp
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def _centred_qx(get, rows, cols):
+    # staggered flows have one column more than the grid, average the faces on both sides of each cell
+    qx = get('Qx')[rows.start:rows.stop, cols.start:cols.stop + 1]
+    return 0.5 * qx[:, :-1] + 0.5 * qx[:, 1:]
+
+
+def _centred_qy(get, rows, cols):
+    # reverse flow so that positive is northward, and negative is southward
+    qy = get('Qy')[rows.start:rows.stop + 1, cols.start:cols.stop]
+    return -0.5 * qy[:-1, :] - 0.5 * qy[1:, :]
+
+
+# output fields per model: function of (get, rows, cols) returning the field in the window, and attributes. get
+# retrieves a model variable, rows and cols are slices of the window
+FIELDS = {
+    'LFP': {
+        'SGCQin': (lambda get, rows, cols: get('SGCQin')[rows, cols],
+                   {'units': 'm**3 s**-1', 'short_name': 'river_flow', 'long_name': 'River Flow'}),
+        'H': (lambda get, rows, cols: get('H')[rows, cols],
+              {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Water Depth'}),
+        # flood depth above terrain
+        'H_f': (lambda get, rows, cols: np.maximum(get('H')[rows, cols] + get('SGCz')[rows, cols] -
+                                                   get('DEM')[rows, cols], 0),
+                {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Water Depth floodplain'}),
+        # channel depth below terrain, only in channels
+        'H_c': (lambda get, rows, cols: np.minimum(get('DEM')[rows, cols] - get('SGCz')[rows, cols],
+                                                   get('H')[rows, cols]),
+                {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Water Depth channel'}),
+        'Qx': (_centred_qx, {'units': 'm**3 s**-1', 'long_name': 'Flow in x-direction (eastward)'}),
+        'Qy': (_centred_qy, {'units': 'm**3 s**-1', 'long_name': 'Flow in y-direction (northward)'}),
+        # raw flows on the faces between cells, one column (Qx) or row (Qy) more than the window
+        'Qx_face': (lambda get, rows, cols: get('Qx')[rows, cols.start:cols.stop + 1],
+                    {'units': 'm**3 s**-1', 'long_name': 'Flow in x-direction on cell faces (eastward)'}),
+        'Qy_face': (lambda get, rows, cols: get('Qy')[rows.start:rows.stop + 1, cols],
+                    {'units': 'm**3 s**-1', 'long_name': 'Flow in y-direction on cell faces (southward)'}),
+    },
+    'Sfincs': {
+        'H': (lambda get, rows, cols: get('zs')[rows, cols],
+              {'units': 'm', 'short_name': 'water_level', 'long_name': 'Water level +mean sea level'}),
+        'H_f': (lambda get, rows, cols: np.maximum(get('zs')[rows, cols] - get('zb')[rows, cols], 0),
+                {'units': 'm', 'short_name': 'water_depth', 'long_name': 'Water depth floodplain'}),
+        'qx': (lambda get, rows, cols: get('qx')[rows, cols],
+               {'units': 'm**3 s**-1', 'long_name': 'Flow in x-direction'}),
+        'qy': (lambda get, rows, cols: get('qy')[rows, cols],
+               {'units': 'm**3 s**-1', 'long_name': 'Flow in y-direction'}),
+    },
+}
+# variables that do not change during a run, retrieved once
+STATIC_VARIABLES = ['SGCz', 'DEM', 'zb']
+# fields that are not stored but derived when read (see DERIVED_VARIABLES), with the stored fields they are derived
+# from, and the static fields that are written once for them
+DERIVED_FROM = {
+    'LFP': {'H_f': ['H'], 'H_c': ['H'], 'Qx': ['Qx_face'], 'Qy': ['Qy_face']},
+    'Sfincs': {'H_f': ['H']},
+}
+STATIC_FIELDS = {
+    'LFP': {'SGCz': {'units': 'm', 'long_name': 'Subgrid channel bed elevation'},
+            'DEM': {'units': 'm', 'long_name': 'Terrain elevation'}},
+    'Sfincs': {'zb': {'units': 'm', 'long_name': 'Bed level +mean sea level'}},
+}
+STAGGERED = {'Qx_face': 'x', 'Qy_face': 'y'}
+# experiment settings that do not change the spun-up states: the period (already in the key of the spin-up cache)
+# and output-only settings
+SPINUP_IGNORED = ['start', 'end', 'spinup', 'output', 'checkpoint_every', 'profile']
+
+
+def _parse_time(value):
+    return datetime.strptime(value, DATE_FORMAT) if value else None
+
+
+def _parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+
+class OutputSpec(object):
+    """
+    Declarative output spec of an experiment, read from the [output] section of an experiment file:
+        variables = H, H_f        # output fields (see FIELDS), default all fields of the model
+        interval = 7              # save every Nth coupled time step, or monthly / yearly (first step of each)
+        bbox = 690000, 8200000, 760000, 8330000   # region of interest (xmin, ymin, xmax, ymax) in model crs
+        mask = ../gis/floodplain.tif              # region of interest as raster on the model grid (non-zero cells)
+        start = 2000-11-01        # time window of stored outputs
+        end = 2001-04-30
+        compact = true            # only store active (and masked) cells
+        store_derived = false     # store H_f, H_c and centred Qx, Qy instead of deriving them when read
+        statistics = monthly      # flood statistics in the region of interest per month, year or over the run
+        threshold = 0.1           # flood depth threshold of the statistics in m
+        overviews = true          # build 2x, 4x and 8x overview levels of the outputs after the run
+        discharge = ../gis/cross_sections.gpkg    # record discharge over cross sections (LISFLOOD only)
+    """
+    def __init__(self, variables=None, interval=1, bbox=None, mask=None, start=None, end=None, compact=True,
+                 discharge=None, store_derived=False, statistics=None, threshold=0.1, overviews=False):
+        """
+        :param variables: list - names of output fields, None for all fields of the model
+        :param interval: int or string - save every Nth coupled time step, or 'monthly' or 'yearly'
+        :param bbox: tuple - (xmin, ymin, xmax, ymax) of the region of interest in the model crs
+        :param mask: string - path to raster on the model grid, cells that are not zero are stored
+        :param start: datetime - first time to store
+        :param end: datetime - last time to store
+        :param compact: boolean - only store active cells (and masked cells)
+        :param discharge: string - path to cross sections to record discharge over
+        :param store_derived: boolean - store derived fields (see DERIVED_FROM) instead of the fields they are
+            derived from, plus static fields
+        :param statistics: string - 'monthly', 'yearly' or 'run' to accumulate flood statistics (see
+            FloodStatistics) per period, None for no statistics
+        :param threshold: float - flood depth threshold of the statistics in m
+        :param overviews: boolean - build overview levels of the outputs and statistics after the run (see
+            build_overviews), for interactive inspection with open_overview
+        """
+        self.variables = variables
+        if interval not in ['monthly', 'yearly']:
+            interval = int(interval)
+            if interval < 1:
+                raise ValueError('Output interval must be at least 1 time step')
+        self.interval = interval
+        self.bbox = bbox
+        self.mask = mask
+        self.start = start
+        self.end = end
+        self.compact = compact
+        self.discharge = discharge
+        self.store_derived = store_derived
+        if statistics not in [None, 'monthly', 'yearly', 'run']:
+            raise ValueError('statistics must be monthly, yearly or run')
+        self.statistics = statistics
+        self.threshold = threshold
+        self.overviews = overviews
+
+    @classmethod
+    def from_config(cls, config, section='output', root=''):
+        """
+        :param config: ConfigParser - experiment configuration
+        :param section: string - section with the output spec
+        :param root: string - folder that paths are relative to
+        :return: OutputSpec
+        """
+        get = lambda key: config.get(section, key, fallback='').strip() if config.has_section(section) else ''
+        bbox = [float(v) for v in _parse_list(get('bbox'))]
+        if len(bbox) not in [0, 4]:
+            raise ValueError('bbox must be xmin, ymin, xmax, ymax')
+        path = lambda value: os.path.join(root, value) if value else None
+        return cls(variables=_parse_list(get('variables')) or None,
+                   interval=get('interval') or 1,
+                   bbox=tuple(bbox) if bbox else None,
+                   mask=path(get('mask')),
+                   start=_parse_time(get('start')),
+                   end=_parse_time(get('end')),
+                   compact=get('compact').lower() not in ['false', 'no', '0'],
+                   discharge=path(get('discharge')),
+                   store_derived=get('store_derived').lower() in ['true', 'yes', '1'],
+                   statistics=get('statistics') or None,
+                   threshold=float(get('threshold') or 0.1),
+                   overviews=get('overviews').lower() in ['true', 'yes', '1'])
+
+    def due(self, t, step, dt):
+        """
+        :param t: datetime - time at the end of a coupled time step
+        :param step: int - number of the coupled time step since the start of the run (first step is 1)
+        :param dt: timedelta - coupled time step
+        :return: boolean - True if outputs are stored at this time step
+        """
+        if (self.start is not None and t < self.start) or (self.end is not None and t > self.end):
+            return False
+        if self.interval == 'monthly':
+            return (t - dt).month != t.month
+        if self.interval == 'yearly':
+            return (t - dt).year != t.year
+        return step % self.interval == 0
+
+    def window(self, grid, shape):
+        """
+        Determines the region of interest on a model grid
+        :param grid: GLOFRIM grid - with transform and mask
+        :param shape: tuple - (rows, cols) of the model grid
+        :return: tuple - rows (slice), cols (slice), mask in the window (2D boolean array, None to store all cells)
+        """
+        rows, cols = slice(0, shape[0]), slice(0, shape[1])
+        mask = None
+        if self.mask is not None:
+            with rasterio.open(self.mask) as src:
+                data = src.read(1)
+                mask = (data != 0) if src.nodata is None else (data != 0) & (data != src.nodata)
+            if mask.shape != tuple(shape):
+                raise ValueError('Mask {:s} is not on the model grid'.format(self.mask))
+        if self.compact:
+            mask = np.asarray(grid.mask, dtype=bool) if mask is None else mask & np.asarray(grid.mask, dtype=bool)
+        if self.bbox is not None:
+            xmin, ymin, xmax, ymax = self.bbox
+            c0, r0 = ~grid.transform * (xmin, ymax)
+            c1, r1 = ~grid.transform * (xmax, ymin)
+            r0, r1 = sorted([r0, r1])
+            c0, c1 = sorted([c0, c1])
+            rows = slice(int(max(np.floor(r0), 0)), int(min(np.ceil(r1), shape[0])))
+            cols = slice(int(max(np.floor(c0), 0)), int(min(np.ceil(c1), shape[1])))
+        elif self.mask is not None:
+            # crop to the extent of the mask
+            r, c = np.nonzero(mask)
+            rows, cols = slice(r.min(), r.max() + 1), slice(c.min(), c.max() + 1)
+        if rows.stop <= rows.start or cols.stop <= cols.start:
+            raise ValueError('Region of interest is outside the model grid')
+        return rows, cols, None if mask is None else mask[rows, cols]
+
+
+class Experiment(object):
+    """
+    Coupled GLOFRIM experiment declared in an experiment file (ini), see experiments/specs. The [experiment]
+    section sets up the run:
+        config = ../glofrim_barotse_2way1D2D.ini   # GLOFRIM configuration
+        model = LFP                   # hydrodynamic model that outputs are taken from (LFP or Sfincs)
+        output = ../../results/test_oneyear_2way_1D2D.nc   # or .zarr for a chunked zarr store (see ZarrWriter)
+        start = 2000-10-01
+        end = 2000-10-05
+        spinup = 2000-01-01           # start of spin-up period, states are cached (default: cold start)
+        additive = 2                  # indices of exchanges that add to their target
+        fuse_exchanges = false        # fuse exchanges into the same variable (see fuse_grid_exchanges)
+        checkpoint_every = 30
+        profile = false
+        twoway = true                 # infiltrate LISFLOOD flood water back into the wflow Snow store
+        infiltcap = 0.00034722222222222224   # infiltration capacity in mm s-1 (30 mm per day)
+        storagecap = 1e6              # soil storage capacity in mm
+        native_update = false         # advance LISFLOOD with update_until between infiltration events
+        sources = ../../sfincs/barotse/gis/src_update.geojson   # SFINCS source points fed with wflow runoff
+        river = ../../wflow/staticmaps/wflow_river.map
+        uparea = ../../wflow/staticmaps/wflow_uparea.map
+    Paths are relative to the folder of the experiment file. The [output] section is an OutputSpec.
+    """
+    def __init__(self, fn):
+        """
+        :param fn: string - path to experiment file
+        """
+        self.fn = os.path.abspath(fn)
+        self.root = os.path.dirname(self.fn)
+        config = configparser.ConfigParser(inline_comment_prefixes=('#',), interpolation=None)
+        config.read(self.fn)
+        get = lambda key, fallback='': config.get('experiment', key, fallback=fallback).strip()
+        path = lambda value: os.path.abspath(os.path.join(self.root, value)) if value else None
+        self.config_fn = path(get('config'))
+        self.model = get('model', 'LFP')
+        if self.model not in FIELDS:
+            raise ValueError('Outputs of model {:s} are not supported, use one of {}'.format(self.model,
+                                                                                           list(FIELDS)))
+        self.fn_out = path(get('output'))
+        # other outputs (water balance, discharge, checkpoints, ...) are named after the main output
+        self.fn_base = os.path.splitext(self.fn_out)[0]
+        self.t_start = _parse_time(get('start'))
+        self.t_end = _parse_time(get('end'))
+        self.t_spinup = _parse_time(get('spinup'))
+        self.additive = [int(i) for i in _parse_list(get('additive'))]
+        self.fuse_exchanges = get('fuse_exchanges', 'false').lower() in ['true', 'yes', '1']
+        self.checkpoint_every = int(get('checkpoint_every', '30'))
+        self.profile = get('profile', 'false').lower() in ['true', 'yes', '1']
+        self.twoway = get('twoway', 'false').lower() in ['true', 'yes', '1']
+        self.infiltcap = float(get('infiltcap')) if get('infiltcap') else None
+        self.storagecap = float(get('storagecap')) if get('storagecap') else None
+        self.native_update = get('native_update', 'false').lower() in ['true', 'yes', '1']
+        self.sources = path(get('sources'))
+        self.river = path(get('river', '../../wflow/staticmaps/wflow_river.map'))
+        self.uparea = path(get('uparea', '../../wflow/staticmaps/wflow_uparea.map'))
+        # settings that change the results, checkpoints are only resumed by a run with the same settings (the end
+        # time may be extended, checkpoint and profile options do not matter)
+        self.settings = {section: {key: value for key, value in config.items(section)
+                                   if not (section == 'experiment' and key in ['end', 'checkpoint_every', 'profile'])}
+                         for section in config.sections()}
+        # settings that change the spun-up states, spun-up states are only reused by a run with the same coupling
+        # (the period is part of the cache key, outputs do not matter)
+        self.spinup_settings = {section: {key: value for key, value in items.items()
+                                          if not (section == 'experiment' and key in SPINUP_IGNORED)}
+                                for section, items in self.settings.items() if section != 'output'}
+        self.output = OutputSpec.from_config(config, root=self.root)
+        if self.output.discharge is not None and self.model != 'LFP':
+            raise ValueError('Discharge is recorded from the staggered LISFLOOD flows, it is not available for model '
+                             '{:s}'.format(self.model))
+        variables = self.output.variables or list(FIELDS[self.model])
+        # overviews of the requested fields on the cell grid, derived fields are computed from the stored ones
+        self.overview_variables = [name for name in variables if name not in STAGGERED]
+        unknown = [name for name in variables if name not in FIELDS[self.model]]
+        if len(unknown) > 0:
+            raise ValueError('Unknown output variables {} for model {:s}'.format(unknown, self.model))
+        self.static = []
+        if not self.output.store_derived:
+            # derived fields are replaced by the fields they are derived from, in order and without duplicates
+            derived = DERIVED_FROM.get(self.model, {})
+            stored = [name for var in variables for name in derived.get(var, [var])]
+            if any(var in derived for var in variables):
+                self.static = list(STATIC_FIELDS[self.model])
+            variables = [name for i, name in enumerate(stored) if name not in stored[:i]]
+        self.variables = variables
+
+    def run(self):
+        """
+        Runs the experiment: sets up the coupled model (resuming from the latest checkpoint or warm-starting from
+        cached spun-up states), runs it to the end time and stores outputs according to the output spec
+        """
+        from glofrim import Glofrim
+        Glofrim.update = update_glofrim
+        if self.infiltcap is not None or (self.model == 'LFP' and self.output.statistics is not None):
+            # the infiltration patch of LISFLOOD, which also feeds the flood statistics at every infiltration event.
+            # Other runs keep the LISFLOOD update of GLOFRIM, as the scripts they replaced
+            Glofrim._models['LFP'].update = update_lfp
+        cbmi = Glofrim()
+        out_folder = os.path.dirname(self.fn_out)
+        if not os.path.isdir(out_folder):
+            os.makedirs(out_folder)
+        cbmi.logger.info('Reading config for cbmi model from {:s}'.format(self.config_fn))
+        cbmi.initialize_config(self.config_fn)
+        cbmi.set_start_time(self.t_start)
+        cbmi.set_end_time(self.t_end)
+
+        # infiltration options of LISFLOOD, passed to its update function
+        kwargs = {}
+        if self.infiltcap is not None:
+            kwargs = {'infiltcap': self.infiltcap, 'storagecap': self.storagecap, 'native': self.native_update}
+
+        # resume from the latest checkpoint of this run, or warm-start from cached spun-up states
+        checkpoint_dir = self.fn_base + '_checkpoints'
+        key = run_key(self.config_fn, extra=self.settings)
+        checkpoint = latest_checkpoint(checkpoint_dir, key=key)
+        spinup = None
+        if self.t_spinup is not None:
+            spinup = SpinupCache(os.path.join(out_folder, 'spinup'), self.config_fn, self.t_spinup, self.t_start,
+                                 extra=self.spinup_settings)
+        if checkpoint is not None:
+            cbmi.logger.info('Resuming from checkpoint {:s}'.format(checkpoint))
+            cbmi.set_start_time(read_checkpoint(checkpoint)['time'])
+        elif spinup is not None and spinup.lookup() is None:
+            cbmi.logger.info('No spun-up states cached, spinning up from {:s}'.format(
+                self.t_spinup.strftime(DATE_FORMAT)))
+            cbmi.set_start_time(self.t_spinup)
+        cbmi.logger.info('Initializing model')
+        cbmi.initialize_model()
+        positions = {}
+        if checkpoint is not None:
+            positions = load_checkpoint(cbmi, checkpoint)['writers']
+
+        for i in self.additive:
+            cbmi.exchanges[i][1]['add'] = True
+        if self.fuse_exchanges:
+            for name in fuse_grid_exchanges(cbmi):
+                cbmi.logger.info('Fused exchanges {:s}'.format(name))
+        runoff_exchange = None
+        if self.sources is not None:
+            import geopandas as gpd
+            snapper = RiverSnapper(self.river, self.uparea, cache_dir=os.path.join(out_folder, 'cache'))
+            idxs_wfl = snapper.snap_gdf(gpd.read_file(self.sources))
+            runoff_exchange = PointExchange(cbmi, idxs_wfl, model_out='WFL', var_out='RiverRunoff',
+                                            model_in='Sfincs', var_in='qsrc')
+        regridder = None
+        if self.twoway:
+            regridder = Regridder.from_grids(cbmi.bmimodels['LFP'].grid, cbmi.bmimodels['WFL'].grid,
+                                             cache_dir=os.path.join(out_folder, 'cache'))
+
+        def update():
+            cbmi.update(**kwargs)
+            if runoff_exchange is not None:
+                # overwrite discharges in all time steps
+                runoff_exchange.push()
+            if regridder is not None:
+                # add regridded infiltration to the snow water store, so that it infiltrates into wflow
+                infilt_wfl = regridder(cbmi.bmimodels['LFP'].infilt, nodata=np.nan)
+                snow = cbmi.bmimodels['WFL']._bmi.get_value('Snow')
+                snow += np.flipud(infilt_wfl)
+                cbmi.bmimodels['WFL']._bmi.set_value('Snow', snow)
+
+        if checkpoint is None and spinup is not None:
+            if spinup.lookup() is not None:
+                cbmi.logger.info('Loading spun-up states from {:s}'.format(spinup.lookup()))
+                spinup.load(cbmi)
+            else:
+                spinup.run(cbmi, update)
+
+        # output structures, restricted to the region of interest
+        bmi = cbmi.bmimodels[self.model]
+        static = {}
+
+        def get(name):
+            if name in STATIC_VARIABLES:
+                if name not in static:
+                    static[name] = np.array(bmi.get_value(name))
+                return static[name]
+            return bmi.get_value(name)
+        shape = (bmi.grid.height, bmi.grid.width)
+        rows, cols, mask = self.output.window(bmi.grid, shape)
+        x, y = [np.asarray(c) for c in grid_coords(bmi.grid.transform, shape)]
+        fields = [FIELDS[self.model][name] for name in self.variables]
+        cbmi.logger.info('Writing {} to {:s} every {} step(s), in rows {:d}-{:d} and columns {:d}-{:d}'.format(
+            self.variables, self.fn_out, self.output.interval, rows.start, rows.stop, cols.start, cols.stop))
+        static_fields = {name: (get(name)[rows, cols], STATIC_FIELDS[self.model][name]) for name in self.static}
+        # a zarr store if the output ends with .zarr, otherwise NetCDF
+        Writer = ZarrWriter if self.fn_out.endswith('.zarr') else OutputWriter
+        writer = Writer(self.fn_out, x[cols], y[rows], self.variables, [attrs for _, attrs in fields],
+                        mask=mask, position=positions.get('outputs'), static=static_fields,
+                        staggered={name: STAGGERED[name] for name in self.variables if name in STAGGERED})
+        writers = {'outputs': writer}
+        recorder = None
+        if self.output.discharge is not None:
+            import fiona
+            with fiona.open(self.output.discharge) as feats:
+                cs_operator = CrossSectionOperator(x, y, feats)
+            recorder = DischargeRecorder(self.fn_base + '_discharge.nc', cs_operator,
+                                         position=positions.get('discharge'))
+            writers['discharge'] = recorder
+        stats = None
+        if self.output.statistics is not None:
+            stats = FloodStatistics(self.fn_base + '_floodstats.nc', x[cols], y[rows],
+                                    threshold=self.output.threshold,
+                                    reset=None if self.output.statistics == 'run' else self.output.statistics,
+                                    mask=mask, t_start=cbmi.get_current_time(),
+                                    position=positions.get('statistics'))
+            if self.model == 'LFP':
+                # added at every infiltration event of update_lfp
+                stats.attach(bmi, window=(rows, cols))
+            writers['statistics'] = stats
+        cbmi.wb_recorder = WaterBalanceRecorder(self.fn_base + '_wb.nc',
+                                                position=positions.get('water_balance'))
+        writers['water_balance'] = cbmi.wb_recorder
+        timer = StepTimer(enabled=self.profile)
+        timer.attach(cbmi)
+
+        full = (slice(0, shape[0]), slice(0, shape[1]))
+        try:
+            t = cbmi.get_current_time()
+            step = int(round((t - self.t_start) / cbmi._dt))
+            while t < self.t_end:
+                update()
+                t = cbmi.get_current_time()
+                step += 1
+                with timer.section('output'):
+                    if recorder is not None:
+                        recorder.record(t, _centred_qx(get, *full), _centred_qy(get, *full))
+                    if stats is not None and self.model != 'LFP':
+                        stats.add(t, FIELDS[self.model]['H_f'][0](get, rows, cols))
+                    if self.output.due(t, step, cbmi._dt):
+                        writer.append(t, [f(get, rows, cols) for f, _ in fields])
+                if step % self.checkpoint_every == 0:
+                    save_checkpoint(cbmi, checkpoint_dir, writers=writers, key=key)
+        except Exception as e:
+            print(e)
+            # the running period of the statistics is continued from the latest checkpoint by the resumed run
+            if stats is not None:
+                stats.close(final=False)
+            for w in writers.values():
+                w.close()
+            sys.exit('something is going wrong in updating - please check! Rerun to resume from the latest checkpoint')
+        for w in writers.values():
+            w.close()
+        # the run is complete, a rerun starts from the start time again
+        remove_checkpoints(checkpoint_dir)
+        timer.close()
+        if self.output.overviews:
+            cbmi.logger.info('Building overviews of {:s}'.format(self.fn_out))
+            build_overviews(self.fn_out, variables=self.overview_variables)
+            if stats is not None:
+                build_overviews(stats.fn)
+        if timer.enabled:
+            cbmi.logger.info('Timing per coupled step:\n{}'.format(timer.report()))
+            timer.table().to_csv(self.fn_base + '_timing.csv')
+        cbmi.logger.info('Closing model')
+        cbmi.finalize()
+
+
+def run_experiment(fn):
+    """
+    Runs a coupled experiment declared in an experiment file
+    :param fn: string - path to experiment file (ini)
+    """
+    Experiment(fn).run()
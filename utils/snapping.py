@@ -0,0 +1,143 @@
+# snapping of source points (e.g. SFINCS src points, LISFLOOD 1d_us points) to wflow river cells with a spatial
+# index, so that runoff is taken from the right river cell without manually tuned coordinate offsets
+import os
+import re
+import json
+import hashlib
+import configparser
+import numpy as np
+import rasterio
+import rasterio.warp
+from scipy.spatial import cKDTree
+from .staticmaps import checksum
+
+
+def exchange_points(config_fn):
+    """
+    Reads the point coordinates of exchanges in a GLOFRIM ini file, e.g.
+    WFL.RiverRunoff*86400@grid_us=LFP.SGCQin*86400@1d_us|[[677250, 8346250], [733250, 8428750]]
+    :param config_fn: string - path to GLOFRIM ini file
+    :return: dict - per exchange (left-hand side) a 2D numpy array with x and y coordinates (columns)
+    """
+    config = configparser.ConfigParser(inline_comment_prefixes=('#',), interpolation=None, strict=False)
+    config.optionxform = str
+    config.read(config_fn)
+    points = {}
+    for key, value in config.items('exchanges'):
+        match = re.search(r'\|\s*(\[.*\])\s*$', value)
+        if match is not None:
+            points[key] = np.array(json.loads(match.group(1)), dtype=np.float64).reshape(-1, 2)
+    return points
+
+
+class RiverSnapper(object):
+    """
+    Spatial index (KD-tree) over the river cells of a wflow model, built once. Source points are snapped to the
+    river cell within a search radius that best matches them by distance and, if known, by upstream area, so that
+    points close to a confluence end up on the right branch. Snapped indices are cached on disk, keyed by the
+    river maps, the points and the snapping parameters.
+
+    Usage:
+        snapper = RiverSnapper('../wflow/staticmaps/wflow_river.map', '../wflow/staticmaps/wflow_uparea.map',
+                               cache_dir='../results/cache')
+        idxs_wfl = snapper.snap_gdf(gpd.read_file(fn_json))
+        flux_out = cbmi.bmimodels['WFL'].get_value_at_indices('RiverRunoff', idxs_wfl)
+    """
+    def __init__(self, river_fn, uparea_fn=None, crs='EPSG:4326', cache_dir=None):
+        """
+        :param river_fn: string - path to river map (wflow_river.map, river cells are 1)
+        :param uparea_fn: string - path to upstream area map (wflow_uparea.map), optional
+        :param crs: CRS or string - coordinate reference system of the maps, used if the maps have none (PCRaster)
+        :param cache_dir: string - if set, snapped indices are stored in (and read from) this folder
+        """
+        with rasterio.open(river_fn) as src:
+            river = src.read(1)
+            self.transform = src.transform
+            self.crs = src.crs or crs
+            self.shape = river.shape
+            river = (river == 1) if src.nodata is None else (river == 1) & (river != src.nodata)
+        # flat indices of river cells in the (row-major) model grid, as used by get_value_at_indices
+        self.index = np.flatnonzero(river)
+        rows, cols = np.unravel_index(self.index, self.shape)
+        x, y = rasterio.transform.xy(self.transform, rows, cols)
+        self.tree = cKDTree(np.column_stack([x, y]))
+        self.cellsize = abs(self.transform.a)
+        self.uparea = None
+        fns = [river_fn]
+        if uparea_fn is not None:
+            with rasterio.open(uparea_fn) as src:
+                self.uparea = src.read(1).reshape(-1)[self.index].astype(np.float64)
+            fns.append(uparea_fn)
+        self.cache_dir = cache_dir
+        self._maps_key = [checksum(fn) for fn in fns] if cache_dir is not None else None
+
+    def _cache_fn(self, x, y, uparea, max_cells, area_weight):
+        sha1 = hashlib.sha1(json.dumps([self._maps_key, max_cells, area_weight]).encode('utf-8'))
+        for a in [x, y] + ([] if uparea is None else [uparea]):
+            sha1.update(np.ascontiguousarray(a, dtype=np.float64).tobytes())
+        return os.path.join(self.cache_dir, 'snap_{:s}.npz'.format(sha1.hexdigest()))
+
+    def snap(self, x, y, uparea=None, src_crs=None, max_cells=2, area_weight=10.):
+        """
+        Snaps points to river cells. Candidates are all river cells within max_cells cell sizes; the best candidate
+        has the lowest score distance / cell size + area_weight * |ln(uparea cell / uparea point)|, or is the
+        nearest one if the upstream area of the points (or of the cells) is not known. With the default weight, a
+        mismatch in upstream area of 10% weighs as much as a distance of one cell, so that a point at a confluence is
+        snapped to the branch it belongs to rather than to the cell below the confluence.
+        :param x: 1D array - x-coordinates of points
+        :param y: 1D array - y-coordinates of points
+        :param uparea: 1D array - upstream area of points in the units of the uparea map (NaN where unknown)
+        :param src_crs: CRS or string - coordinate reference system of the points (default: that of the maps)
+        :param max_cells: float - search radius in cell sizes
+        :param area_weight: float - weight of the upstream area mismatch relative to the distance in cells
+        :return: 1D numpy array (int) - flat indices of river cells in the model grid
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if src_crs is not None:
+            x, y = [np.asarray(c) for c in rasterio.warp.transform(src_crs, self.crs, x, y)]
+        if uparea is not None:
+            uparea = np.atleast_1d(np.asarray(uparea, dtype=np.float64))
+        fn_cache = None if self.cache_dir is None else self._cache_fn(x, y, uparea, max_cells, area_weight)
+        if fn_cache is not None and os.path.isfile(fn_cache):
+            with np.load(fn_cache) as cache:
+                return cache['idxs']
+        radius = max_cells * self.cellsize
+        idxs = np.zeros(len(x), dtype=np.int64)
+        for i, candidates in enumerate(self.tree.query_ball_point(np.column_stack([x, y]), radius)):
+            if len(candidates) == 0:
+                raise ValueError('No river cell within {:g} cells of point {:d} ({:f}, {:f})'.format(
+                    max_cells, i, x[i], y[i]))
+            candidates = np.array(candidates)
+            score = np.hypot(*(self.tree.data[candidates] - (x[i], y[i])).T) / self.cellsize
+            if uparea is not None and self.uparea is not None and uparea[i] > 0:
+                score += area_weight * np.abs(np.log(np.maximum(self.uparea[candidates], 1e-6) / uparea[i]))
+            idxs[i] = self.index[candidates[np.argmin(score)]]
+        if fn_cache is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            np.savez(fn_cache, idxs=idxs)
+        return idxs
+
+    def snap_gdf(self, gdf, uparea_col='uparea', **kwargs):
+        """
+        Snaps the points of a GeoDataFrame (e.g. sfincs/barotse/gis/src_update.geojson) to river cells
+        :param gdf: GeoDataFrame - points, reprojected to the maps if its crs is set
+        :param uparea_col: string - column with upstream area of the points (ignored if missing)
+        :param kwargs: dict - arguments of snap (max_cells, area_weight)
+        :return: 1D numpy array (int) - flat indices of river cells in the model grid
+        """
+        uparea = gdf[uparea_col].values if uparea_col in gdf.columns else None
+        return self.snap(gdf.geometry.x.values, gdf.geometry.y.values, uparea=uparea, src_crs=gdf.crs, **kwargs)
+
+    def xy(self, idxs, dst_crs=None):
+        """
+        :param idxs: 1D array - flat indices of cells in the model grid
+        :param dst_crs: CRS or string - coordinate reference system of the coordinates (default: that of the maps)
+        :return: tuple - 1D numpy arrays with x and y coordinates of the cell centres
+        """
+        rows, cols = np.unravel_index(idxs, self.shape)
+        x, y = rasterio.transform.xy(self.transform, rows, cols)
+        if dst_crs is not None:
+            x, y = rasterio.warp.transform(self.crs, dst_crs, x, y)
+        return np.asarray(x), np.asarray(y)
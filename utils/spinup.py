@@ -0,0 +1,149 @@
+# cache of spun-up model states, so that experiments that share the same model configuration and inputs only
+# simulate the spin-up period once and then warm-start from the cached states (stored as checkpoints)
+import os
+import re
+import json
+import glob
+import hashlib
+import configparser
+from .checkpoint import save_checkpoint, latest_checkpoint, load_checkpoint
+from .staticmaps import STORE_PATTERNS, checksum
+
+# input files of each model that are not referenced by name in the model configuration, relative to its folder
+INPUT_PATTERNS = {
+    'WFL': STORE_PATTERNS + ['instate/*.map'],
+}
+
+
+def model_configs(config_fn):
+    """
+    Reads the model configuration files referenced in a GLOFRIM ini file
+    :param config_fn: string - path to GLOFRIM ini file
+    :return: dict - absolute path of the configuration file per model
+    """
+    config = configparser.ConfigParser(inline_comment_prefixes=('#',), interpolation=None, strict=False)
+    config.optionxform = str
+    config.read(config_fn)
+    root_dir = os.path.join(os.path.dirname(os.path.abspath(config_fn)), config.get('models', 'root_dir',
+                                                                                    fallback=''))
+    return {mod: os.path.abspath(os.path.join(root_dir, fn)) for mod, fn in config.items('models')
+            if mod != 'root_dir'}
+
+
+def model_inputs(mod, config_fn, patterns=INPUT_PATTERNS):
+    """
+    Lists the input files of a model: all files referenced in its configuration file (relative to the folder of
+    the configuration file) and the files matching the input patterns of the model
+    :param mod: string - model short name, e.g. 'WFL'
+    :param config_fn: string - path to model configuration file
+    :param patterns: dict - per model glob patterns relative to the folder of the configuration file
+    :return: list - absolute paths of input files, sorted
+    """
+    root = os.path.dirname(config_fn)
+    fns = set()
+    with open(config_fn, 'r', errors='ignore') as f:
+        for line in f:
+            for token in re.split(r'[\s=,]+', line.split('#')[0]):
+                fn = os.path.join(root, token.lstrip('/\\'))
+                if token and os.path.isfile(fn):
+                    fns.add(os.path.abspath(fn))
+    for pattern in patterns.get(mod, []):
+        fns.update(os.path.abspath(fn) for fn in glob.glob(os.path.join(root, pattern)) if os.path.isfile(fn))
+    return sorted(fns)
+
+
+class SpinupCache(object):
+    """
+    Cache of spun-up states of a coupled model. States are keyed by a hash of the contents of the GLOFRIM ini file,
+    the model configuration files and all model inputs, the spin-up period and any other settings that affect the
+    spin-up (e.g. infiltration parameters of a two-way coupling). Experiments with identical keys share the cached
+    states. Checksums of input files are remembered by size and modification time, so that unchanged (large) input
+    files are not read again for every experiment.
+
+    Usage:
+        spinup = SpinupCache('../results/spinup', config_fn, t_spinup, t_start)
+        state = spinup.lookup()
+        cbmi.set_start_time(t_start if state is not None else t_spinup)
+        cbmi.initialize_model()
+        if state is not None:
+            load_checkpoint(cbmi, state)
+        else:
+            spinup.run(cbmi)
+    """
+    def __init__(self, cache_dir, config_fn, t_start, t_end, extra=None):
+        """
+        :param cache_dir: string - folder with cached states
+        :param config_fn: string - path to GLOFRIM ini file
+        :param t_start: datetime - start of the spin-up period
+        :param t_end: datetime - end of the spin-up period (start time of the experiment)
+        :param extra: dict - other settings that affect the spin-up, included in the key
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.t_start = t_start
+        self.t_end = t_end
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._checksums_fn = os.path.join(self.cache_dir, 'checksums.json')
+        self._checksums = {}
+        if os.path.isfile(self._checksums_fn):
+            with open(self._checksums_fn, 'r') as f:
+                self._checksums = json.load(f)
+        content = {'config': self._checksum(config_fn),
+                   'models': {},
+                   'period': [t_start.isoformat(), t_end.isoformat()],
+                   'extra': extra,
+                   }
+        for mod, fn in sorted(model_configs(config_fn).items()):
+            root = os.path.dirname(fn)
+            content['models'][mod] = {os.path.relpath(fn_input, root).replace(os.sep, '/'): self._checksum(fn_input)
+                                      for fn_input in [fn] + model_inputs(mod, fn)}
+        with open(self._checksums_fn + '.tmp', 'w') as f:
+            json.dump(self._checksums, f, indent=1)
+        os.replace(self._checksums_fn + '.tmp', self._checksums_fn)
+        self.key = hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        self.path = os.path.join(self.cache_dir, 'spinup_{:s}'.format(self.key))
+
+    def _checksum(self, fn):
+        fn = os.path.abspath(fn)
+        stat = os.stat(fn)
+        entry = self._checksums.get(fn)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': checksum(fn)}
+            self._checksums[fn] = entry
+        return entry['sha1']
+
+    def lookup(self):
+        """
+        :return: string - path to the cached states (a checkpoint), None if there are none for this key
+        """
+        return latest_checkpoint(self.path)
+
+    def store(self, cbmi):
+        """
+        Stores the states of the coupled model at the end of the spin-up period
+        :param cbmi: Glofrim - coupled model at the end of the spin-up period
+        :return: string - path to the cached states
+        """
+        if cbmi.get_current_time() != self.t_end:
+            raise ValueError('Model time {} differs from end of spin-up {}'.format(cbmi.get_current_time(),
+                                                                                   self.t_end))
+        return save_checkpoint(cbmi, self.path, keep=1)
+
+    def load(self, cbmi):
+        """
+        Loads the cached states into a coupled model that was initialized at the end of the spin-up period
+        :param cbmi: Glofrim - initialized coupled model
+        """
+        load_checkpoint(cbmi, self.lookup())
+
+    def run(self, cbmi, update=None):
+        """
+        Runs the spin-up period and stores the states at the end of it
+        :param cbmi: Glofrim - coupled model initialized at the start of the spin-up period
+        :param update: function - updates the coupled model one time step, as in the experiment (default: cbmi.update)
+        :return: string - path to the cached states
+        """
+        update = cbmi.update if update is None else update
+        while cbmi.get_current_time() < self.t_end:
+            update()
+        return self.store(cbmi)
@@ -0,0 +1,124 @@
+# timing of the parts of a coupled GLOFRIM time step (model updates, exchanges, LISFLOOD sub-stepping and
+# infiltration, output collection), to find out where the time of a slow run is spent
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+import pandas as pd
+from .update_funcs import update_glofrim
+
+
+class StepTimer(object):
+    """
+    Per-step timing table of a coupled run. update_glofrim and update_lfp record wall times in it if it is attached
+    to the coupled model (as cbmi.timer and as timer of each model), otherwise they skip all timing. A disabled timer
+    is never attached, so instrumentation can stay in the scripts at no cost.
+    Recorded columns (seconds, unless stated otherwise):
+        step - wall time from the start of one coupled step to the start of the next (or to close)
+        update.<model> - update of a model, e.g. update.WFL
+        exchange.<name> - exchange in cbmi.exchanges
+        LFP.substeps - number of LISFLOOD (adaptive) sub-steps, or of update_until calls in native mode
+        LFP.substepping - time in LISFLOOD sub-steps
+        LFP.infiltration - time in the infiltration patch
+        <section> - any section timed in a script, e.g. output
+
+    Usage:
+        Glofrim.update = update_funcs.update_glofrim
+        timer = StepTimer()
+        timer.attach(cbmi)
+        while running:
+            cbmi.update()
+            with timer.section('output'):
+                writer.append(...)
+        timer.close()
+        print(timer.report())
+    """
+    def __init__(self, enabled=True):
+        """
+        :param enabled: boolean - if False, attach does nothing and sections are not timed
+        """
+        self.enabled = enabled
+        self.rows = []
+        self._row = None
+        self._t0 = None
+
+    def attach(self, cbmi):
+        """
+        Attaches the timer to the coupled model and its models, so that their update functions record timings
+        :param cbmi: Glofrim - coupled model, its update must be update_funcs.update_glofrim
+        """
+        if not self.enabled:
+            return
+        # steps are only opened by the patched update, otherwise the table would stay empty
+        if getattr(type(cbmi), 'update', None) is not update_glofrim:
+            raise ValueError('StepTimer needs the patched update of the coupled model, install it first with '
+                             'Glofrim.update = utils.update_funcs.update_glofrim')
+        cbmi.timer = self
+        for bmi in cbmi.bmimodels.values():
+            bmi.timer = self
+
+    def start_step(self, time):
+        """
+        Starts a new row in the timing table, and closes the previous one
+        :param time: datetime - model time at the start of the coupled step
+        """
+        self._close_row()
+        self._row = {'time': time}
+        self._t0 = perf_counter()
+
+    def _close_row(self):
+        if self._row is not None:
+            self._row['step'] = perf_counter() - self._t0
+            self.rows.append(self._row)
+            self._row = None
+
+    def add(self, name, value):
+        """
+        Adds a wall time (or count) to a column of the current step
+        :param name: string - column name
+        :param value: float - seconds (or count) to add
+        """
+        if self._row is not None:
+            self._row[name] = self._row.get(name, 0.) + value
+
+    def section(self, name):
+        """
+        :param name: string - column name
+        :return: context manager that adds the wall time of the block to the column of the current step
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._section(name)
+
+    @contextmanager
+    def _section(self, name):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - t0)
+
+    def close(self):
+        """
+        Closes the last row of the timing table
+        """
+        self._close_row()
+
+    def table(self):
+        """
+        :return: DataFrame - timing table, one row per coupled step indexed by model time
+        """
+        if len(self.rows) == 0:
+            return pd.DataFrame()
+        return pd.DataFrame(self.rows).set_index('time')
+
+    def report(self):
+        """
+        :return: DataFrame - per column the total, mean and maximum per step and the share of the total step time
+        """
+        table = self.table()
+        if len(table) == 0:
+            return pd.DataFrame()
+        report = pd.DataFrame({'total': table.sum(), 'mean': table.mean(), 'max': table.max()})
+        report['share'] = report['total'] / report.loc['step', 'total']
+        # counts are no wall times
+        report.loc[[c for c in table.columns if c.endswith('substeps')], 'share'] = float('nan')
+        return report
@@ -3,6 +3,7 @@
 # is returned from the model after each day running so that it can be introduced to WFLOW again
 
 import numpy as np
+from time import perf_counter
 
 def update_glofrim(self, dt=None, **kwargs):
     """Updating model for a certain time step interval (default: None).
@@ -26,11 +27,18 @@ def update_glofrim(self, dt=None, **kwargs):
         msg = "endTime already reached, model not updated"
         self.logger.warn(msg)
         raise Exception(msg)
+    # optional timing of all update and exchange items, see timing.StepTimer
+    timer = getattr(self, 'timer', None)
+    if timer is not None:
+        timer.start_step(self._t)
     # update all models with combined model dt
-    wb_dict = {'time': str(self._t)}
+    # volumes are collected as numbers, and only formatted if they go to the text water balance log
+    wb_dict = {}
     dt = self._dt.total_seconds() if dt is None else dt
     t_next = self._t + timedelta(seconds=dt)
     for item in self.exchanges:
+        if timer is not None:
+            t0 = perf_counter()
         if item[0] == 'update':
             # LFP deviates from the set timestep using an adaptive timestep if dt is set to large
             # calculate the dt to get to the next timestep
@@ -44,19 +52,122 @@ def update_glofrim(self, dt=None, **kwargs):
                 self.bmimodels[imod].update(dt=dt_mod)
 
             # get volume totals in and out if the bmi object has this funtion, ortherwise return -9999
-            tot_volume_in = getattr(self.bmimodels[imod], '_get_tot_volume_in', lambda: -9999.)()
-            wb_dict.update({'{}_tot_in'.format(imod): '{:.2f}'.format(tot_volume_in)})
-            tot_volume_out = getattr(self.bmimodels[imod], '_get_tot_volume_out', lambda: -9999.)()
-            wb_dict.update({'{}_tot_out'.format(imod): '{:.2f}'.format(tot_volume_out)})
+            wb_dict['{}_tot_in'.format(imod)] = getattr(self.bmimodels[imod], '_get_tot_volume_in', lambda: -9999.)()
+            wb_dict['{}_tot_out'.format(imod)] = getattr(self.bmimodels[imod], '_get_tot_volume_out', lambda: -9999.)()
         elif item[0] == 'exchange':
-            tot_volume = self.exchange(**item[1])
-            wb_dict.update({item[1]['name']: '{:.2f}'.format(tot_volume)})
-    # write water balance volumes to file according to header
-    self.wb_logger.info(', '.join([wb_dict[c] for c in self._wb_header]))
+            wb_dict[item[1]['name']] = self.exchange(**item[1])
+        if timer is not None:
+            timer.add('{:s}.{:s}'.format(item[0], item[1] if item[0] == 'update' else item[1]['name']),
+                      perf_counter() - t0)
+    wb_recorder = getattr(self, 'wb_recorder', None)
+    if wb_recorder is not None:
+        # columnar float64 records, see waterbalance.WaterBalanceRecorder
+        wb_recorder.record(self._t, wb_dict)
+    else:
+        # write water balance volumes to file according to header
+        wb_dict = {name: '{:.2f}'.format(value) for name, value in wb_dict.items()}
+        wb_dict['time'] = str(self._t)
+        self.wb_logger.info(', '.join([wb_dict[c] for c in self._wb_header]))
     self._t = self.get_current_time()
 
 
-def update_lfp(self, dt=None, infiltcap=None, storagecap=None, infiltdt=3600):
+class InfiltrationEngine(object):
+    """
+    Infiltration of flood water from LISFLOOD into the soil, restricted to cells that can infiltrate at all (inside
+    the model mask, with a positive infiltration capacity and storage capacity). All work buffers are allocated
+    once, and at each infiltration event only cells that are wet at that moment are processed, so that the cost
+    scales with the number of wet cells instead of the domain size. The arithmetic follows the original inline
+    implementation in update_lfp element by element, so that results are bit-compatible.
+    """
+    def __init__(self, mask, z, dem, infiltcap, storagecap):
+        """
+        :param mask: 2D numpy array (bool) - cells that are part of the model domain
+        :param z: 2D numpy array - sub-grid channel bed elevation (SGCz)
+        :param dem: 2D numpy array - terrain elevation (DEM)
+        :param infiltcap: float or 2D numpy array - infiltration capacity in mm s-1
+        :param storagecap: float or 2D numpy array - available storage capacity left over in the soil in mm
+        """
+        self.shape = mask.shape
+        self._infiltcap = np.array(infiltcap, dtype=np.float64)
+        self._storagecap = np.array(storagecap, dtype=np.float64)
+        infiltcap = np.broadcast_to(self._infiltcap, self.shape)
+        storagecap = np.broadcast_to(self._storagecap, self.shape)
+        if np.any(infiltcap < 0) or np.any(storagecap < 0):
+            raise ValueError('Infiltration capacity and storage capacity must be non-negative')
+        # compact index of cells that can infiltrate, other cells always have zero infiltration
+        self.index = np.flatnonzero(mask & (infiltcap > 0) & (storagecap > 0))
+        self.z = z.reshape(-1)[self.index].astype(np.float64)
+        self.dem = dem.reshape(-1)[self.index].astype(np.float64)
+        self.infiltcap = infiltcap.reshape(-1)[self.index].copy()
+        self.storagecap = storagecap.reshape(-1)[self.index] / 1000
+        self.total = np.zeros(len(self.index))
+        # work buffers
+        n = len(self.index)
+        self._depth = np.zeros(n)
+        self._wet = np.zeros(n, dtype=bool)
+        self._pos = np.arange(n)
+        self._wet_pos = np.zeros(n, dtype=np.int64)
+        self._wet_idx = np.zeros(n, dtype=np.int64)
+        self._cap = np.zeros(n)
+        self._pot = np.zeros(n)
+
+    def matches(self, infiltcap, storagecap):
+        """
+        Checks if the engine was set up for the given capacities, so that it can be reused
+        :param infiltcap: float or 2D numpy array - infiltration capacity in mm s-1
+        :param storagecap: float or 2D numpy array - available storage capacity left over in the soil in mm
+        :return: boolean
+        """
+        return np.array_equal(self._infiltcap, infiltcap) and np.array_equal(self._storagecap, storagecap)
+
+    def reset(self):
+        """
+        Resets the total infiltration, at the start of each coupled time step
+        """
+        self.total[:] = 0.
+
+    def apply(self, h, seconds):
+        """
+        Infiltrates flood water over a sub-time step and removes it from the water depth in place
+        :param h: 2D numpy array - water depth as retrieved with get_var('H'), changed in place
+        :param seconds: float - length of the sub-time step in seconds
+        """
+        h_flat = h.reshape(-1)
+        # water level above terrain level
+        np.take(h_flat, self.index, out=self._depth)
+        self._depth += self.z
+        self._depth -= self.dem
+        np.maximum(self._depth, 0, out=self._depth)
+        # only wet cells can infiltrate
+        np.greater(self._depth, 0, out=self._wet)
+        n = np.count_nonzero(self._wet)
+        if n == 0:
+            return
+        pos = np.compress(self._wet, self._pos, out=self._wet_pos[:n])
+        idx = np.take(self.index, pos, out=self._wet_idx[:n])
+        depth = np.take(self._depth, pos, out=self._depth[:n])
+        # infiltration capacity within sub-time step (in m total)
+        cap = np.take(self.infiltcap, pos, out=self._cap[:n])
+        cap *= seconds
+        cap /= 1000
+        # infiltration maximized to capacity currently available in soil
+        pot = np.take(self.storagecap, pos, out=self._pot[:n])
+        pot -= self.total[pos]
+        np.minimum(pot, cap, out=pot)
+        actual = np.minimum(depth, pot, out=pot)
+        self.total[pos] += actual
+        h_flat[idx] -= actual
+
+    def infilt(self):
+        """
+        :return: 2D numpy array - total infiltration since the last reset in mm
+        """
+        infilt = np.zeros(self.shape)
+        infilt.reshape(-1)[self.index] = self.total * 1000
+        return infilt
+
+
+def update_lfp(self, dt=None, infiltcap=None, storagecap=None, infiltdt=3600, native=False):
     """
     refactoring (monkey patch) of lisflood GLOFRIM update function to be able to account for infiltration
     inputs:
@@ -64,30 +175,19 @@ def update_lfp(self, dt=None, infiltcap=None, storagecap=None, infiltdt=3600):
         infiltcap: infiltration capacity in mm s-1
         storagecap: available storage capacity left over in the soil in mm
         infiltdt: frequency by which to update the infiltration
+        native: if True, the model is advanced with one update_until call of the library per infiltration event
+            (at whole multiples of infiltdt and at the end of the time step) instead of one Python call per
+            adaptive time step. Requires a library with update_until (e.g. inertial.InertialModel).
+    If flood statistics are attached to the model (see floodstats.FloodStatistics.attach), water depths are added
+    to them after every infiltration event.
 
     """
-
-    def infilt():
-        """
-        Determine infiltration over time step
-        """
-        # get water level above channel depth
-        h = self._bmi.get_var('H')
-        flood_depth = np.maximum(h + z - dem, 0)
-        current_infilt_cap = infiltcap * ((
-                                                      self._t - t_current_infilt).total_seconds()) / 1000  # infiltration capacity within sub-time step (in m total)
-        potential_infilt = np.minimum(storagecap / 1000 - total_infiltration,
-                                      current_infilt_cap)  # infiltration maximized to capacity currently available in soil
-        return np.minimum(flood_depth, potential_infilt)
-
     from datetime import datetime, timedelta
 
-    # make a zero infiltration map [mm accumulated over time step]
-    total_infiltration = np.zeros(self.grid.mask.shape)
     if infiltcap is None:
-        infiltcap = np.ones(self.grid.mask.shape) * 1e6  # super large infiltration capacity
+        infiltcap = 1e6  # super large infiltration capacity
     if storagecap is None:
-        storagecap = np.zeros(self.grid.mask.shape)
+        storagecap = 0.
 
     # dt in seconds. if not given model timestep is used
     if self._t >= self._endTime:
@@ -104,32 +204,72 @@ def update_lfp(self, dt=None, infiltcap=None, storagecap=None, infiltdt=3600):
     t_current_infilt = self.get_current_time()
     t_next_infilt = t_current_infilt + timedelta(seconds=infiltdt)
     i = 0
-    t_current = self.get_current_time()
-    z = self._bmi.get_var('SGCz')
-    # retrieve the DEM
-    dem = self._bmi.get_var('DEM')
+    # set up the infiltration engine once and reuse it as long as the capacities do not change
+    engine = getattr(self, '_infilt_engine', None)
+    if engine is None or not engine.matches(infiltcap, storagecap):
+        z = self._bmi.get_var('SGCz')
+        # retrieve the DEM
+        dem = self._bmi.get_var('DEM')
+        engine = InfiltrationEngine(self.grid.mask, z, dem, infiltcap, storagecap)
+        self._infilt_engine = engine
+    # start with zero infiltration [mm accumulated over time step]
+    engine.reset()
+    # optional timing of sub-stepping and infiltration, see timing.StepTimer
+    timer = getattr(self, 'timer', None)
+    if timer is not None:
+        t_loop = perf_counter()
+        t_infilt = 0.
+    # optional sub-daily flood statistics
+    stats = getattr(self, 'flood_stats', None)
 
-    while self._t < t_next:
-        self._bmi.update()
+    if native:
+        # infiltration events in seconds since the start of this time step, computed once, so that the loop has
+        # no datetime arithmetic and no rounding of model times
+        t_bmi = self._bmi.get_current_time()
+        seconds = (t_next - self._t).total_seconds()
+        events = np.append(np.arange(infiltdt, seconds, infiltdt), seconds)
+        t_prev = 0.
+        for t_event in events:
+            self._bmi.update_until(t_bmi + t_event)
+            if timer is not None:
+                t0 = perf_counter()
+            engine.apply(self._bmi.get_var('H'), t_event - t_prev)
+            if timer is not None:
+                t_infilt += perf_counter() - t0
+            if stats is not None:
+                stats.add(self._t + timedelta(seconds=float(t_event)), self._bmi.get_var('H'))
+            t_prev = t_event
+            i += 1
         self._t = self.get_current_time()
-        if self._t > t_next_infilt:
-            #             print('Seconds past: {:d}'.format(int((self._t - t_current_infilt).total_seconds())))
-            actual_infilt = infilt()
-            total_infiltration += actual_infilt  # add current infiltration to total over entire GLOFRIM timestep
-            h = self._bmi.get_var('H')
-            h -= actual_infilt  # reduce water depth by infiltration amount, this should automatically also update h in lisflood itself
-            # update the next time step to store infilt
-            t_current_infilt = self._t
-            t_next_infilt = self._t + timedelta(seconds=infiltdt)
-        i += 1
+        t_current_infilt = self._t
+    else:
+        while self._t < t_next:
+            self._bmi.update()
+            self._t = self.get_current_time()
+            if self._t > t_next_infilt:
+                if timer is not None:
+                    t0 = perf_counter()
+                # reduce water depth by infiltration amount, this also updates h in lisflood itself
+                engine.apply(self._bmi.get_var('H'), (self._t - t_current_infilt).total_seconds())
+                if timer is not None:
+                    t_infilt += perf_counter() - t0
+                if stats is not None:
+                    stats.add(self._t, self._bmi.get_var('H'))
+                # update the next time step to store infilt
+                t_current_infilt = self._t
+                t_next_infilt = self._t + timedelta(seconds=infiltdt)
+            i += 1
+    if timer is not None:
+        t0 = perf_counter()
+        timer.add('LFP.substepping', t0 - t_loop - t_infilt)
     if self._t > t_current_infilt:
         # do one final infiltration update
-        #         print('Seconds past: {:d}'.format(int((self._t - t_current_infilt).total_seconds())))
-        actual_infilt = infilt()
-        total_infiltration += actual_infilt  # add current infiltration to total over entire GLOFRIM timestep
-        h = self._bmi.get_var('H')
-        h -= actual_infilt
+        engine.apply(self._bmi.get_var('H'), (self._t - t_current_infilt).total_seconds())
+        if stats is not None:
+            stats.add(self._t, self._bmi.get_var('H'))
+    if timer is not None:
+        timer.add('LFP.infiltration', t_infilt + perf_counter() - t0)
+        timer.add('LFP.substeps', i)
 
     self.logger.info('updated model to datetime {} in {:d} iterations'.format(self._t.strftime("%Y-%m-%d %H:%M:%S"), i))
-    self.infilt = total_infiltration * 1000
-#     return total_infiltration * 1000 # return this in mm over time step
\ No newline at end of file
+    self.infilt = engine.infilt()
@@ -5,6 +5,8 @@ import numpy as np
 import rasterio
 import rasterio.features
 from scipy.signal import convolve2d
+import scipy.sparse
+from .exchange import PointExchange
 # import .update_funcs
 
 def perpendicular(line, reverse=False):
@@ -112,9 +114,106 @@ def discharge(da_x, da_y, feats, key='name', reverse=False):
     :param reverse: boolean - default False (True), assuming that flow perpendicular direction is 90 degrees (counter)clockwise from the coordinate ordering of features.
     :return: flow: Dataset - containing all flow cross section time series
     """
-    qs = [discharge_f(da_x, da_y, feat, key, reverse=reverse) for feat in feats]
-    qs = [i for i in qs if i is not None]
-    return xr.concat(qs, dim='station')
+    operator = CrossSectionOperator(da_x['x'].values, da_y['y'].values, feats, key=key, reverse=reverse)
+    return operator.discharge(da_x, da_y)
+
+class CrossSectionOperator(object):
+    """
+    Compiles a set of cross-section lines into one sparse (station x cell) operator, using the same
+    perpendicular direction and sign logic as discharge_f. Discharge for all stations is then found with
+    one sparse product, either per time step during a run or per chunk of time steps afterwards.
+
+    Usage:
+        operator = CrossSectionOperator(x, y, fiona.open('../gis/cross_sections.gpkg'))
+        q = operator(qx, qy)  # 1D array with discharge per station
+        ds_q = operator.discharge(ds['Qx'], ds['Qy'])  # DataArray (station, time)
+    """
+    def __init__(self, x, y, feats, key='name', reverse=False):
+        """
+        :param x: 1D numpy array - x-coordinates of the (cell centred) flow fields
+        :param y: 1D numpy array - y-coordinates of the (cell centred) flow fields
+        :param feats: fiona features - (must be 2-coordinate LineStrings only!)
+        :param key: string - name of fiona property (default: 'name') to use for naming of discharge cross section stations
+        :param reverse: boolean - default False (True), assuming that flow perpendicular direction is 90 degrees (counter)clockwise from the coordinate ordering of features.
+        """
+        x, y = np.array(x), np.array(y)
+        res_x, res_y = np.abs((x[-1] - x[0]) / (len(x) - 1)), np.abs((y[-1] - y[0]) / (len(y) - 1))
+        xmin, xmax = x.min() - res_x * .5, x.max() + res_x * .5
+        ymin, ymax = y.min() - res_y * .5, y.max() + res_y * .5
+        self.shape = (len(y), len(x))
+        transform = rasterio.transform.from_bounds(xmin, ymin, xmax, ymax, len(x), len(y))
+        self.stations = []
+        rows, cols, values = [], [], []
+        for feat in feats:
+            if feat is None:
+                continue
+            if feat['geometry']['type'] != 'LineString':
+                raise ValueError('Feature other than LineString found')
+            if len(feat['geometry']['coordinates']) != 2:
+                raise IndexError(
+                    'Non-straight lines found in cross-sections. Each cross-section line may only contain two coordinates')
+            north, east = perpendicular(feat['geometry']['coordinates'], reverse=reverse)
+            if north == -1:
+                north_south_conv = np.array([[0., -1., 0.], [0., 1, 0.], [0., 0., 0]])
+            else:
+                north_south_conv = np.array([[0., 0., 0.], [0., 1, 0.], [0., -1., 0]])
+            if east == -1:
+                west_east_conv = np.array([[0., 0., 0.], [0., 1, -1.], [0., 0., 0]])
+            else:
+                west_east_conv = np.array([[0., 0., 0.], [-1., 1, 0.], [0., 0., 0]])
+            image = rasterio.features.rasterize([(feat['geometry'], 1)],
+                                                out_shape=self.shape,
+                                                transform=transform,
+                                                all_touched=True
+                                                )
+            north_south_cells = np.maximum(convolve2d(image, north_south_conv, mode='same'), 0) * north
+            west_east_cells = np.maximum(convolve2d(image, west_east_conv, mode='same'), 0) * east
+            # x-directional flow goes in the first half of the columns, y-directional flow in the second half
+            for n, cells in enumerate([west_east_cells, north_south_cells]):
+                idx = np.flatnonzero(cells)
+                rows.append(np.full(len(idx), len(self.stations)))
+                cols.append(idx + n * cells.size)
+                values.append(cells.flatten()[idx])
+            self.stations.append(feat['properties'][key])
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        # only keep the cells that are used by any station, so that flow fields can be subsetted before the product
+        self.index, cols = np.unique(cols, return_inverse=True)
+        self.operator = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(len(self.stations), len(self.index)))
+
+    def __call__(self, qx, qy):
+        """
+        Computes discharge over all cross sections
+        :param qx: numpy array - x-directional flow, (y, x) for one time step or (time, y, x)
+        :param qy: numpy array - y-directional flow, (y, x) for one time step or (time, y, x)
+        :return: numpy array - discharge (station) for one time step or (time, station)
+        """
+        n_cells = self.shape[0] * self.shape[1]
+        q = np.concatenate([np.reshape(qx, (-1, n_cells)), np.reshape(qy, (-1, n_cells))], axis=1)[:, self.index]
+        # missing values do not contribute, as in discharge_f
+        q[np.isnan(q)] = 0.
+        flow = (self.operator @ q.T).T
+        return flow[0] if np.ndim(qx) == 2 else flow
+
+    def discharge(self, da_x, da_y, chunk=365):
+        """
+        Computes discharge time series over all cross sections from x- and y-directional flow DataArrays,
+        reading the flow fields in chunks of time steps
+        :param da_x: DataArray - containing x-directional flow (time, y, x)
+        :param da_y: DataArray - containing y-directional flow (time, y, x)
+        :param chunk: int - number of time steps to process at once
+        :return: flow: DataArray - containing all flow cross section time series (station, time)
+        """
+        flow = np.concatenate([self(da_x[i:i + chunk].values, da_y[i:i + chunk].values)
+                               for i in range(0, len(da_x['time']), chunk)], axis=0)
+        return xr.DataArray(flow.T,
+                            dims=('station', 'time'),
+                            coords={'station': self.stations,
+                                    'time': da_x['time']
+                                    },
+                            attrs={'units': da_x.units,
+                                   'short_name': 'river_discharge'
+                                   }
+                            )
 
 def list_to_dataarray(data, time, x, y, name, attrs):
     """
@@ -146,7 +245,8 @@ def merge_outputs(datas, time, x, y, names, attributes):
     :param y: 1D numpy array - y-coordinates
     :param names: list - containing strings with names of datas
     :param attributes: list - containing attributes belonging to datas
-    :return: Dataset of all data in datas
+    :return: Dataset of all data in datas, unchanged. Write it quantised and compressed with
+        ds.to_netcdf(fn, encoding=output_encodings(ds))
     """
     return xr.merge([list_to_dataarray(data, time, x, y, name, attrs) for data, name, attrs in zip(datas, names, attributes)])
 
@@ -169,9 +269,20 @@ def get_indexes(cbmi, gdf, model_name="WFL", x_off=None, y_off=None):
     return idxs
 
 def update_runoff_bounds(cbmi, idxs, model_out="WFL", var_out="RiverRunoff", model_in="Sfincs", var_in="qsrc"):
-    flux_out = cbmi.bmimodels[model_out].get_value_at_indices(var_out, idxs)
-    flux_in = cbmi.bmimodels[model_in]._bmi.get_var(var_in)
-    # print(flux_in)
-    # overwrite discharges in all time steps
-    flux_in[:] = flux_out
-    cbmi.bmimodels[model_in]._bmi.set_var(var_in, flux_in)
+    """Overwrites the discharges at all times of the target point sources (default SFINCS qsrc) with the source
+    values at idxs (default wflow RiverRunoff). Sets up the exchange at every call, in a time loop set up a
+    PointExchange once and push it instead.
+    """
+    PointExchange(cbmi, idxs, model_out=model_out, var_out=var_out, model_in=model_in, var_in=var_in).push()
+
+def grid_coords(transform, shape):
+    """
+    Derives x and y axes (cell centres) from a grid definition
+    :param transform: Affine - transform of the grid
+    :param shape: tuple - (rows, cols) of the grid
+    :return: (x, y) - lists with x-coordinates and y-coordinates
+    """
+    rows, cols = shape
+    x = rasterio.transform.xy(transform, np.zeros(cols, dtype=int), np.arange(cols))[0]
+    y = rasterio.transform.xy(transform, np.arange(rows), np.zeros(rows, dtype=int))[1]
+    return x, y
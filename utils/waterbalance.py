@@ -0,0 +1,162 @@
+# columnar water balance records of coupled GLOFRIM runs. Volumes in and out of each model and exchanged volumes
+# are kept as float64 numbers instead of formatted strings in a text log, and written in chunks to a NetCDF file
+# with one column (variable) per quantity
+from datetime import datetime
+import numpy as np
+import netCDF4
+import pandas as pd
+
+TIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+EPOCH = datetime(1970, 1, 1)
+# value used by update_glofrim for models that do not report volumes in and out
+MISSING = -9999.
+
+
+class WaterBalanceRecorder(object):
+    """
+    Records the water balance of a coupled run at every coupled time step. Records are appended to a preallocated
+    structured array and only written to disk when it is full (or at flush and close), so that the cost per step is
+    a few assignments. The file has an unlimited record dimension, so it grows with the run. The columns are set
+    by the first record: time and, in order, all other quantities (e.g. LFP_tot_in, LFP_tot_out, exchange names).
+    Set it on the coupled model to use it instead of the text water balance log of update_glofrim:
+        cbmi.wb_recorder = WaterBalanceRecorder(fn_wb)
+        ...
+        cbmi.wb_recorder.close()
+    """
+    def __init__(self, fn, chunk=1024, position=None):
+        """
+        :param fn: string - path to NetCDF file to write (overwritten if it exists, unless position is set)
+        :param chunk: int - number of records kept in memory before they are written to disk
+        :param position: int - if set, the existing file is reopened and recording continues at this record
+        """
+        self.fn = fn
+        self.chunk = chunk
+        self.columns = None
+        self._buffer = None
+        self._m = 0
+        if position is not None:
+            self.nc = netCDF4.Dataset(fn, 'a')
+            self._n_file = position
+            self._setup([name for name in self.nc.variables if name != 'time'])
+        else:
+            self.nc = netCDF4.Dataset(fn, 'w', format='NETCDF4')
+            self.nc.createDimension('record', None)
+            self._n_file = 0
+
+    @property
+    def n(self):
+        """
+        :return: int - number of records, written and buffered
+        """
+        return self._n_file + self._m
+
+    def _setup(self, names):
+        self.columns = ['time'] + list(names)
+        self._buffer = np.zeros(self.chunk, dtype=[(name, 'f8') for name in self.columns])
+        for name in self.columns:
+            if name not in self.nc.variables:
+                v = self.nc.createVariable(name, 'f8', ('record',), chunksizes=(self.chunk,))
+                if name == 'time':
+                    v.units = TIME_UNITS
+                    v.calendar = 'standard'
+                else:
+                    v.units = 'm**3'
+
+    def record(self, time, values):
+        """
+        Appends the water balance of one coupled time step
+        :param time: datetime - time at the start of the coupled time step
+        :param values: dict - volumes (float) by name of quantity, in the same order at every step
+        """
+        if self.columns is None:
+            self._setup(values.keys())
+        row = self._buffer[self._m]
+        row['time'] = (time - EPOCH).total_seconds()
+        for name, value in values.items():
+            row[name] = value
+        self._m += 1
+        if self._m == self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered records to disk
+        """
+        if self._m > 0:
+            for name in self.columns:
+                self.nc[name][self._n_file:self._n_file + self._m] = self._buffer[name][:self._m]
+            self._n_file += self._m
+            self._m = 0
+        self.nc.sync()
+
+    def close(self):
+        """
+        Writes the buffered records and closes the file
+        """
+        if self.nc.isopen():
+            self.flush()
+            self.nc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WaterBalance(object):
+    """
+    Queries on a water balance file written by WaterBalanceRecorder. Columns named <model>_tot_in and
+    <model>_tot_out are the volumes in and out of a model as reported by the model in each coupled time step,
+    all other columns are exchanged volumes. Volumes that are not reported by a model are NaN, and left out of totals.
+
+    Usage:
+        wb = WaterBalance(fn_wb)
+        wb.model('LFP')      # volumes in, out and residual (in - out) of LISFLOOD per time step
+        wb.exchanges()       # exchanged volumes per time step
+        wb.totals()          # totals over the run
+    """
+    def __init__(self, fn):
+        """
+        :param fn: string - path to water balance file
+        """
+        with netCDF4.Dataset(fn, 'r') as nc:
+            time = pd.to_datetime(np.asarray(nc['time'][:]), unit='s', origin=EPOCH)
+            self.data = pd.DataFrame({name: np.asarray(nc[name][:]) for name in nc.variables if name != 'time'},
+                                     index=pd.DatetimeIndex(time, name='time'))
+        # volumes that are not reported by a model are missing, not -9999 m3
+        self.data[self.data == MISSING] = np.nan
+        self.models = [c[:-len('_tot_in')] for c in self.data.columns if c.endswith('_tot_in')]
+        model_columns = ['{:s}_tot_{:s}'.format(mod, io) for mod in self.models for io in ['in', 'out']]
+        self.exchange_names = [c for c in self.data.columns if c not in model_columns]
+
+    def model(self, mod):
+        """
+        :param mod: string - model short name, e.g. 'LFP'
+        :return: DataFrame - volumes in, out and residual (in - out) per time step
+        """
+        df = pd.DataFrame({'in': self.data['{:s}_tot_in'.format(mod)],
+                           'out': self.data['{:s}_tot_out'.format(mod)]})
+        df['residual'] = df['in'] - df['out']
+        return df
+
+    def exchanges(self):
+        """
+        :return: DataFrame - exchanged volumes per time step, one column per exchange
+        """
+        return self.data[self.exchange_names]
+
+    def totals(self, start=None, end=None):
+        """
+        Sums volumes over (a period of) the run
+        :param start: datetime or string - first time step to include (default: start of run)
+        :param end: datetime or string - last time step to include (default: end of run)
+        :return: Series - totals of volumes in, out and residual per model, and of each exchange
+        """
+        totals = {}
+        for mod in self.models:
+            for name, series in self.model(mod)[start:end].items():
+                totals['{:s}_{:s}'.format(mod, name)] = series.sum(min_count=1)
+        for name, series in self.exchanges()[start:end].items():
+            totals[name] = series.sum(min_count=1)
+        return pd.Series(totals)
@@ -0,0 +1,251 @@
+# chunked zarr output store for coupled GLOFRIM runs, as an alternative to the NetCDF OutputWriter. Fields are
+# chunked in time and in spatial tiles, so that browsing a map or extracting a time series only reads the chunks
+# it touches, and chunks are compressed and written from a background thread pool while the model runs
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import netCDF4
+from .encoding import get_encoding
+from .output import GRID_DIMS, faces, face_mask
+
+# default chunk sizes: time steps per chunk, rows and columns per tile (cells per chunk in compact stores)
+CHUNKS = {'time': 8, 'y': 256, 'x': 256, 'cell': 65536}
+
+
+def _open_group(fn, mode):
+    # zarr format 2 is read by all zarr and xarray versions, zarr 2 has no zarr_format argument
+    import zarr
+    try:
+        return zarr.open_group(fn, mode=mode, zarr_format=2)
+    except TypeError:
+        return zarr.open_group(fn, mode=mode)
+
+
+def _compressor(encoding, complevel):
+    from numcodecs import Blosc
+    shuffle = Blosc.SHUFFLE if encoding.shuffle else Blosc.NOSHUFFLE
+    return Blosc(cname='zstd', clevel=encoding.complevel or complevel, shuffle=shuffle)
+
+
+def _create(group, name, data=None, shape=None, chunks=None, dtype='f8', dims=(), attrs={}, compressor=None,
+            fill_value=None):
+    # array with the dimension names that xarray reads from zarr format 2 stores
+    shape = np.shape(data) if shape is None else shape
+    v = group.create_dataset(name, shape=shape, chunks=chunks or shape, dtype=dtype, compressor=compressor,
+                             fill_value=fill_value)
+    v.attrs.update(dict(attrs, _ARRAY_DIMENSIONS=list(dims)))
+    if data is not None:
+        v[...] = data
+    return v
+
+
+class ZarrWriter(object):
+    """
+    Writes 2D output fields of a coupled run to a zarr store (folder), with the same interface and layout as
+    OutputWriter (time, y, x or compact cell dimensions, static and staggered variables, encodings), so that the
+    store is opened with xr.open_zarr(fn) and used with the active and derived accessors.
+    Fields are chunked in time (CHUNKS['time'] steps) and in spatial tiles (CHUNKS['y'] x CHUNKS['x'] cells, or
+    CHUNKS['cell'] active cells), a compromise between map access (one time slab reads one chunk row per tile) and
+    time series access (one point reads one tile over time). Appended slices are collected in memory until a
+    chunk row in time is complete, which is then compressed and written tile by tile in a background thread pool
+    while the model continues. Metadata is consolidated, so that opening the store reads a single file.
+    A run resumed from a checkpoint reopens the store with the position stored in the checkpoint (flush writes
+    the incomplete chunk row as well).
+
+    Usage:
+        writer = ZarrWriter(fn_out.replace('.nc', '.zarr'), x, y, names, attributes, mask=mask)
+        while running:
+            writer.append(cbmi.get_current_time(), [q, h, ...])
+        writer.close()
+        ds = xr.open_zarr(fn_out.replace('.nc', '.zarr'))
+    """
+    def __init__(self, fn, x, y, names, attributes, time_units='seconds since 1970-01-01 00:00:00',
+                 calendar='standard', complevel=4, mask=None, position=None, encodings=None, static=None,
+                 staggered=None, chunks=None, workers=4):
+        """
+        :param fn: string - path to zarr store to write (overwritten if it exists, unless position is set)
+        :param x: 1D numpy array - x-coordinates
+        :param y: 1D numpy array - y-coordinates
+        :param names: list - containing strings with names of variables to write
+        :param attributes: list - containing attributes dictionaries belonging to names
+        :param time_units: string - CF-compliant units used to encode the time axis
+        :param calendar: string - CF-compliant calendar used to encode the time axis
+        :param complevel: int - compression level (1-9) of the zstd compressor
+        :param mask: 2D numpy array (bool) - if set, only cells where mask is True are stored
+        :param position: int - if set, the existing store is reopened and writing continues at this time step
+        :param encodings: dict - encodings overriding ENCODINGS, by variable name, short_name or units
+        :param static: dict - 2D numpy arrays and attributes dictionaries (tuples) of static fields by name, written
+            once
+        :param staggered: dict - axis ('x' or 'y') of variables on the faces between cells by name
+        :param chunks: dict - chunk sizes overriding CHUNKS (keys time, y, x and cell)
+        :param workers: int - number of threads that compress and write chunks
+        """
+        self.fn = fn
+        self.names = list(names)
+        self.encodings = [get_encoding(name, attrs, encodings) for name, attrs in zip(self.names, attributes)]
+        self.staggered = dict(staggered or {})
+        self.shapes = {None: (len(y), len(x)), 'x': (len(y), len(x) + 1), 'y': (len(y) + 1, len(x))}
+        self.chunks = dict(CHUNKS, **(chunks or {}))
+        self.time_units = time_units
+        self.calendar = calendar
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.workers = workers
+        if position is not None:
+            self.group = _open_group(fn, 'r+')
+            self.indices = {axis: np.asarray(self.group[dims[2]][:]) for axis, dims in GRID_DIMS.items()
+                            if dims[2] in self.group}
+            self.index = self.indices.get(None)
+            self.n = position
+            self._open_arrays()
+            self._resize(position)
+            self._new_buffers()
+            # the incomplete chunk row in time is read back, it is written again when complete
+            start = self._block_start()
+            for name, buffer in self.buffers.items():
+                buffer[:position - start] = self.arrays[name][start:position]
+            self.times[:position - start] = self.arrays['time'][start:position]
+            return
+        self.n = 0
+        self.group = _open_group(fn, 'w')
+        _create(self.group, 'time', shape=(0,), chunks=(1024,), dims=('time',),
+                attrs={'units': time_units, 'calendar': calendar})
+        _create(self.group, 'y', np.array(y, dtype=np.float64), dims=('y',))
+        _create(self.group, 'x', np.array(x, dtype=np.float64), dims=('x',))
+        axes = set(self.staggered.get(name) for name in self.names) - {None}
+        for axis, name, coords in [('x', 'x_u', x), ('y', 'y_v', y)]:
+            if axis in axes:
+                _create(self.group, name, faces(coords), dims=(name,),
+                        attrs={'long_name': '{:s}-coordinate of cell faces'.format(axis)})
+        self.indices = {}
+        if mask is not None:
+            _create(self.group, 'mask', np.array(mask, dtype=np.int8), dtype='i1', dims=('y', 'x'))
+            for axis in [None] + sorted(axes):
+                cell = GRID_DIMS[axis][2]
+                self.indices[axis] = np.flatnonzero(mask if axis is None else face_mask(mask, axis))
+                _create(self.group, cell, self.indices[axis], dtype='i8', dims=(cell,),
+                        attrs={'long_name': 'flat index of active {:s} in ({:s}, {:s}) grid'.format(
+                            'cell' if axis is None else 'face', *GRID_DIMS[axis][:2])})
+        self.index = self.indices.get(None)
+        for name, (data, attrs) in (static or {}).items():
+            encoding = get_encoding(name, attrs, encodings)
+            data = encoding.pack(self._select(None, data))
+            _create(self.group, name, data, dtype=encoding.dtype, dims=self._dims(None),
+                    attrs=dict(attrs, **encoding.attributes()), compressor=_compressor(encoding, complevel),
+                    fill_value=self._fill_value(encoding))
+        for name, attrs, encoding in zip(self.names, attributes, self.encodings):
+            shape = self._shape(self.staggered.get(name))
+            _create(self.group, name, shape=(0,) + shape, chunks=self._chunks(shape), dtype=encoding.dtype,
+                    dims=('time',) + self._dims(self.staggered.get(name)),
+                    attrs=dict(attrs, **encoding.attributes()), compressor=_compressor(encoding, complevel),
+                    fill_value=self._fill_value(encoding))
+        self._open_arrays()
+        self._new_buffers()
+        self._consolidate()
+
+    def _open_arrays(self):
+        # arrays are kept, so that they are resized in place (arrays taken from the group again may have the
+        # shape of the consolidated metadata)
+        self.arrays = {name: self.group[name] for name in ['time'] + self.names}
+
+    @staticmethod
+    def _fill_value(encoding):
+        return encoding.fill_value if encoding.packed else np.nan
+
+    def _dims(self, axis):
+        rows, cols, cell = GRID_DIMS[axis]
+        return (rows, cols) if self.index is None else (cell,)
+
+    def _shape(self, axis):
+        return self.shapes[axis] if self.index is None else (len(self.indices[axis]),)
+
+    def _chunks(self, shape):
+        if len(shape) == 1:
+            return (self.chunks['time'], min(self.chunks['cell'], max(shape[0], 1)))
+        return (self.chunks['time'], min(self.chunks['y'], shape[0]), min(self.chunks['x'], shape[1]))
+
+    def _select(self, axis, data):
+        # crops a slice to the (staggered) grid and selects the active cells
+        rows, cols = self.shapes[axis]
+        data = np.asarray(data)[:rows, :cols]
+        if self.index is not None:
+            data = data.reshape(-1)[self.indices[axis]]
+        return data
+
+    def _block_start(self):
+        return (self.n // self.chunks['time']) * self.chunks['time']
+
+    def _new_buffers(self):
+        # buffers of one chunk row in time, handed over to the writing threads when complete
+        self.buffers = {name: np.full((self.chunks['time'],) + self._shape(self.staggered.get(name)),
+                                      self._fill_value(encoding), dtype=encoding.dtype)
+                        for name, encoding in zip(self.names, self.encodings)}
+        self.times = np.zeros(self.chunks['time'])
+
+    def _resize(self, n):
+        for arr in self.arrays.values():
+            arr.resize((n,) + arr.shape[1:])
+
+    def _consolidate(self):
+        import zarr
+        zarr.consolidate_metadata(self.fn)
+
+    def _write_block(self, start, stop):
+        # submits the writes of the buffered chunk row, one task per variable and spatial tile
+        self._resize(stop)
+        self.arrays['time'][start:stop] = self.times[:stop - start]
+        for name, buffer in self.buffers.items():
+            arr = self.arrays[name]
+            tiles = [[slice(i, min(i + c, size)) for i in range(0, size, c)]
+                     for size, c in zip(arr.shape[1:], arr.chunks[1:])]
+            for region in product(*tiles):
+                self.pending.append(self.pool.submit(arr.__setitem__, (slice(start, stop),) + region,
+                                                     buffer[(slice(0, stop - start),) + region]))
+        # limit the memory held by pending writes
+        while len(self.pending) > 4 * self.workers * max(len(self.names), 1):
+            self.pending.pop(0).result()
+
+    def append(self, time, datas):
+        """
+        Appends one time step, written when its chunk row in time is complete
+        :param time: datetime - time of the slices as retrieved from bmi model
+        :param datas: list - 2D numpy slices in the same order as names, or dict with names as keys
+        """
+        if isinstance(datas, dict):
+            datas = [datas[name] for name in self.names]
+        i = self.n - self._block_start()
+        self.times[i] = netCDF4.date2num(time, self.time_units, calendar=self.calendar)
+        for name, data, encoding in zip(self.names, datas, self.encodings):
+            self.buffers[name][i] = encoding.pack(self._select(self.staggered.get(name), data))
+        self.n += 1
+        if self.n % self.chunks['time'] == 0:
+            self._write_block(self.n - self.chunks['time'], self.n)
+            self._new_buffers()
+
+    def flush(self):
+        """
+        Writes the incomplete chunk row, waits until all chunks are written and consolidates the metadata, e.g.
+        before a checkpoint
+        """
+        start = self._block_start()
+        if self.n > start:
+            # the buffers are kept, the chunk row is written again when complete
+            self._write_block(start, self.n)
+        while len(self.pending) > 0:
+            self.pending.pop(0).result()
+        self._consolidate()
+
+    def close(self):
+        """
+        Writes all remaining time steps and closes the store
+        """
+        if self.pool is not None:
+            self.flush()
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()